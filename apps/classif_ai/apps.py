@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class ClassifaiConfig(AppConfig):
     name = "apps.classif_ai"
+
+    def ready(self):
+        # registers the tenant hooks defined in helpers and the check reporting the missing ones
+        import apps.classif_ai.helpers  # noqa: F401
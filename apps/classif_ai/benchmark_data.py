@@ -0,0 +1,73 @@
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator
+
+from django.db import connection, transaction
+
+from apps.classif_ai.models import File, FileSet, FileSetInferenceQueue
+
+### how do the benchmark commands generate their data?
+# Every benchmark inserts its synthetic dataset with a single statement: --files file sets spread over the last --days
+# days, each with a finished inference queue of the ml model and a single file, generated from generate_series. Each
+# command appends the rows only it needs (model classifications, ai regions...) to the same statement. The dataset is
+# generated and benchmarked inside a transaction that is rolled back, unless --keep is given.
+
+FILE_SETS_SQL = """
+    with file_sets as (
+        insert into {file_set_table} (created_ts, updated_ts, subscription_id, meta_info, is_deleted, is_bookmarked)
+        select now() - (i %% %(days)s) * interval '1 day', now(), %(subscription_id)s, {meta_info}, false, false
+        from generate_series(1, %(files)s) i
+        returning id, created_ts
+    ),
+    queues as (
+        insert into {queue_table} (created_ts, updated_ts, file_set_id, ml_model_id, status, inference_id)
+        select created_ts, created_ts, id, %(ml_model_id)s, 'FINISHED', '' from file_sets
+    ),
+    files as (
+        insert into {file_table} (created_ts, updated_ts, file_set_id, name, path)
+        select created_ts, created_ts, id, '', '' from file_sets
+        returning id, created_ts
+    )
+"""
+
+
+@contextmanager
+def benchmark_transaction(keep: bool) -> Iterator[None]:
+    """[a transaction the generated data is rolled back with at the end of the benchmark, unless keep]"""
+    with transaction.atomic():
+        yield
+        if not keep:
+            transaction.set_rollback(True)
+
+
+def insert_synthetic_file_sets(
+    options: Dict, sql: str, params: Dict, models: Iterable, meta_info: str = "'{}'::jsonb"
+) -> float:
+    """[inserts the file sets, inference queues and files of the command options along with the rows of sql, returns
+    the seconds it took.
+    sql is the rest of the statement after the files cte: a comma and the command's own ctes if it has any, then the
+    final insert. It can use the file_sets (id, created_ts) and files (id, created_ts) ctes. meta_info is the sql of
+    the meta info of the file sets, i is the number of the file set. The tables of the models sql inserts into are
+    analyzed along with the common ones, so that the planner picks the plans the real data would get]"""
+    started_at = time.perf_counter()
+    statement = (
+        FILE_SETS_SQL.format(
+            file_set_table=FileSet._meta.db_table,
+            queue_table=FileSetInferenceQueue._meta.db_table,
+            file_table=File._meta.db_table,
+            meta_info=meta_info,
+        )
+        + sql
+    )
+    params = {
+        "days": options["days"],
+        "files": options["files"],
+        "subscription_id": options["subscription_id"],
+        "ml_model_id": options["ml_model_id"],
+        **params,
+    }
+    with connection.cursor() as cursor:
+        cursor.execute(statement, params)
+        for model in [FileSet, FileSetInferenceQueue, File, *models]:
+            cursor.execute(f"analyze {connection.ops.quote_name(model._meta.db_table)}")
+    return time.perf_counter() - started_at
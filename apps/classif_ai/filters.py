@@ -25,11 +25,12 @@ from apps.classif_ai.models import (
     Defect,
     UserClassification,
     ModelClassification,
+    ModelClassificationDefect,
     ModelDetection,
     UserDetection,
     WaferMap,
 )
-from apps.classif_ai.helpers import get_env, _auto_model_filter
+from apps.classif_ai.helpers import _auto_model_filter
 
 
 class NumberInFilter(django_filters.BaseInFilter, django_filters.NumberFilter):
@@ -189,31 +190,23 @@ class FileSetFilterSet(django_filters.FilterSet):
 
         model_filter = Q(files__model_classifications__ml_model_id__in=ml_model_ids)
         defect_filter = Q()
-        if defect_ids:
+        if defect_ids and priority:
+            # only the files whose highest priority defect is one of the defects, the top defect of every
+            # classification is picked once in a subquery instead of excluding the higher priority ones per file set
+            top_defects = ModelClassificationDefect.objects.top_defects(ml_model_ids)
+            defect_filter = defect_filter | Q(
+                files__in=ModelClassificationDefect.objects.filter(
+                    id__in=top_defects.values("id"), defect_id__in=defect_ids
+                ).values("classification__file_id")
+            )
+        elif defect_ids:
             defect_filter = defect_filter | Q(
                 files__model_classifications__model_classification_annotations__defect_id__in=defect_ids
             )
         if include_nvd:
             defect_filter = defect_filter | Q(files__model_classifications__is_no_defect=True)
 
-        queryset = queryset.filter(model_filter & defect_filter)
-
-        if priority:
-            ordered_defect_ids = get_env().list("ORDERED_DEFECT_IDS", cast=int, default=[1, 2, 4, 5, 3, 6])
-            # defect_ids should always have a single element if priority is True
-            idx = len(ordered_defect_ids)
-            for dd in defect_ids:
-                try:
-                    t_idx = ordered_defect_ids.index(dd)
-                    if t_idx < idx:
-                        idx = t_idx
-                except ValueError:
-                    pass
-            queryset = queryset.exclude(
-                files__model_classifications__model_classification_annotations__defect_id__in=ordered_defect_ids[0:idx]
-            )
-
-        return queryset
+        return queryset.filter(model_filter & defect_filter)
 
     def get_file_sets_with_train_type(self, queryset: QuerySet, _, value):
         train_types = value
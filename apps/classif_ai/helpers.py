@@ -1,7 +1,6 @@
 import base64
 import errno
 from calendar import monthrange
-import importlib
 import os
 import uuid
 import pytz
@@ -13,10 +12,12 @@ from xml.parsers.expat import ExpatError
 from common.services import SqsService
 
 import environ
-from django.db import models, connection, transaction
+from django.db import models, transaction
 from django.db.models import Q, Subquery, OuterRef
+from django.db.models.functions import TruncDay, TruncMonth, TruncWeek
 from django.utils.text import slugify
 
+from apps.classif_ai.tenant_hooks import register_tenant_hook, require_tenant_hook
 from apps.subscriptions.models import Subscription
 from sixsense.settings import BASE_DIR, PROJECT_START_DATE, IMAGE_HANDLER_QUEUE_URL
 
@@ -30,6 +31,17 @@ def get_env():
     return env
 
 
+def get_ordered_defect_ids():
+    """[ids of all the defects from the highest priority to the lowest, the ones in ORDERED_DEFECT_IDS first and the
+    others by their creation]"""
+    from apps.classif_ai.models import Defect
+
+    ordered_defect_ids = get_env().list("ORDERED_DEFECT_IDS", cast=int, default=[1, 2, 4, 5, 3, 6])
+    return ordered_defect_ids + list(
+        Defect.objects.exclude(id__in=ordered_defect_ids).order_by("created_ts").values_list("id", flat=True)
+    )
+
+
 def add_uuid_to_file_name(complete_file_name):
     split = complete_file_name.split(".")
     file_name = ".".join(split[0:-1])
@@ -37,6 +49,7 @@ def add_uuid_to_file_name(complete_file_name):
     return file_name + "--" + uuid.uuid4().hex[:10] + "." + extension
 
 
+@register_tenant_hook("infineon", "get_use_case_id")
 def infineon_get_use_case_id(data):
     from apps.classif_ai.models import UseCase
 
@@ -52,6 +65,7 @@ def infineon_get_use_case_id(data):
         return use_case.id
 
 
+@register_tenant_hook("infineon", "populate_meta_info")
 def infineon_populate_meta_info(data):
     infineon_separator = "_"
     file_name = data["files"][0]["name"]
@@ -148,6 +162,7 @@ class JSONBSet(models.Func):
     output_field = models.CharField()
 
 
+@register_tenant_hook("infineon", "header_xml_to_dict")
 def infineon_header_xml_to_dict(meta_file_path, subscription_id):
     try:
         xmldoc = minidom.parseString(meta_file_path)
@@ -173,6 +188,7 @@ def infineon_header_xml_to_dict(meta_file_path, subscription_id):
     return meta_info
 
 
+@register_tenant_hook("infineon", "yield_xml_to_dict")
 def infineon_yield_xml_to_dict(meta_file_path, subscription_id):
     try:
         xmldoc = minidom.parseString(meta_file_path)
@@ -202,6 +218,7 @@ def build_query(filters):
     return query
 
 
+@register_tenant_hook("infineon", "get_default_model_for_file_set")
 def infineon_get_default_model_for_file_set(file_set):
     from apps.classif_ai.models import MlModel
 
@@ -215,8 +232,7 @@ def infineon_get_default_model_for_file_set(file_set):
 
 
 def get_default_model_for_file_set(file_set):
-    helpers_module = importlib.import_module("apps.classif_ai.helpers")
-    return getattr(helpers_module, connection.tenant.schema_name + "_get_default_model_for_file_set")(file_set)
+    return require_tenant_hook("get_default_model_for_file_set")(file_set)
 
 
 # def get_callable_from_string(name):
@@ -266,6 +282,15 @@ def convert_datetime_to_str(time_val, time_format=None):
     return time_str
 
 
+def get_time_function(time_format=None):
+    """returns the Trunc function the "daily" / "weekly" / "monthly" time format of the charts groups on"""
+    if time_format == "monthly":
+        return TruncMonth
+    elif time_format == "weekly":
+        return TruncWeek
+    return TruncDay
+
+
 def ingest_training_data_inferences_from_json_file(ml_model_id: int, inference_outputs: dict) -> None:
     from apps.classif_ai.models import File, TrainingSessionFileSet, FileSetInferenceQueue
     from apps.classif_ai.serializers import FileRegionSerializer
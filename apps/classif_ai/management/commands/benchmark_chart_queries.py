@@ -0,0 +1,268 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+from django.utils import timezone
+
+from apps.classif_ai.benchmark_data import benchmark_transaction, insert_synthetic_file_sets
+from apps.classif_ai.helpers import convert_datetime_to_str, get_time_function
+from apps.classif_ai.models import Defect, FileRegion, JsonKeys
+from apps.classif_ai.services import AnalysisService
+
+
+def legacy_yield_loss_trend(analysis_service, defect_id_map, imp_defects, time_format):
+    """[the yield loss trend as it used to be computed: raw rows grouped in python]"""
+    time_function = get_time_function(time_format)
+    defective_file_sets = list(
+        analysis_service.file_sets()
+        .filter(
+            files__file_regions__defects__has_any_keys=imp_defects,
+            meta_info__lot_id__isnull=False,
+            meta_info__InitialTotal__isnull=False,
+            meta_info__has_keys=["InitialTotal", "lot_id"],
+            files__file_regions__is_user_feedback=False,
+        )
+        .values("id")
+        .annotate(defect=JsonKeys("files__file_regions__defects"))
+        .distinct()
+        .annotate(time_val=time_function("created_ts"))
+    )
+    distinct_initial_total = (
+        analysis_service.file_sets()
+        .filter(
+            file_set_inference_queues__status="FINISHED",
+            meta_info__InitialTotal__isnull=False,
+            meta_info__has_keys=["InitialTotal"],
+        )
+        .values("meta_info__lot_id", "meta_info__InitialTotal")
+        .distinct()
+        .annotate(time_val=time_function("created_ts"))
+    )
+    time_val_initial_total = {}
+    for obj in distinct_initial_total:
+        time_val_initial_total.setdefault(obj["time_val"], 0)
+        time_val_initial_total[obj["time_val"]] += int(obj["meta_info__InitialTotal"])
+    defect_time_val_file_sets = {}
+    for obj in defective_file_sets:
+        defect_id = int(obj["defect"])
+        if defect_id in defect_id_map:
+            defect_time_val_file_sets.setdefault(defect_id, {}).setdefault(obj["time_val"], []).append(obj["id"])
+    response = {}
+    for defect_id, time_vals in defect_time_val_file_sets.items():
+        response[defect_id] = {"name": defect_id_map[defect_id]}
+        for time_val, file_set_ids in time_vals.items():
+            num = len(file_set_ids)
+            den = time_val_initial_total[time_val]
+            response[defect_id][convert_datetime_to_str(time_val, time_format)] = {
+                "percentage": round(num * 100 / den, 2),
+                "ai_reject_count": num,
+                "total_unit_count": den,
+            }
+    return response
+
+
+def legacy_overkill_trend(analysis_service, include_defects, time_format):
+    """[the overkill charts as they used to be computed: raw rows grouped in python]"""
+    time_function = get_time_function(time_format)
+    file_sets = (
+        analysis_service.file_sets()
+        .filter(
+            Q(files__file_regions__defects__has_any_keys=include_defects, files__file_regions__is_user_feedback=False)
+            | Q(files__file_regions__isnull=True)
+        )
+        .values("id", "meta_info__lot_id")
+        .distinct()
+        .annotate(time_val=time_function("created_ts"))
+    )
+    distinct_meta_info = (
+        analysis_service.file_sets()
+        .filter(file_set_inference_queues__status="FINISHED")
+        .values("meta_info__lot_id", "meta_info__InitialTotal", "meta_info__MachineNo")
+        .distinct()
+        .annotate(time_val=time_function("created_ts"))
+    )
+    meta_info_grouped_by_time_val = {}
+    for meta_info in distinct_meta_info:
+        lots = meta_info_grouped_by_time_val.setdefault(meta_info["time_val"], {})
+        lots.setdefault(
+            meta_info["meta_info__lot_id"], (meta_info["meta_info__InitialTotal"], meta_info["meta_info__MachineNo"])
+        )
+    file_set_id_grouped_by_time_val = {}
+    for file_set in file_sets:
+        file_set_id_grouped_by_time_val.setdefault(file_set["time_val"], {}).setdefault(
+            file_set["meta_info__lot_id"], []
+        ).append(file_set["id"])
+    overkill_scatter_plot = {}
+    overkill_trend = {}
+    machine_initial_total_count = {}
+    for time_val, lots in meta_info_grouped_by_time_val.items():
+        time_str = convert_datetime_to_str(time_val, time_format)
+        scatter_result = []
+        trend_result = {}
+        for lot_id, (initial_total, machine_no) in lots.items():
+            if not lot_id or not initial_total:
+                continue
+            count = len(file_set_id_grouped_by_time_val.get(time_val, {}).get(lot_id, []))
+            scatter_result.append(
+                {
+                    "machine_no": machine_no,
+                    "lot_id": lot_id,
+                    "percentage": round(count * 100 / int(initial_total), 2),
+                    "over_reject_count": count,
+                    "total_unit_count": int(initial_total),
+                }
+            )
+            for totals in (trend_result, machine_initial_total_count):
+                total_and_count = totals.setdefault(machine_no, [0, 0])
+                total_and_count[0] += count
+                total_and_count[1] += int(initial_total)
+        if not scatter_result:
+            continue
+        overkill_scatter_plot[time_str] = scatter_result
+        overkill_trend[time_str] = {"date_range": time_str}
+        for machine_no, (count, total) in trend_result.items():
+            overkill_trend[time_str][machine_no] = {
+                "total_unit_count": total,
+                "over_reject_count": count,
+                "percentage": round(count * 100 / total, 2),
+            }
+    machine_wise_overkill_rate = {}
+    for machine_no, (count, total) in machine_initial_total_count.items():
+        machine_wise_overkill_rate[machine_no] = {
+            "percentage": round(100 * count / total, 2),
+            "over_reject_count": count,
+            "total_unit_count": total,
+        }
+    return {
+        "overkill_scatter": overkill_scatter_plot,
+        "overkill_trend": list(overkill_trend.values()),
+        "machine_wise_overkill_rate": machine_wise_overkill_rate,
+    }
+
+
+def comparable_overkill_trend(overkill_trend):
+    """[the overkill charts with their lots and buckets sorted, the order sql and python group them in differs]"""
+    return {
+        "overkill_scatter": {
+            time_str: sorted(lots, key=lambda lot: (str(lot["machine_no"]), str(lot["lot_id"])))
+            for time_str, lots in overkill_trend["overkill_scatter"].items()
+        },
+        "overkill_trend": sorted(overkill_trend["overkill_trend"], key=lambda bucket: bucket["date_range"]),
+        "machine_wise_overkill_rate": overkill_trend["machine_wise_overkill_rate"],
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        "Generates a synthetic dataset inside a transaction that is rolled back, and times the yield loss / overkill "
+        "charts computed with grouped sql against the legacy python grouping"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--subscription-id", dest="subscription_id", type=int, required=True)
+        parser.add_argument("--ml-model-id", dest="ml_model_id", type=int, required=True)
+        parser.add_argument("--files", dest="files", type=int, default=1000000, help="Number of files to generate")
+        parser.add_argument("--days", dest="days", type=int, default=90, help="Number of days the files span")
+        parser.add_argument("--lot-size", dest="lot_size", type=int, default=500, help="Files per lot")
+        parser.add_argument("--machines", dest="machines", type=int, default=8, help="Number of machines")
+        parser.add_argument(
+            "--defect-rate", dest="defect_rate", type=float, default=0.3, help="Share of files with an ai region"
+        )
+        parser.add_argument("--time-format", dest="time_format", default="daily", help="daily, weekly or monthly")
+        parser.add_argument(
+            "--keep", dest="keep", action="store_true", default=False, help="Commit the generated data"
+        )
+
+    def handle(self, **options):
+        defect_ids = list(Defect.objects.filter(ml_models=options["ml_model_id"]).values_list("id", flat=True))
+        if not defect_ids:
+            raise CommandError("The ml model doesn't have any defects")
+        with benchmark_transaction(options["keep"]):
+            seconds = self.generate(options, defect_ids)
+            self.stdout.write(f"Generated {options['files']} files in {seconds:.1f}s")
+
+            file_set_filters = {
+                "subscription_id__in": [options["subscription_id"]],
+                "created_ts__gte": timezone.now() - timedelta(days=options["days"]),
+                "created_ts__lte": timezone.now(),
+            }
+            ml_model_filters = {"id__in": [options["ml_model_id"]]}
+            defect_id_map = dict(Defect.objects.filter(id__in=defect_ids).values_list("id", "name"))
+            include_defects = [str(defect_id) for defect_id in defect_ids[: len(defect_ids) // 2]]
+            exclude_defects = [defect_id for defect_id in defect_ids[len(defect_ids) // 2 :]]
+            time_format = options["time_format"]
+
+            def yield_loss_sql():
+                return AnalysisService(file_set_filters, ml_model_filters).yield_loss_trend_grouped_by_defect(
+                    defect_id_map, defect_ids, time_format
+                )
+
+            def yield_loss_legacy():
+                return legacy_yield_loss_trend(
+                    AnalysisService(file_set_filters, ml_model_filters), defect_id_map, defect_ids, time_format
+                )
+
+            def overkill_sql():
+                return AnalysisService(file_set_filters, ml_model_filters).overkill_trend(
+                    include_defects, exclude_defects, time_format
+                )
+
+            def overkill_legacy():
+                return legacy_overkill_trend(
+                    AnalysisService(file_set_filters, ml_model_filters), include_defects, time_format
+                )
+
+            for name, legacy, grouped_sql, comparable in [
+                ("yield_loss_trend_grouped_by_defect", yield_loss_legacy, yield_loss_sql, lambda result: result),
+                ("overkill_trend", overkill_legacy, overkill_sql, comparable_overkill_trend),
+            ]:
+                results = []
+                for implementation, function in [("legacy", legacy), ("sql", grouped_sql)]:
+                    started_at = time.perf_counter()
+                    results.append(function())
+                    self.stdout.write(f"{name} ({implementation}): {time.perf_counter() - started_at:.2f}s")
+                if comparable(results[0]) != comparable(results[1]):
+                    raise CommandError(f"{name} of the sql query differs from the legacy one")
+
+    @staticmethod
+    def generate(options, defect_ids):
+        """[inserts file sets (one file each, grouped in lots per day and machine), their finished inference queues
+        and ai regions with a single defect for --defect-rate of the files]"""
+        meta_info = """
+            jsonb_build_object(
+                'lot_id', 'BENCH-' || (i %% %(days)s) || '-' || (i / (%(days)s * %(lot_size)s)),
+                'InitialTotal', %(lot_size)s,
+                'MachineNo', 'M' || ((i / (%(days)s * %(lot_size)s)) %% %(machines)s)
+            )
+        """
+        sql = """
+            insert into {file_region_table} (
+                created_ts, updated_ts, file_id, ml_model_id, defects, region, is_user_feedback, is_removed,
+                model_output_meta_info
+            )
+            select
+                created_ts,
+                created_ts,
+                id,
+                %(ml_model_id)s,
+                jsonb_build_object(
+                    (%(defect_ids)s::int[])[1 + id %% cardinality(%(defect_ids)s::int[])]::text,
+                    jsonb_build_object('confidence', 0.9)
+                ),
+                '{{"type": "box", "coordinates": {{"x": 0.1, "y": 0.1, "w": 0.2, "h": 0.2}}}}'::jsonb,
+                false,
+                false,
+                '{{}}'::jsonb
+            from files
+            where random() < %(defect_rate)s
+        """.format(
+            file_region_table=FileRegion._meta.db_table
+        )
+        params = {
+            "lot_size": options["lot_size"],
+            "machines": options["machines"],
+            "defect_ids": defect_ids,
+            "defect_rate": options["defect_rate"],
+        }
+        return insert_synthetic_file_sets(options, sql, params, [FileRegion], meta_info=meta_info)
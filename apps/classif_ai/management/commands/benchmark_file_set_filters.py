@@ -0,0 +1,236 @@
+import json
+from types import SimpleNamespace
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.http import QueryDict
+
+from apps.classif_ai.benchmark_data import benchmark_transaction, insert_synthetic_file_sets
+from apps.classif_ai.filters import FileSetFilterSet
+from apps.classif_ai.models import (
+    Defect,
+    FileSet,
+    GTClassification,
+    GTClassificationDefect,
+    ModelClassification,
+    ModelClassificationDefect,
+    TrainingSession,
+    TrainingSessionFileSet,
+)
+
+### how is the benefit of an index measured?
+# A synthetic dataset is generated inside a transaction that is rolled back. Every file set filter is run with
+# EXPLAIN ANALYZE with all the indexes, then again with each of the INDEXES dropped inside a savepoint that is rolled
+# back, so the tables are never left without them. An index is worth keeping if the filters it's used by are slower
+# without it. DROP INDEX locks the table until the savepoint is rolled back, run it against a database nobody uses.
+
+INDEXES = [
+    "fsiq_file_set_model_status_idx",
+    "tsfs_session_type_fs_idx",
+    "gt_cls_defect_defect_idx",
+    "model_cls_model_file_idx",
+    "model_cls_defect_defect_idx",
+]
+
+
+def index_names(plan):
+    """[returns the names of the indexes scanned anywhere in the json plan]"""
+    names = set()
+    if isinstance(plan, dict):
+        if "Index Name" in plan:
+            names.add(plan["Index Name"])
+        for value in plan.values():
+            names |= index_names(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            names |= index_names(value)
+    return names
+
+
+class Command(BaseCommand):
+    help = (
+        "Generates a synthetic dataset inside a transaction that is rolled back, and measures with EXPLAIN ANALYZE "
+        "how much slower each file set filter gets without each of the file set filter indexes"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--subscription-id", dest="subscription_id", type=int, required=True)
+        parser.add_argument("--ml-model-id", dest="ml_model_id", type=int, required=True)
+        parser.add_argument("--files", dest="files", type=int, default=200000, help="Number of files to generate")
+        parser.add_argument("--days", dest="days", type=int, default=90, help="Number of days the files span")
+        parser.add_argument(
+            "--gt-rate", dest="gt_rate", type=float, default=0.3, help="Share of files with a gt classification"
+        )
+        parser.add_argument(
+            "--accuracy", dest="accuracy", type=float, default=0.8, help="Share of gt defects matching the model's"
+        )
+        parser.add_argument("--repeat", dest="repeat", type=int, default=3, help="Runs per query, the fastest counts")
+        parser.add_argument(
+            "--keep", dest="keep", action="store_true", default=False, help="Commit the generated data"
+        )
+
+    def handle(self, **options):
+        defect_ids = list(Defect.objects.filter(ml_models=options["ml_model_id"]).values_list("id", flat=True))
+        if not defect_ids:
+            raise CommandError("The ml model doesn't have any defects")
+        training_session_id = (
+            TrainingSession.objects.filter(new_ml_model_id=options["ml_model_id"]).values_list("id", flat=True).first()
+        )
+        with benchmark_transaction(options["keep"]):
+            seconds = self.generate(options, defect_ids, training_session_id)
+            self.stdout.write(f"Generated {options['files']} files in {seconds:.1f}s")
+
+            querysets = self.querysets(options, defect_ids[0], training_session_id is not None)
+            indexes = [index for index in INDEXES if self.index_exists(index)]
+            for index in sorted(set(INDEXES) - set(indexes)):
+                self.stderr.write(f"{index} doesn't exist, it's left out")
+
+            baseline = {}
+            for name, queryset in querysets.items():
+                baseline[name] = self.explain(queryset, options["repeat"])
+                self.stdout.write(
+                    f"{name}: {baseline[name]['ms']:.1f}ms using {', '.join(sorted(baseline[name]['indexes']))}"
+                )
+            for index in indexes:
+                savepoint = transaction.savepoint()
+                with connection.cursor() as cursor:
+                    cursor.execute(f"drop index {connection.ops.quote_name(index)}")
+                results = {}
+                for name, queryset in querysets.items():
+                    if index in baseline[name]["indexes"]:
+                        results[name] = {
+                            "with_ms": round(baseline[name]["ms"], 1),
+                            "without_ms": round(self.explain(queryset, options["repeat"])["ms"], 1),
+                        }
+                transaction.savepoint_rollback(savepoint)
+                self.stdout.write(json.dumps({"index": index, "used_by": results}))
+
+    @staticmethod
+    def querysets(options, defect_id, has_training_session):
+        """[the file set ids of each benchmarked filter, filtered the way the file set views filter them]"""
+        ml_model_id = str(options["ml_model_id"])
+        filters = {
+            "ml_model_id__in": {"ml_model_id__in": ml_model_id},
+            "ai_predicted_label__in": {"ml_model_id__in": ml_model_id, "ai_predicted_label__in": str(defect_id)},
+            "ground_truth_label__in": {"ground_truth_label__in": str(defect_id)},
+            "is_confident_defect": {"ml_model_id__in": ml_model_id, "is_confident_defect": "true"},
+            "is_audited": {"ml_model_id__in": ml_model_id, "is_audited": "true"},
+            "is_accurate": {"ml_model_id__in": ml_model_id, "is_accurate": "true"},
+        }
+        if has_training_session:
+            filters["train_type__in"] = {"train_type__in": "TRAIN", "training_ml_model__in": ml_model_id}
+        querysets = {}
+        for name, params in filters.items():
+            query_params = QueryDict(mutable=True)
+            query_params.update({"subscription_id__in": str(options["subscription_id"]), **params})
+            file_set_filter = FileSetFilterSet(
+                query_params, queryset=FileSet.objects.all(), request=SimpleNamespace(query_params=query_params)
+            )
+            querysets[name] = file_set_filter.qs.values("id").distinct()
+        return querysets
+
+    @staticmethod
+    def index_exists(index):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "select 1 from pg_indexes where schemaname = current_schema() and indexname = %s", [index]
+            )
+            return cursor.fetchone() is not None
+
+    @staticmethod
+    def explain(queryset, repeat):
+        """[the fastest execution time of the query in ms and the indexes its plan uses]"""
+        sql, params = queryset.query.sql_with_params()
+        execution_times = []
+        indexes = set()
+        with connection.cursor() as cursor:
+            for _ in range(repeat):
+                cursor.execute("explain (analyze, buffers, format json) " + sql, params)
+                plan = cursor.fetchone()[0]
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                execution_times.append(plan[0]["Execution Time"])
+                indexes |= index_names(plan)
+        return {"ms": min(execution_times), "indexes": indexes}
+
+    @staticmethod
+    def generate(options, defect_ids, training_session_id):
+        """[inserts file sets with a finished inference queue and a single file each, a model classification with a
+        single defect for every file and a gt classification for --gt-rate of them, matching the model's defect for
+        --accuracy of those. The file sets are split between the train types of the ml model's training session]"""
+        sql = """
+            , training_file_sets as (
+                insert into {training_file_set_table} (
+                    created_ts, updated_ts, file_set_id, training_session_id, defects, dataset_train_type,
+                    belongs_to_old_model_training_data
+                )
+                select
+                    created_ts,
+                    created_ts,
+                    id,
+                    %(training_session_id)s::int,
+                    '{{}}'::jsonb,
+                    (array['TRAIN', 'TEST', 'VALIDATION'])[1 + id %% 3],
+                    false
+                from file_sets
+                where %(training_session_id)s::int is not null
+            ),
+            model_classifications as (
+                insert into {model_classification_table} (created_ts, updated_ts, file_id, ml_model_id, is_no_defect)
+                select created_ts, created_ts, id, %(ml_model_id)s, false from files
+                returning id, file_id, created_ts
+            ),
+            model_classification_defects as (
+                insert into {model_classification_defect_table} (
+                    created_ts, updated_ts, classification_id, defect_id, confidence
+                )
+                select
+                    created_ts,
+                    created_ts,
+                    id,
+                    (%(defect_ids)s::int[])[1 + file_id %% cardinality(%(defect_ids)s::int[])],
+                    round(random()::numeric, 6)
+                from model_classifications
+            ),
+            gt_classifications as (
+                insert into {gt_classification_table} (created_ts, updated_ts, file_id, is_no_defect)
+                select created_ts, created_ts, id, false from files
+                where random() < %(gt_rate)s
+                returning id, file_id, created_ts
+            )
+            insert into {gt_classification_defect_table} (created_ts, updated_ts, classification_id, defect_id)
+            select
+                created_ts,
+                created_ts,
+                id,
+                case
+                    when random() < %(accuracy)s
+                    then (%(defect_ids)s::int[])[1 + file_id %% cardinality(%(defect_ids)s::int[])]
+                    else (%(defect_ids)s::int[])[1 + (file_id + 1) %% cardinality(%(defect_ids)s::int[])]
+                end
+            from gt_classifications
+        """.format(
+            training_file_set_table=TrainingSessionFileSet._meta.db_table,
+            model_classification_table=ModelClassification._meta.db_table,
+            model_classification_defect_table=ModelClassificationDefect._meta.db_table,
+            gt_classification_table=GTClassification._meta.db_table,
+            gt_classification_defect_table=GTClassificationDefect._meta.db_table,
+        )
+        params = {
+            "training_session_id": training_session_id,
+            "defect_ids": defect_ids,
+            "gt_rate": options["gt_rate"],
+            "accuracy": options["accuracy"],
+        }
+        return insert_synthetic_file_sets(
+            options,
+            sql,
+            params,
+            [
+                TrainingSessionFileSet,
+                ModelClassification,
+                ModelClassificationDefect,
+                GTClassification,
+                GTClassificationDefect,
+            ],
+        )
@@ -1,64 +1,227 @@
+import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 
-from django.core.management.base import BaseCommand
+from boto3.s3.transfer import TransferConfig
+from django.core.management.base import BaseCommand, CommandError
 from django.db import transaction
 
-from apps.classif_ai.models import FileSet, File, UploadSession
-from apps.classif_ai.serializers import FileSetInferenceQueueSerializer
+from apps.classif_ai.models import File, FileSet, FileSetInferenceQueue, UploadSession
 from common.services import S3Service
+from sixsense import settings
+
+### how does the ingestion resume?
+# Every file of the folder becomes a file set with a single file. The files are ingested in batches: the images of a
+# batch are uploaded in parallel, the file sets / files of the uploaded ones are inserted in one transaction and their
+# names are appended to the checkpoint. The first line of the checkpoint holds the upload session and the options it
+# was started with, running the command again with the same checkpoint and options continues that upload session and
+# skips the files it already has.
+
+PROMPTS = {
+    "subscription_id": "Please enter the subscription_id: ",
+    "use_case_id": "Please enter the use_case_id: ",
+    "folder_path": "Please enter the folder_path: ",
+    "ui_folder_name": "Please enter the ui_folder_name: ",
+    "ml_model_id": "Please enter the model id using which inference needs to be performed. "
+    "Click enter if inference is not needed: ",
+    "output_file_path": "Please enter the output file path: ",
+}
+INT_OPTIONS = {"subscription_id", "use_case_id", "ml_model_id"}
+REQUIRED_OPTIONS = ["subscription_id", "use_case_id", "folder_path", "ui_folder_name"]
+# options of the upload session, a checkpoint is only resumed with the ones it was started with
+CHECKPOINT_OPTIONS = ["folder_path", "subscription_id", "use_case_id", "ui_folder_name"]
+
+
+class Checkpoint:
+    """[append only record of the upload session, the options it was started with and the names of the files
+    ingested in it]"""
+
+    def __init__(self, path):
+        self.path = path
+        self.header = {}
+        self.file_names = set()
+        if os.path.exists(path):
+            with open(path, "r") as file:
+                lines = file.read().splitlines()
+            if lines:
+                self.header = json.loads(lines[0])
+                for line in lines[1:]:
+                    try:
+                        self.file_names.add(json.loads(line))
+                    except ValueError:
+                        # the last line is incomplete if the command was killed while writing it
+                        pass
+
+    @property
+    def upload_session_id(self):
+        return self.header.get("upload_session_id")
+
+    def start(self, upload_session_id, options):
+        self.header = {"upload_session_id": upload_session_id, **options}
+        self._append([self.header])
+
+    def mismatches(self, options):
+        """[returns {option: checkpoint value} of the options the checkpoint was started with a different value of]"""
+        return {
+            option: self.header[option]
+            for option, value in options.items()
+            if option in self.header and self.header[option] != value
+        }
+
+    def add(self, file_names):
+        self.file_names.update(file_names)
+        self._append(file_names)
+
+    def _append(self, values):
+        with open(self.path, "a") as file:
+            file.writelines(json.dumps(value) + "\n" for value in values)
+            file.flush()
+            os.fsync(file.fileno())
 
 
 class Command(BaseCommand):
-    def ingest_fileset(self, subscription_id, use_case_id, upload_session_id, file_paths, ml_model_id=None):
-        with transaction.atomic():
-            file_set = FileSet.objects.create(
-                upload_session_id=upload_session_id, subscription_id=subscription_id, use_case_id=use_case_id
-            )
-            for file_path in file_paths:
-                file = File(name=os.path.basename(file_path), file_set=file_set)
-                file.save()
-                s3_service = S3Service()
-                s3_service.upload_file(file_path, file.path)
-            if ml_model_id:
-                inference_queue_serializer = FileSetInferenceQueueSerializer(
-                    data={"file_set": file_set.id, "ml_model": ml_model_id}
-                )
-                inference_queue_serializer.is_valid(raise_exception=True)
-                inference_queue_serializer.save()
+    help = (
+        "Ingests every file of a folder as a file set of a new upload session, the images are uploaded to S3 in "
+        "parallel and the rows are inserted in batches. Progress is kept in a checkpoint file, running the command "
+        "again with the same checkpoint resumes the ingestion."
+    )
 
-    def create_upload_session(self, subscription_id, use_case_id, name):
-        return UploadSession.objects.create(subscription_id=subscription_id, use_case_id=use_case_id, name=name)
+    def add_arguments(self, parser):
+        parser.add_argument("--subscription-id", dest="subscription_id", type=int)
+        parser.add_argument("--use-case-id", dest="use_case_id", type=int)
+        parser.add_argument("--folder-path", dest="folder_path")
+        parser.add_argument("--ui-folder-name", dest="ui_folder_name", help="Name of the upload session")
+        parser.add_argument("--ml-model-id", dest="ml_model_id", type=int, help="Model the file sets are inferred with")
+        parser.add_argument("--output-file-path", dest="output_file_path", help="File the report is appended to")
+        parser.add_argument(
+            "--checkpoint",
+            dest="checkpoint",
+            help="Checkpoint file, defaults to <folder_path>.ingest-checkpoint next to the folder",
+        )
+        parser.add_argument("--batch-size", dest="batch_size", type=int, default=500)
+        parser.add_argument(
+            "--workers", dest="workers", type=int, default=16, help="Number of images uploaded in parallel"
+        )
+        parser.add_argument(
+            "--noinput",
+            "--no-input",
+            action="store_false",
+            dest="interactive",
+            help="Don't prompt for the missing options",
+        )
 
     def handle(self, **options):
-        subscription_id = int(input("Please enter the subscription_id: "))
-        use_case_id = int(input("Please enter the use_case_id: "))
-        folder_path = input("Please enter the folder_path: ")
-        ui_folder_name = input("Please enter the ui_folder_name: ")
-        ml_model_id = input(
-            "Please enter the model id using which inference needs to be performed. Click enter if inference is not needed: "
-        )
-        output_file_path = input("Please enter the output file path: ")
-        if ml_model_id:
-            ml_model_id = int(ml_model_id)
+        for option, prompt in PROMPTS.items():
+            if options[option] is None and options["interactive"]:
+                value = input(prompt)
+                if value:
+                    options[option] = int(value) if option in INT_OPTIONS else value
+        missing = [option for option in REQUIRED_OPTIONS if options[option] is None]
+        if missing:
+            raise CommandError(f"Missing option(s): {', '.join(missing)}")
+        folder_path = os.path.abspath(options["folder_path"])
+        checkpoint = Checkpoint(options["checkpoint"] or folder_path.rstrip(os.sep) + ".ingest-checkpoint")
+        checkpoint_options = {option: options[option] for option in CHECKPOINT_OPTIONS}
+        checkpoint_options["folder_path"] = folder_path
+
+        if checkpoint.upload_session_id is None:
+            upload_session = UploadSession.objects.create(
+                subscription_id=options["subscription_id"],
+                use_case_id=options["use_case_id"],
+                name=options["ui_folder_name"],
+            )
+            checkpoint.start(upload_session.id, checkpoint_options)
         else:
-            ml_model_id = None
-        file_count = 0
-        success_file_paths = []
-        failed_file_paths = []
-        upload_session = self.create_upload_session(subscription_id, use_case_id, ui_folder_name)
-        for filename in os.listdir(folder_path):
-            try:
-                self.ingest_fileset(
-                    subscription_id, use_case_id, upload_session.id, [os.path.join(folder_path, filename)], ml_model_id
+            mismatches = checkpoint.mismatches(checkpoint_options)
+            if mismatches:
+                raise CommandError(
+                    f"The checkpoint {checkpoint.path} was started with "
+                    + ", ".join(f"{option}={value!r}" for option, value in mismatches.items())
                 )
-                file_count += 1
-                print(file_count)
-                success_file_paths.append(filename)
-            except:
-                failed_file_paths.append(filename)
-        f = open(output_file_path, "a")
-        f.write("successful file names:")
-        f.write(str(success_file_paths))
-        f.write("failed file names:")
-        f.write(str(failed_file_paths))
-        f.close()
+            upload_session = UploadSession.objects.get(id=checkpoint.upload_session_id)
+            self.stdout.write(f"Resuming upload session {upload_session.id}")
+        # files committed right before a crash may be missing from the checkpoint, but not from the upload session
+        ingested = checkpoint.file_names | set(
+            File.objects.filter(file_set__upload_session=upload_session).values_list("name", flat=True)
+        )
+        file_names = sorted(
+            entry.name for entry in os.scandir(folder_path) if entry.is_file() and entry.name not in ingested
+        )
+        self.stdout.write(f"{len(ingested)} files already ingested, {len(file_names)} to go")
+
+        s3_client = S3Service().s3_client
+        # the files are uploaded in parallel, a single file doesn't need the transfer threads of its own
+        transfer_config = TransferConfig(use_threads=False)
+        success_file_names = []
+        failed_file_names = []
+        with ThreadPoolExecutor(max_workers=options["workers"]) as executor:
+            for start in range(0, len(file_names), options["batch_size"]):
+                batch = file_names[start : start + options["batch_size"]]
+                uploaded, failed = self.upload_files(executor, s3_client, transfer_config, folder_path, batch)
+                self.insert_file_sets(upload_session, uploaded, options["ml_model_id"])
+                checkpoint.add(list(uploaded))
+                success_file_names.extend(uploaded.keys())
+                failed_file_names.extend(failed)
+                self.stdout.write(
+                    f"{len(success_file_names)} / {len(file_names)} ingested, {len(failed_file_names)} failed"
+                )
+
+        if options["output_file_path"]:
+            with open(options["output_file_path"], "a") as f:
+                f.write("successful file names:")
+                f.write(str(success_file_names))
+                f.write("failed file names:")
+                f.write(str(failed_file_names))
+
+    def upload_files(self, executor, s3_client, transfer_config, folder_path, file_names):
+        """[uploads the files in parallel, returns ({name: path} of the uploaded ones, names of the failed ones)]"""
+        # the paths are built here, connection is thread local and the workers don't have the tenant set
+        paths = {file_name: File.default_path(file_name) for file_name in file_names}
+        futures = {
+            file_name: executor.submit(
+                s3_client.upload_file,
+                os.path.join(folder_path, file_name),
+                settings.AWS_STORAGE_BUCKET_NAME,
+                path,
+                Config=transfer_config,
+            )
+            for file_name, path in paths.items()
+        }
+        uploaded = {}
+        failed = []
+        for file_name, future in futures.items():
+            try:
+                future.result()
+                uploaded[file_name] = paths[file_name]
+            except Exception as e:
+                self.stderr.write(f"{file_name}: {e}")
+                failed.append(file_name)
+        return uploaded, failed
+
+    @staticmethod
+    def insert_file_sets(upload_session, paths, ml_model_id=None):
+        """[inserts a file set with a single file for each of the uploaded files]"""
+        if not paths:
+            return
+        with transaction.atomic():
+            # bulk_create skips FileSet.save, the fields it sets from the upload session are set here
+            file_sets = FileSet.objects.bulk_create(
+                [
+                    FileSet(
+                        upload_session_id=upload_session.id,
+                        subscription_id=upload_session.subscription_id,
+                        use_case_id=upload_session.use_case_id,
+                    )
+                    for _ in paths
+                ]
+            )
+            File.objects.bulk_create(
+                [
+                    File(file_set=file_set, name=file_name, path=path)
+                    for file_set, (file_name, path) in zip(file_sets, paths.items())
+                ]
+            )
+            if ml_model_id:
+                for file_set in file_sets:
+                    # saved one by one, saving a queue is what triggers the inference
+                    FileSetInferenceQueue.objects.create(file_set=file_set, ml_model_id=ml_model_id)
@@ -0,0 +1,19 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand
+
+from apps.classif_ai.service.metric_rollup_service import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the daily classification metric rollups of the tenant"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--date-gte", dest="date_gte", default=None, help="Only rebuild the days from this date (YYYY-MM-DD)"
+        )
+
+    def handle(self, **options):
+        date_gte = date.fromisoformat(options["date_gte"]) if options["date_gte"] else None
+        rebuild_rollups(date_gte)
+        self.stdout.write(self.style.SUCCESS("Rebuilt the classification metric rollups"))
@@ -0,0 +1,64 @@
+import argparse
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.classif_ai.tenant_runner import get_tenant_schema_names, run_command_for_tenants
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs a management command for every tenant, the tenants are run in parallel in a bounded process pool or as "
+        "celery tasks. e.g. run_for_all_tenants --concurrency 8 notification_every_x_hours"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("command_name")
+        parser.add_argument("command_args", nargs=argparse.REMAINDER, help="Arguments passed to the command")
+        parser.add_argument(
+            "--concurrency", dest="concurrency", type=int, default=4, help="Number of tenants run at a time"
+        )
+        parser.add_argument(
+            "--schemas", dest="schemas", default=None, help="Comma separated schema names, all the tenants by default"
+        )
+        parser.add_argument(
+            "--celery",
+            action="store_true",
+            dest="use_celery",
+            help="Run the tenants as celery tasks instead of in processes forked from this one",
+        )
+
+    def handle(self, **options):
+        if options["concurrency"] < 1:
+            raise CommandError("--concurrency must be at least 1")
+        schemas = options["schemas"].split(",") if options["schemas"] else None
+        schema_names = get_tenant_schema_names(schemas)
+        if not schema_names:
+            raise CommandError("No tenant to run the command for")
+
+        started_at = time.perf_counter()
+        failed = []
+        for result in run_command_for_tenants(
+            options["command_name"],
+            options["command_args"],
+            schema_names,
+            concurrency=options["concurrency"],
+            use_celery=options["use_celery"],
+        ):
+            if result["output"]:
+                self.stdout.write(f"[{result['schema']}] {result['output'].rstrip()}")
+            if result["error"]:
+                failed.append(result["schema"])
+                self.stderr.write(f"[{result['schema']}] failed after {result['seconds']}s: {result['error']}")
+            else:
+                self.stdout.write(f"[{result['schema']}] done in {result['seconds']}s")
+        summary = {
+            "command": options["command_name"],
+            "tenants": len(schema_names),
+            "failed": failed,
+            "seconds": round(time.perf_counter() - started_at, 3),
+        }
+        self.stdout.write(json.dumps(summary))
+        if failed:
+            raise CommandError(f"{options['command_name']} failed for {len(failed)} tenant(s): {', '.join(failed)}")
@@ -1,73 +1,221 @@
-from apps.classif_ai.tasks import perform_file_set_inference
-from django.db import connection, models, transaction
-from django.db.models import Q
-from django.core.paginator import Paginator
+import uuid
 
-from sixsense.settings import INFERENCE_METHOD
+from django.core.exceptions import EmptyResultSet
+from django.contrib.postgres.fields import ArrayField
+from django.db import connection, models, transaction
+from django.db.models import F, Func, Q, Value
+from django.db.models.functions import Cast
 
 
 class FileSetInferenceQueueManager(models.Manager):
     def partial_create(self, objs, batch_size=None, ignore_conflicts=False):
-        objs_grouped_by_ml_model = {}
-        for obj in objs:
-            if objs_grouped_by_ml_model.get(obj.ml_model_id, None) is None:
-                objs_grouped_by_ml_model[obj.ml_model_id] = []
-            objs_grouped_by_ml_model[obj.ml_model_id].append(obj)
+        """Creates the queue objects that aren't already queued (in a non FAILED state) for the same ml model and
+        file set, and hands them over to a background task that publishes them to the inference workers.
+
+        Returns the id of the dispatching task, or None if there was nothing to queue.
+        """
+        from apps.classif_ai.tasks import dispatch_file_set_inference
+
+        ml_model_ids = {obj.ml_model_id for obj in objs}
+        file_set_ids = {obj.file_set_id for obj in objs}
         with transaction.atomic():
-            for ml_model_id in objs_grouped_by_ml_model:
-                file_set_ids = [obj.file_set_id for obj in objs_grouped_by_ml_model[ml_model_id]]
-                result = self.filter(~Q(status="FAILED"), file_set_id__in=file_set_ids, ml_model_id=ml_model_id)
-                if result:
-                    for val in result:
-                        file_set_id = val.file_set_id
-                        for obj in objs_grouped_by_ml_model[ml_model_id]:
-                            if obj.file_set_id == file_set_id:
-                                objs_grouped_by_ml_model[ml_model_id].remove(obj)
-            objs = []
-            for val in objs_grouped_by_ml_model.values():
-                objs.extend(val)
-
-            super(FileSetInferenceQueueManager, self).bulk_create(objs, batch_size, ignore_conflicts)
+            already_queued = set(
+                self.filter(
+                    ~Q(status="FAILED"), ml_model_id__in=ml_model_ids, file_set_id__in=file_set_ids
+                ).values_list("ml_model_id", "file_set_id")
+            )
+            new_objs = []
             for obj in objs:
-                if INFERENCE_METHOD == "SAGEMAKER_ASYNC":
-                    # ToDo: When doing in bulk, this may be very slow and requests may time out
-                    from apps.classif_ai.services import InferenceService
-
-                    InferenceService(ml_model_id=obj.ml_model_id, file_set_id=obj.file_set_id).perform()
-                else:
-                    perform_file_set_inference.delay(
-                        file_set_id=obj.file_set_id, ml_model_id=obj.ml_model_id, schema=connection.schema_name
-                    )
+                key = (obj.ml_model_id, obj.file_set_id)
+                if key in already_queued:
+                    continue
+                already_queued.add(key)
+                new_objs.append(obj)
+            if not new_objs:
+                return None
+            created_objs = super(FileSetInferenceQueueManager, self).bulk_create(new_objs, batch_size, ignore_conflicts)
+            queue_ids = [obj.id for obj in created_objs if obj.id is not None]
+            task_id = str(uuid.uuid4())
+            schema = connection.schema_name
+            transaction.on_commit(
+                lambda: dispatch_file_set_inference.apply_async(
+                    args=[f"Dispatch inference of {len(queue_ids)} file sets", queue_ids],
+                    kwargs={"schema": schema},
+                    task_id=task_id,
+                )
+            )
+        return task_id
 
 
 class FileSetManager(models.Manager):
     def copy(self, input_data):
-        from apps.classif_ai.models import FileSet, File
+        """Copies the filtered file sets, along with their files, to the upload session. The copy runs server side:
+        new ids are drawn for the file sets into a mapping table, the file sets and the files are then inserted with
+        one INSERT ... SELECT each.
+
+        Returns the number of file sets and files copied.
+        """
+        from apps.classif_ai.models import FileSet, File, UploadSession
         from apps.classif_ai.filters import FileSetFilterSet
 
         with transaction.atomic():
             file_set_filter = FileSetFilterSet(input_data.get("file_set_filters"), queryset=FileSet.objects.all())
             skip_existing_images = input_data.get("skip_existing_images", False)
             upload_session_id = input_data.get("upload_session_id")
+            upload_session = UploadSession.objects.get(id=upload_session_id)
 
-            file_set_queryset = file_set_filter.qs.prefetch_related("files")
-
+            file_set_queryset = file_set_filter.qs
             if skip_existing_images:
                 existing_file_names = FileSet.objects.filter(upload_session_id=upload_session_id).values_list(
                     "files__name", flat=True
                 )
                 file_set_queryset = file_set_queryset.exclude(files__name__in=existing_file_names)
-            new_files = []
-            paginator = Paginator(file_set_queryset, 10000)
-            for page_number in paginator.page_range:
-                page = paginator.page(page_number)
-                for file_set in page.object_list:
-                    old_id = file_set.id
-                    file_set.id = None
-                    file_set.upload_session_id = upload_session_id
-                    file_set.save()
-                    for file in File.objects.filter(file_set_id=old_id):
-                        file.id = None
-                        file.file_set = file_set
-                        new_files.append(file)
-            File.objects.bulk_create(new_files, ignore_conflicts=True)
+
+            # FileSet.save validates the meta info against the subscription of the upload session, the file sets of
+            # the same subscription are already valid, the others are validated once per distinct meta info.
+            for meta_info in (
+                file_set_queryset.exclude(subscription_id=upload_session.subscription_id)
+                .values_list("meta_info", flat=True)
+                .distinct()
+            ):
+                FileSet(subscription_id=upload_session.subscription_id, meta_info=meta_info).clean()
+
+            if file_set_queryset.query.is_empty():
+                return {"file_sets": 0, "files": 0}
+            file_set_ids_sql, file_set_ids_params = file_set_queryset.values("id").query.sql_with_params()
+            file_set_table = connection.ops.quote_name(FileSet._meta.db_table)
+            file_table = connection.ops.quote_name(File._meta.db_table)
+            # columns set by the copy itself, every other column is copied as is
+            file_set_overrides = {
+                "created_ts": "now()",
+                "updated_ts": "now()",
+                "upload_session_id": "%s",
+                "use_case_id": "%s",
+                "subscription_id": "%s",
+            }
+            file_overrides = {"created_ts": "now()", "updated_ts": "now()", "file_set_id": "m.new_id"}
+            file_set_columns = [
+                connection.ops.quote_name(field.column)
+                for field in FileSet._meta.concrete_fields
+                if field.column not in file_set_overrides and not field.primary_key
+            ]
+            file_columns = [
+                connection.ops.quote_name(field.column)
+                for field in File._meta.concrete_fields
+                if field.column not in file_overrides and not field.primary_key
+            ]
+
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    """
+                    create temporary table file_set_copy_map on commit drop as
+                    select id as old_id, nextval(pg_get_serial_sequence(%s, 'id')) as new_id
+                    from {file_set_table}
+                    where id in ({file_set_ids_sql})
+                    """.format(
+                        file_set_table=file_set_table, file_set_ids_sql=file_set_ids_sql
+                    ),
+                    [file_set_table] + list(file_set_ids_params),
+                )
+                cursor.execute(
+                    """
+                    insert into {file_set_table} (id, {columns}, {override_columns})
+                    select m.new_id, {source_columns}, {override_values}
+                    from file_set_copy_map m inner join {file_set_table} fs on fs.id = m.old_id
+                    order by m.new_id
+                    """.format(
+                        file_set_table=file_set_table,
+                        columns=", ".join(file_set_columns),
+                        override_columns=", ".join(file_set_overrides.keys()),
+                        source_columns=", ".join(f"fs.{column}" for column in file_set_columns),
+                        override_values=", ".join(file_set_overrides.values()),
+                    ),
+                    [upload_session.id, upload_session.use_case_id, upload_session.subscription_id],
+                )
+                file_set_count = cursor.rowcount
+                cursor.execute(
+                    """
+                    insert into {file_table} ({columns}, {override_columns})
+                    select {source_columns}, {override_values}
+                    from file_set_copy_map m inner join {file_table} f on f.file_set_id = m.old_id
+                    order by f.id
+                    on conflict do nothing
+                    """.format(
+                        file_table=file_table,
+                        columns=", ".join(file_columns),
+                        override_columns=", ".join(file_overrides.keys()),
+                        source_columns=", ".join(f"f.{column}" for column in file_columns),
+                        override_values=", ".join(file_overrides.values()),
+                    )
+                )
+                file_count = cursor.rowcount
+                cursor.execute("drop table file_set_copy_map")
+        return {"file_sets": file_set_count, "files": file_count}
+
+
+class WaferMapTagManager(models.Manager):
+    def add_tags(self, wafer_queryset, tag_ids):
+        """Tags every wafer of the queryset with each of the tags in a single INSERT ... SELECT, the wafers already
+        having a tag are skipped.
+
+        Returns the number of tags added.
+        """
+        tag_ids = [int(tag_id) for tag_id in tag_ids]
+        try:
+            wafer_sql, params = wafer_queryset.order_by().values("id").query.sql_with_params()
+        except EmptyResultSet:
+            return 0
+        if not tag_ids:
+            return 0
+        sql = """
+            insert into {table} (wafer_id, tag_id)
+            select distinct wafer.id, tag.id
+            from ({wafer_sql}) wafer
+            cross join {tag_table} tag
+            where tag.id = any(%s)
+            on conflict (wafer_id, tag_id) do nothing
+        """.format(
+            table=connection.ops.quote_name(self.model._meta.db_table),
+            wafer_sql=wafer_sql,
+            tag_table=connection.ops.quote_name(self.model._meta.get_field("tag").related_model._meta.db_table),
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params + (tag_ids,))
+            return cursor.rowcount
+
+    def remove_tags(self, wafer_queryset, tag_ids=None):
+        """Removes the given tags, or all of them if tag_ids is None, from every wafer of the queryset with a single
+        DELETE.
+
+        Returns the number of tags removed.
+        """
+        queryset = self.filter(wafer__in=wafer_queryset.order_by().values("id"))
+        if tag_ids is not None:
+            queryset = queryset.filter(tag_id__in=tag_ids)
+        return queryset.delete()[0]
+
+
+class ModelClassificationDefectManager(models.Manager):
+    def top_defects(self, ml_model_ids, ordered_defect_ids=None):
+        """The highest priority defect of every model classification of the ml models, picked with a single DISTINCT
+        ON over the classifications instead of comparing the defects of every classification with each other.
+        ordered_defect_ids defaults to get_ordered_defect_ids().
+
+        Returns a queryset of one ModelClassificationDefect per classification, to be used as a subquery, e.g.
+        filter(id__in=top_defects.values("id")). It's evaluated once by postgres as it doesn't reference the outer
+        query.
+        """
+        from apps.classif_ai.helpers import get_ordered_defect_ids
+
+        if ordered_defect_ids is None:
+            ordered_defect_ids = get_ordered_defect_ids()
+        priority = Func(
+            Cast(Value(list(ordered_defect_ids)), ArrayField(models.IntegerField())),
+            F("defect_id"),
+            function="array_position",
+        )
+        return (
+            self.filter(classification__ml_model_id__in=ml_model_ids)
+            .order_by("classification_id", priority.asc(nulls_last=True), "defect_id")
+            .distinct("classification_id")
+        )
@@ -0,0 +1,45 @@
+# Generated by Django 3.2 on 2026-10-18 10:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('classif_ai', '0144_add_draft_status_choice_to_mlmodel'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ClassificationMetricRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('total_count', models.IntegerField(default=0)),
+                ('auto_classified_count', models.IntegerField(default=0)),
+                ('audited_count', models.IntegerField(default=0)),
+                ('accurate_count', models.IntegerField(default=0)),
+                ('updated_ts', models.DateTimeField(auto_now=True, verbose_name='Last Updated Date')),
+                ('gt_defect', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='gt_classification_metric_rollups', to='classif_ai.defect')),
+                ('ml_model', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='classification_metric_rollups', to='classif_ai.mlmodel')),
+                ('model_defect', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='model_classification_metric_rollups', to='classif_ai.defect')),
+                ('use_case', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='classification_metric_rollups', to='classif_ai.usecase')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['use_case', 'date'], name='metric_rollup_use_case_idx'), models.Index(fields=['ml_model', 'date'], name='metric_rollup_ml_model_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='StaleClassificationMetricRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('created_ts', models.DateTimeField(auto_now_add=True, verbose_name='Created Date')),
+                ('use_case', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stale_classification_metric_rollups', to='classif_ai.usecase')),
+            ],
+            options={
+                'unique_together': {('date', 'use_case')},
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.2 on 2026-10-18 14:02
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('classif_ai', '0145_classification_metric_rollups'),
+    ]
+
+    operations = [
+        # a wafer could be tagged twice with the same tag, the duplicates are dropped before the constraint is added
+        migrations.RunSQL(
+            sql="""
+                delete from classif_ai_wafermaptag duplicate
+                using classif_ai_wafermaptag original
+                where duplicate.wafer_id = original.wafer_id
+                and duplicate.tag_id = original.tag_id
+                and duplicate.id > original.id
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AlterUniqueTogether(
+            name='wafermaptag',
+            unique_together={('wafer', 'tag')},
+        ),
+    ]
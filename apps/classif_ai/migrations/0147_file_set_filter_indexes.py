@@ -0,0 +1,40 @@
+# Generated by Django 3.2 on 2026-10-18 16:40
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # the indexes are built concurrently, without blocking the writes to the tables
+    atomic = False
+
+    dependencies = [
+        ('classif_ai', '0146_wafermaptag_unique_wafer_tag'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='filesetinferencequeue',
+            index=models.Index(fields=['file_set', 'ml_model', 'status'], name='fsiq_file_set_model_status_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='trainingsessionfileset',
+            index=models.Index(
+                fields=['training_session', 'dataset_train_type', 'file_set'], name='tsfs_session_type_fs_idx'
+            ),
+        ),
+        AddIndexConcurrently(
+            model_name='gtclassificationdefect',
+            index=models.Index(fields=['defect', 'classification'], name='gt_cls_defect_defect_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='modelclassification',
+            index=models.Index(fields=['ml_model', 'file'], name='model_cls_model_file_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='modelclassificationdefect',
+            index=models.Index(
+                fields=['defect', 'classification'], include=('confidence',), name='model_cls_defect_defect_idx'
+            ),
+        ),
+    ]
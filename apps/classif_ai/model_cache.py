@@ -0,0 +1,160 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def get_directory_size(path):
+    """Returns the total size in bytes of all the files under path. Returns 0 if the path doesn't exist."""
+    total_size = 0
+    if not path or not os.path.exists(path):
+        return total_size
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    for dir_path, _, file_names in os.walk(path):
+        for file_name in file_names:
+            file_path = os.path.join(dir_path, file_name)
+            if not os.path.islink(file_path):
+                total_size += os.path.getsize(file_path)
+    return total_size
+
+
+class ModelCache:
+    """
+    Process wide LRU cache of the loaded (in memory) ml models, keyed by (schema_name, ml_model_id).
+
+    The cache is bounded by a model count and / or a byte budget (0 means unbounded). When the budget is exceeded,
+    the least recently used model of the tenant holding the largest share of the cache is evicted first, so that a
+    single busy tenant can't push every other tenant's models out. A per tenant model limit can be set as well.
+    """
+
+    def __init__(self, max_models=0, max_bytes=0, max_models_per_tenant=0):
+        self.max_models = max_models
+        self.max_bytes = max_bytes
+        self.max_models_per_tenant = max_models_per_tenant
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    @property
+    def total_bytes(self):
+        return sum(entry["size"] for entry in self._entries.values())
+
+    def get(self, schema_name, model_id):
+        key = (schema_name, model_id)
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry["model"]
+
+    def put(self, schema_name, model_id, model, size=0):
+        key = (schema_name, model_id)
+        with self._lock:
+            if key in self._entries:
+                self._entries.pop(key)
+            self._entries[key] = {"model": model, "size": size}
+            self._enforce_budget(protected_key=key)
+        return model
+
+    def evict(self, schema_name, model_id):
+        with self._lock:
+            entry = self._entries.pop((schema_name, model_id), None)
+        if entry is not None:
+            self._destroy(schema_name, model_id, entry["model"])
+        return entry is not None
+
+    def evict_least_recently_used(self, exclude=None):
+        """Evicts the least recently used model of the tenant with the most cached models.
+        Returns False if there was nothing to evict."""
+        with self._lock:
+            key = self._select_victim(exclude=exclude)
+            if key is None:
+                return False
+            entry = self._entries.pop(key)
+        self._destroy(key[0], key[1], entry["model"])
+        return True
+
+    def clear(self):
+        with self._lock:
+            keys = list(self._entries.keys())
+        for schema_name, model_id in keys:
+            self.evict(schema_name, model_id)
+
+    def stats(self):
+        with self._lock:
+            tenants = {}
+            for (schema_name, model_id), entry in self._entries.items():
+                tenant = tenants.setdefault(schema_name, {"models": [], "bytes": 0})
+                tenant["models"].append(model_id)
+                tenant["bytes"] += entry["size"]
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "models": len(self._entries),
+                "bytes": self.total_bytes,
+                "tenants": tenants,
+            }
+
+    def _tenant_keys(self, schema_name):
+        return [key for key in self._entries.keys() if key[0] == schema_name]
+
+    def _select_victim(self, exclude=None, schema_name=None):
+        candidates = [key for key in self._entries.keys() if key != exclude]
+        if schema_name is not None:
+            candidates = [key for key in candidates if key[0] == schema_name]
+        if not candidates:
+            return None
+        usage = {}
+        for key in candidates:
+            usage[key[0]] = usage.get(key[0], 0) + 1
+        heaviest_tenant = max(usage, key=lambda tenant: usage[tenant])
+        # OrderedDict keeps the least recently used entries first.
+        for key in candidates:
+            if key[0] == heaviest_tenant:
+                return key
+
+    def _is_over_budget(self):
+        if self.max_models and len(self._entries) > self.max_models:
+            return True
+        if self.max_bytes and self.total_bytes > self.max_bytes:
+            return True
+        return False
+
+    def _enforce_budget(self, protected_key):
+        victims = []
+        schema_name = protected_key[0]
+        while self.max_models_per_tenant and len(self._tenant_keys(schema_name)) > self.max_models_per_tenant:
+            key = self._select_victim(exclude=protected_key, schema_name=schema_name)
+            if key is None:
+                break
+            victims.append((key, self._entries.pop(key)))
+        while self._is_over_budget():
+            key = self._select_victim(exclude=protected_key)
+            if key is None:
+                break
+            victims.append((key, self._entries.pop(key)))
+        for key, entry in victims:
+            self._destroy(key[0], key[1], entry["model"])
+
+    def _destroy(self, schema_name, model_id, model):
+        self.evictions += 1
+        logger.info(f"Evicting model {model_id} of schema {schema_name} from the model cache")
+        try:
+            model.predictor.destroy()
+        except Exception:
+            pass
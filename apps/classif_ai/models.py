@@ -1,4 +1,5 @@
 import json
+import logging
 import os
 import sys
 from datetime import datetime, timezone
@@ -8,7 +9,6 @@ from django.db.models.expressions import F
 
 from django.db.models.query import QuerySet
 
-import boto3
 import requests
 from django.contrib.gis.geos import Point
 from django.contrib.postgres.fields.citext import CITextField
@@ -19,11 +19,9 @@ from django.core.files.storage import get_storage_class, default_storage
 from django.db import models, connection, transaction
 from django.contrib.gis.db import models
 from django.db.models import Func, Q
-from django.db.models.signals import post_delete
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
 from django.utils.text import get_valid_filename
-from rest_framework import serializers
-from django_tenants.utils import schema_context
 
 from apps.classif_ai.helpers import (
     add_uuid_to_file_name,
@@ -32,15 +30,22 @@ from apps.classif_ai.helpers import (
     create_celery_format_message,
     prepare_training_session_defects_json,
 )
-from apps.classif_ai.managers import FileSetInferenceQueueManager, FileSetManager
+from apps.classif_ai.managers import (
+    FileSetInferenceQueueManager,
+    FileSetManager,
+    ModelClassificationDefectManager,
+    WaferMapTagManager,
+)
+from apps.classif_ai.model_cache import ModelCache, get_directory_size
+from apps.classif_ai.region_matching import RegionMatcher
 from apps.classif_ai.tasks import perform_file_set_inference
-from apps.subscriptions.models import Subscription
+from apps.subscriptions.meta_info_validator import get_file_set_meta_info_validator
+from common.file_storage import get_pre_signed_url
 from common.models import Base
-from common.services import S3Service
+from common.services import S3Service, get_boto3_client
 from sixsense import settings
 from sixsense.settings import (
     DS_MODEL_INVOCATION_PATH,
-    DEFAULT_FILE_STORAGE_OBJECT,
     CUSTOM_MODELS_PATH,
     WAFERMAP_PLOTTING_URL,
     INFERENCE_METHOD,
@@ -50,6 +55,8 @@ from sixsense.settings import (
 from sixsense.settings import AUTH_USER_MODEL as User
 from django.utils.translation import ugettext_lazy as _
 
+logger = logging.getLogger(__name__)
+
 file_storage = get_storage_class()
 
 
@@ -84,7 +91,11 @@ class MlModel(Base):
     inference_endpoint = models.CharField(max_length=1024, blank=True)
     inference_endpoint_region = models.CharField(max_length=32, blank=True)
     artifact_path = models.CharField(max_length=1024, blank=True)
-    models = {}
+    models = ModelCache(
+        max_models=settings.MODEL_CACHE_MAX_MODELS,
+        max_bytes=settings.MODEL_CACHE_MAX_BYTES,
+        max_models_per_tenant=settings.MODEL_CACHE_MAX_MODELS_PER_TENANT,
+    )
 
     def __str__(self):
         return f"{self.name}-{self.code}-{self.version}"
@@ -133,6 +144,14 @@ class MlModel(Base):
     def classification_type(self):
         return self.use_case.classification_type
 
+    @classmethod
+    def get_loaded_model(cls, model_id):
+        """Returns the in memory model of the current tenant from the model cache, loading it on a cache miss."""
+        loaded_model = cls.models.get(connection.tenant.schema_name, model_id)
+        if loaded_model is None:
+            loaded_model = cls.load_model(model_id)
+        return loaded_model
+
     @classmethod
     def load_model(cls, model_id):
         try:
@@ -142,6 +161,7 @@ class MlModel(Base):
             # sys.path.append(SKYWORKS_DS_MODEL_INVOCATION_PATH)
             db_model = cls.objects.get(id=model_id)
             model_invocation_path = db_model.path.get("invocation_path", None)
+            model_size = 0
             if model_invocation_path:
                 local_path = os.path.join(CUSTOM_MODELS_PATH, model_invocation_path)
                 if not os.path.exists(local_path):
@@ -158,6 +178,7 @@ class MlModel(Base):
                             os.makedirs(os.path.dirname(os.path.join("all_models", file)), exist_ok=True)
                             with open(os.path.join("all_models", file), "wb") as f:
                                 f.write(r.content)
+                model_size = get_directory_size(local_path)
                 # from invoke import Defect_detector
                 Defect_detector = locate(".".join(os.path.join(local_path, "invoke/Defect_detector").split("/")))
             # elif connection.schema_name == 'gf7':
@@ -170,31 +191,31 @@ class MlModel(Base):
             #     from skyworks_deployment.invoke import Defect_detector
             else:
                 from invoke import Defect_detector
-            if cls.models.get(connection.tenant.schema_name, None) is None:
-                cls.models[connection.tenant.schema_name] = {}
-            cls.models[connection.tenant.schema_name][model_id] = Defect_detector(db_model.path)
+            return cls.models.put(
+                connection.tenant.schema_name, model_id, Defect_detector(db_model.path), size=model_size
+            )
         except cls.DoesNotExist:
             raise
-        except RuntimeError as e:
-            retry_loading = False
-            for schema_name, loaded_models in cls.models:
-                for loaded_model_id in loaded_models.keys():
-                    with schema_context(schema_name):
-                        cou = FileSetInferenceQueue.objects.filter(
-                            ml_model_id=loaded_model_id, status__in=["PENDING", "PROCESSING"]
-                        ).count()
-                        if cou == 0:
-                            try:
-                                cls.models[schema_name][loaded_model_id].predictor.destroy()
-                            except Exception:
-                                pass
-                            del cls.models[loaded_model_id]
-                            retry_loading = True
-            if retry_loading:
+        except RuntimeError:
+            # Most likely the device ran out of memory. Free the least recently used model and try again until there
+            # is nothing left to free.
+            if cls.models.evict_least_recently_used(exclude=(connection.tenant.schema_name, model_id)):
                 return cls.load_model(model_id)
-            else:
-                raise
-        return cls.models[connection.tenant.schema_name][model_id]
+            raise
+
+    @classmethod
+    def warmup_models(cls):
+        """Loads the models deployed in production of every use case of the current tenant into the model cache."""
+        loaded_model_ids = []
+        for model_id in cls.objects.filter(status="deployed_in_prod").values_list("id", flat=True):
+            if (connection.tenant.schema_name, model_id) in cls.models:
+                continue
+            try:
+                cls.load_model(model_id)
+                loaded_model_ids.append(model_id)
+            except Exception as e:
+                logger.exception(f"Failed to warm up model {model_id} of schema {connection.tenant.schema_name}: {e}")
+        return loaded_model_ids
 
     def copy_defects_from(self, ml_model, created_by_id):
         ml_model_defect_sql = """
@@ -376,7 +397,7 @@ class WaferMap(Base):
 
     def get_pre_signed_url(self):
         if self.image_path:
-            return DEFAULT_FILE_STORAGE_OBJECT.url(self.image_path)
+            return get_pre_signed_url(self.image_path)
         else:
             return
 
@@ -418,6 +439,11 @@ class WaferMapTag(models.Model):
     wafer = models.ForeignKey(WaferMap, on_delete=models.CASCADE)
     tag = models.ForeignKey(Tag, on_delete=models.PROTECT)
 
+    objects = WaferMapTagManager()
+
+    class Meta:
+        unique_together = [["wafer", "tag"]]
+
 
 class FileSet(Base):
     upload_session = models.ForeignKey(
@@ -435,22 +461,11 @@ class FileSet(Base):
 
     def clean(self, *args, **kwargs):
         if self.subscription_id:
-            config = Subscription.objects.get(id=self.subscription_id).file_set_meta_info
-            meta_info = self.meta_info
-
-            sub_fields = {}
-            for field in config:
-                serializer_field = getattr(serializers, field["field_type"])
-                sub_fields[field["field"]] = serializer_field(**field["field_props"])
-
-            FileSetMetaInfoSerializer = type("FileSetMetaInfoSerializer", (serializers.Serializer,), sub_fields)
-            serializer_data = {}
-            for key, val in meta_info.items():
-                serializer_data[key] = val
-            serializer = FileSetMetaInfoSerializer(data=serializer_data)
-            unknown = set(serializer_data) - set(serializer.fields)
+            validator = get_file_set_meta_info_validator(self.subscription_id)
+            unknown = validator.unknown_fields(self.meta_info)
             if unknown:
                 raise ValidationError("Unknown field(s): {}".format(", ".join(unknown)))
+            serializer = validator.serializer(self.meta_info)
             serializer.is_valid(raise_exception=True)
 
     def save(self, *args, **kwargs):
@@ -494,7 +509,7 @@ class File(Base):
         return s3_service.generate_pre_signed_post(self.path)
 
     def get_pre_signed_url(self):
-        return DEFAULT_FILE_STORAGE_OBJECT.url(self.path)
+        return get_pre_signed_url(self.path)
         # if settings.TENANT_FILE_STORAGE == "S3":
         #     s3_service = S3Service()
         #     return s3_service.generate_pre_signed_url(self.path)
@@ -511,11 +526,14 @@ class File(Base):
                     settings.MEDIA_ROOT, connection.tenant.schema_name, get_valid_filename(self.image.name)
                 )
             else:
-                self.path = os.path.join(
-                    settings.MEDIA_ROOT, connection.tenant.schema_name, add_uuid_to_file_name(self.name)
-                )
+                self.path = self.default_path(self.name)
         super().save(*args, **kwargs)
 
+    @staticmethod
+    def default_path(name):
+        """[storage path of a file without an image, a new unique one on every call]"""
+        return os.path.join(settings.MEDIA_ROOT, connection.tenant.schema_name, add_uuid_to_file_name(name))
+
     # def delete(self, *args, **kwargs):
     # deleted = super().save(*args, **kwargs)
     # def _delete():
@@ -641,31 +659,12 @@ class FileRegion(Base):
                             self.classification_correctness = False
                     self.save()
                 else:
-                    matching_region = None
-                    for feedback in already_existing_feedbacks:
-                        iou = calculate_iou(
-                            [
-                                feedback.region["coordinates"]["x"],
-                                feedback.region["coordinates"]["y"],
-                                feedback.region["coordinates"]["x"] + feedback.region["coordinates"]["w"],
-                                feedback.region["coordinates"]["y"] + feedback.region["coordinates"]["h"],
-                            ],
-                            [
-                                self.region["coordinates"]["x"],
-                                self.region["coordinates"]["y"],
-                                self.region["coordinates"]["x"] + self.region["coordinates"]["w"],
-                                self.region["coordinates"]["y"] + self.region["coordinates"]["h"],
-                            ],
-                        )
-                        if iou > 0.4:
-                            if matching_region:
-                                if matching_region[1] < iou:
-                                    matching_region = [feedback, iou]
-                            else:
-                                matching_region = [feedback, iou]
-                    if matching_region:
-                        matching_region[0].ai_region = self
-                        matching_region[0].save()
+                    matching_feedback, _ = RegionMatcher(already_existing_feedbacks).best_match(
+                        self.region, self.IOU_THRESHOLD_FOR_DETECTION_CORRECTNESS
+                    )
+                    if matching_feedback:
+                        matching_feedback.ai_region = self
+                        matching_feedback.save()
             if self.ai_region:
                 model_type = self.ml_model.type
                 region = self.region
@@ -737,6 +736,12 @@ class FileSetInferenceQueue(Base):
 
     objects = FileSetInferenceQueueManager()
 
+    class Meta:
+        indexes = [
+            # the inference queues of the file sets are looked up by ml model and status, e.g. the FINISHED ones
+            models.Index(name="fsiq_file_set_model_status_idx", fields=["file_set", "ml_model", "status"]),
+        ]
+
     def clean(self, *args, **kwargs):
         if (
             self.id is None
@@ -780,7 +785,7 @@ class TrainingSession(Base):
         with transaction.atomic():
             body = {"training_session_id": self.id, "schema": connection.tenant.schema_name}
             message = create_celery_format_message("retrain.run_training", args=[json.dumps(body)])
-            client = boto3.client("sqs", region_name=RETRAINING_QUEUE_REGION_NAME)
+            client = get_boto3_client("sqs", region_name=RETRAINING_QUEUE_REGION_NAME)
             try:
                 resp = client.send_message(
                     QueueUrl=RETRAINING_QUEUE,
@@ -893,6 +898,14 @@ class TrainingSessionFileSet(Base):
     dataset_train_type = models.CharField(choices=DATASET_CATEGORY_CHOICES, max_length=50, blank=True)
     belongs_to_old_model_training_data = models.BooleanField(null=False, default=False)
 
+    class Meta:
+        indexes = [
+            # the train_type filter reads the file sets of the training sessions with the given train types
+            models.Index(
+                name="tsfs_session_type_fs_idx", fields=["training_session", "dataset_train_type", "file_set"]
+            ),
+        ]
+
     # TODO Need to validate classification and detection defects
     def clean(self, *args, **kwargs):
         if self.file_set_id:
@@ -937,29 +950,11 @@ class UserClassification(models.Model):
         super(UserClassification, self).save(*args, **kwargs)
 
     def copy_to_gt(self):
+        from apps.classif_ai.service.gt_promotion_service import promote_user_classifications
+
         if self._state.adding:
             raise ValidationError("Can't copy to gt before the user annotation is saved")
-        with transaction.atomic():
-            gt_classification = GTClassification.objects.filter(file_id=self.file_id).first()
-            if not gt_classification:
-                gt_classification = GTClassification(file_id=self.file_id, is_no_defect=self.is_no_defect)
-            user_classification_defects = UserClassificationDefect.objects.filter(classification=self)
-            is_no_defect = False
-            if not user_classification_defects:
-                is_no_defect = True
-            gt_classification.is_no_defect = is_no_defect
-            gt_classification.save()
-            GTClassificationDefect.objects.filter(classification=gt_classification).delete()
-            if gt_classification.is_no_defect is False:
-                user_classification_defects = UserClassificationDefect.objects.filter(classification=self)
-                gt_classification_defects = []
-                for user_classification_defect in user_classification_defects:
-                    gt_classification_defects.append(
-                        GTClassificationDefect(
-                            classification=gt_classification, defect_id=user_classification_defect.defect_id
-                        )
-                    )
-                GTClassificationDefect.objects.bulk_create(gt_classification_defects)
+        promote_user_classifications([self.id])
 
 
 class UserClassificationDefect(Base):
@@ -991,32 +986,11 @@ class UserDetection(models.Model):
         super(UserDetection, self).save(*args, **kwargs)
 
     def copy_to_gt(self):
+        from apps.classif_ai.service.gt_promotion_service import promote_user_detections
+
         if self._state.adding:
             raise ValidationError("Can't copy to gt before the user annotation is saved")
-        with transaction.atomic():
-            gt_detection = GTDetection.objects.filter(file_id=self.file_id).first()
-            if not gt_detection:
-                gt_detection = GTDetection(file_id=self.file_id, is_no_defect=self.is_no_defect)
-            gt_detection.is_no_defect = self.is_no_defect
-            gt_detection.save()
-            GTDetectionRegion.objects.filter(detection=gt_detection).delete()
-            if gt_detection.is_no_defect is False:
-                user_detection_regions = UserDetectionRegion.objects.filter(detection=self)
-                for user_detection_region in user_detection_regions:
-                    gt_detection_region = GTDetectionRegion.objects.create(
-                        detection=gt_detection, region=user_detection_region.region
-                    )
-                    user_detection_region_defects = UserDetectionRegionDefect.objects.filter(
-                        detection_region=user_detection_region
-                    )
-                    gt_detection_region_defects = []
-                    for user_detection_region_defect in user_detection_region_defects:
-                        gt_detection_region_defects.append(
-                            GTDetectionRegionDefect(
-                                detection_region=gt_detection_region, defect_id=user_detection_region_defect.defect_id
-                            )
-                        )
-                    GTDetectionRegionDefect.objects.bulk_create(gt_detection_region_defects)
+        promote_user_detections([self.id])
 
 
 class UserDetectionRegion(Base):
@@ -1058,6 +1032,10 @@ class GTClassificationDefect(Base):
 
     class Meta:
         unique_together = [["classification", "defect"]]
+        indexes = [
+            # the label filters start from the defects, the unique index only serves lookups by classification
+            models.Index(name="gt_cls_defect_defect_idx", fields=["defect", "classification"]),
+        ]
 
 
 class GTDetection(Base):
@@ -1095,6 +1073,10 @@ class ModelClassification(Base):
 
     class Meta:
         unique_together = [["file", "ml_model"]]
+        indexes = [
+            # the unique index serves lookups by file, this one the classifications of the filtered ml models
+            models.Index(name="model_cls_model_file_idx", fields=["ml_model", "file"]),
+        ]
 
 
 class ModelClassificationDefect(Base):
@@ -1106,8 +1088,16 @@ class ModelClassificationDefect(Base):
     # ToDo: There should be a validation to validate if the defect being inserted actually belongs to the
     #  use case of the file or not
 
+    objects = ModelClassificationDefectManager()
+
     class Meta:
         unique_together = [["classification", "defect"]]
+        indexes = [
+            # the confidence is included for the confidence threshold filters to be answered from the index
+            models.Index(
+                name="model_cls_defect_defect_idx", fields=["defect", "classification"], include=["confidence"]
+            ),
+        ]
 
 
 class ModelDetection(Base):
@@ -1140,3 +1130,74 @@ class ModelDetectionRegionDefect(models.Model):
 
     class Meta:
         unique_together = [["detection_region", "defect"]]
+
+
+class ClassificationMetricRollup(models.Model):
+    """
+    Daily rollup of the classification metrics, one row per (day, use case, model, gt defect, model defect).
+    The counts are over the same rows the classification metrics are calculated on, i.e. the distinct
+    (file, gt defect, model defect) combinations of the model classifications of a file.
+    Rows are derived data, they are rebuilt by the metric rollup service whenever the classifications of a day change.
+    """
+
+    date = models.DateField()
+    use_case = models.ForeignKey(UseCase, related_name="classification_metric_rollups", on_delete=models.CASCADE)
+    ml_model = models.ForeignKey(MlModel, related_name="classification_metric_rollups", on_delete=models.CASCADE)
+    gt_defect = models.ForeignKey(
+        Defect, related_name="gt_classification_metric_rollups", on_delete=models.CASCADE, null=True, blank=True
+    )
+    model_defect = models.ForeignKey(
+        Defect, related_name="model_classification_metric_rollups", on_delete=models.CASCADE, null=True, blank=True
+    )
+    total_count = models.IntegerField(default=0)
+    auto_classified_count = models.IntegerField(default=0)
+    audited_count = models.IntegerField(default=0)
+    accurate_count = models.IntegerField(default=0)
+    updated_ts = models.DateTimeField(_("Last Updated Date"), auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(name="metric_rollup_use_case_idx", fields=["use_case", "date"]),
+            models.Index(name="metric_rollup_ml_model_idx", fields=["ml_model", "date"]),
+        ]
+
+
+class StaleClassificationMetricRollup(models.Model):
+    """(day, use case) slices of ClassificationMetricRollup waiting to be rebuilt."""
+
+    date = models.DateField()
+    use_case = models.ForeignKey(UseCase, related_name="stale_classification_metric_rollups", on_delete=models.CASCADE)
+    created_ts = models.DateTimeField(_("Created Date"), auto_now_add=True)
+
+    class Meta:
+        unique_together = [["date", "use_case"]]
+
+
+# deletes aren't listened to, a post_delete receiver would turn every queryset delete of the classifications into a
+# delete per row. The bulk deletes mark the rollups of their files stale themselves.
+@receiver(post_save, sender=GTClassification)
+@receiver(post_save, sender=ModelClassification)
+def classification_changed(sender, instance, **kwargs):
+    from apps.classif_ai.service.metric_rollup_service import mark_files_stale
+
+    mark_files_stale([instance.file_id])
+
+
+@receiver(pre_save, sender=MlModel)
+def ml_model_pre_save(sender, instance, **kwargs):
+    # kept to tell in post_save whether the confidence threshold changed
+    instance._saved_confidence_threshold = (
+        MlModel.objects.filter(id=instance.id).values_list("confidence_threshold", flat=True).first()
+        if instance.id is not None
+        else None
+    )
+
+
+@receiver(post_save, sender=MlModel)
+def ml_model_post_save(sender, instance, created, **kwargs):
+    if created or instance.confidence_threshold == getattr(instance, "_saved_confidence_threshold", None):
+        return
+    from apps.classif_ai.service.metric_rollup_service import mark_ml_model_stale
+
+    # the auto classified / audited / accurate counts of the rollups depend on the threshold
+    mark_ml_model_stale(instance.id)
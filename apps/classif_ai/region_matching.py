@@ -0,0 +1,134 @@
+from bisect import bisect_right
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+from apps.classif_ai.helpers import calculate_iou
+
+
+def region_to_box(region):
+    """Converts a region json ({"type": "box", "coordinates": {x, y, w, h}}) into [x1, y1, x2, y2]."""
+    coordinates = region["coordinates"]
+    return [
+        coordinates["x"],
+        coordinates["y"],
+        coordinates["x"] + coordinates["w"],
+        coordinates["y"] + coordinates["h"],
+    ]
+
+
+class RegionMatcher:
+    """
+    Finds the best IoU match for a target region among a fixed set of candidate regions.
+
+    The candidate boxes are indexed once, sorted by their left edge. For every target only the candidates whose
+    bounding box overlaps with the target's bounding box are considered, and their IoU is computed in one vectorized
+    pass (numpy, if available).
+
+    Args:
+        candidates: collection of objects holding a region json, e.g. FileRegion instances or region dicts
+        get_region: callable returning the region json of a candidate. Defaults to the `region` attribute.
+    """
+
+    def __init__(self, candidates, get_region=None):
+        if get_region is None:
+            get_region = lambda candidate: candidate.region
+        candidates = list(candidates)
+        boxes = [region_to_box(get_region(candidate)) for candidate in candidates]
+        order = sorted(range(len(candidates)), key=lambda idx: boxes[idx][0])
+        # Position of every indexed candidate in the input, used to break IoU ties the same way a linear scan would.
+        self._positions = order
+        self.candidates = [candidates[idx] for idx in order]
+        self.boxes = [boxes[idx] for idx in order]
+        self._left_edges = [box[0] for box in self.boxes]
+        if np is not None:
+            self._box_array = np.asarray(self.boxes, dtype=float).reshape(-1, 4)
+
+    def __len__(self):
+        return len(self.candidates)
+
+    def _overlapping_indices(self, box):
+        # Only the candidates starting before the target ends can overlap with it.
+        end = bisect_right(self._left_edges, box[2])
+        if np is not None:
+            candidate_boxes = self._box_array[:end]
+            mask = (
+                (candidate_boxes[:, 2] >= box[0])
+                & (candidate_boxes[:, 1] <= box[3])
+                & (candidate_boxes[:, 3] >= box[1])
+            )
+            return np.nonzero(mask)[0]
+        return [
+            idx
+            for idx in range(end)
+            if self.boxes[idx][2] >= box[0] and self.boxes[idx][1] <= box[3] and self.boxes[idx][3] >= box[1]
+        ]
+
+    def _scores(self, region):
+        box = region_to_box(region)
+        indices = self._overlapping_indices(box)
+        if len(indices) == 0:
+            return []
+        if np is None:
+            return [(idx, calculate_iou(self.boxes[idx], box)) for idx in indices]
+        candidate_boxes = self._box_array[indices]
+        dx = np.minimum(candidate_boxes[:, 2], box[2]) - np.maximum(candidate_boxes[:, 0], box[0])
+        dy = np.minimum(candidate_boxes[:, 3], box[3]) - np.maximum(candidate_boxes[:, 1], box[1])
+        intersection_areas = np.where((dx >= 0) & (dy >= 0), dx * dy, 0)
+        candidate_areas = (candidate_boxes[:, 2] - candidate_boxes[:, 0]) * (
+            candidate_boxes[:, 3] - candidate_boxes[:, 1]
+        )
+        box_area = (box[2] - box[0]) * (box[3] - box[1])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ious = intersection_areas / (candidate_areas + box_area - intersection_areas)
+        return [(int(idx), float(iou)) for idx, iou in zip(indices, ious)]
+
+    def ious(self, region):
+        """Returns [(candidate, iou)] for all the candidates whose bounding box overlaps with region."""
+        return [(self.candidates[idx], iou) for idx, iou in self._scores(region)]
+
+    def best_match(self, region, threshold):
+        """Returns (candidate, iou) of the candidate with the highest IoU above threshold, (None, None) otherwise.
+        On a tie, the candidate that came first in the input wins."""
+        best_idx, best_iou = None, None
+        for idx, iou in self._scores(region):
+            if not iou > threshold:
+                continue
+            if (
+                best_iou is None
+                or iou > best_iou
+                or (iou == best_iou and self._positions[idx] < self._positions[best_idx])
+            ):
+                best_idx, best_iou = idx, iou
+        if best_idx is None:
+            return None, None
+        return self.candidates[best_idx], best_iou
+
+
+def match_regions_bulk(targets_by_key, candidates_by_key, threshold, get_target_region=None, get_region=None):
+    """
+    Matches the target regions of many files (or any other grouping key) against the candidate regions of the same
+    key in a single call. The candidates of every key are indexed only once.
+
+    Args:
+        targets_by_key: {key: [target]}
+        candidates_by_key: {key: [candidate]}
+        threshold: minimum IoU (exclusive) for two regions to match
+        get_target_region: callable returning the region json of a target. Defaults to the `region` attribute.
+        get_region: callable returning the region json of a candidate. Defaults to the `region` attribute.
+
+    Returns:
+        {key: [(target, matching candidate or None, iou or None)]}
+    """
+    if get_target_region is None:
+        get_target_region = lambda target: target.region
+    matches = {}
+    for key, targets in targets_by_key.items():
+        matcher = RegionMatcher(candidates_by_key.get(key, []), get_region=get_region)
+        matches[key] = []
+        for target in targets:
+            candidate, iou = matcher.best_match(get_target_region(target), threshold)
+            matches[key].append((target, candidate, iou))
+    return matches
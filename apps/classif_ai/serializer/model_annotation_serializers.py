@@ -1,4 +1,3 @@
-from django.contrib.gis.geos import Polygon
 from django.db import transaction
 from apps.classif_ai.helpers import inference_output_setup_and_send
 from rest_framework import serializers
@@ -16,6 +15,7 @@ from apps.classif_ai.models import (
     FileSetInferenceQueue,
 )
 from apps.classif_ai.serializers import DefectSerializer
+from apps.classif_ai.service.model_annotation_service import ModelAnnotationBulkWriter
 
 
 class MlModelClassificationDefectSerializer(serializers.ModelSerializer):
@@ -127,30 +127,7 @@ class MLModelDetectionSerializer(serializers.ModelSerializer):
             model_detection = super().create(validated_data)
             if model_detection.is_no_defect is False and self.context.get("detection_regions", None):
                 detection_regions = self.context.get("detection_regions")
-                for detection_region_data in detection_regions:
-                    region = detection_region_data["region"]["coordinates"]
-                    detection_region = ModelDetectionRegion.objects.create(
-                        region=Polygon(
-                            (
-                                (region["x"], region["y"]),
-                                (region["x"] + region["w"], region["y"]),
-                                (region["x"] + region["w"], region["y"] + region["h"]),
-                                (region["x"], region["y"] + region["h"]),
-                                (region["x"], region["y"]),
-                            )
-                        ),
-                        detection=model_detection,
-                    )
-                    model_detection_defects = []
-                    for defect in detection_region_data["defects"]:
-                        model_detection_defects.append(
-                            ModelDetectionRegionDefect(
-                                detection_region=detection_region,
-                                defect_id=defect["defect_id"],
-                                confidence=defect["confidence"],
-                            )
-                        )
-                    ModelDetectionRegionDefect.objects.bulk_create(model_detection_defects)
+                ModelAnnotationBulkWriter.write_detection_regions([(model_detection, detection_regions)])
             FileSetInferenceQueue.objects.filter(
                 file_set_id=model_detection.file.file_set_id, ml_model=validated_data["ml_model"], status="PROCESSING"
             ).update(status="FINISHED")
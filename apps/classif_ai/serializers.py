@@ -1,4 +1,3 @@
-import importlib
 import os
 import uuid
 import ast
@@ -8,8 +7,10 @@ from django.contrib.postgres.aggregates.general import ArrayAgg
 from django.core.exceptions import ImproperlyConfigured
 from django.core.files.storage import default_storage
 from django.db import transaction, connection
+from django.db.models import Count, IntegerField, Manager, OuterRef, Subquery
 from django.db.models.aggregates import Max
 from django.db.models.expressions import F
+from django.db.models.functions import Coalesce
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 from sixsense.settings import IMAGE_HANDLER_QUEUE_URL
@@ -44,15 +45,48 @@ from apps.classif_ai.models import (
     WaferMap,
     Tag,
 )
-from apps.subscriptions.models import Subscription
+from apps.classif_ai.tenant_hooks import get_tenant_hook, require_tenant_hook
+from apps.subscriptions.meta_info_validator import get_file_set_meta_info_validator
 from apps.users.serializers import UserSerializer
+from common.file_storage import get_pre_signed_urls
 from common.services import S3Service
 from sixsense import settings
 
 from django_celery_results.models import TaskResult
 
 
-class FileCreateSerializer(serializers.ModelSerializer):
+class PreSignedUrlListSerializer(serializers.ListSerializer):
+    """Signs the urls of all the instances being serialized in one batch (cached urls are reused), and shares them
+    with the child serializer through the context under "pre_signed_urls"."""
+
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, Manager) else data
+        iterable = list(iterable)
+        pre_signed_urls = self.context.get("pre_signed_urls", None)
+        if pre_signed_urls is None:
+            pre_signed_urls = {}
+            self._context["pre_signed_urls"] = pre_signed_urls
+        pre_signed_urls.update(
+            get_pre_signed_urls(self.child.get_pre_signed_url_path(instance) for instance in iterable)
+        )
+        return super(PreSignedUrlListSerializer, self).to_representation(iterable)
+
+
+class PreSignedUrlMixin:
+    pre_signed_url_path_field = "path"
+
+    def get_pre_signed_url_path(self, instance):
+        return getattr(instance, self.pre_signed_url_path_field)
+
+    def get_pre_signed_url(self, instance):
+        pre_signed_urls = self.context.get("pre_signed_urls", None) or {}
+        path = self.get_pre_signed_url_path(instance)
+        if path in pre_signed_urls:
+            return pre_signed_urls[path]
+        return instance.get_pre_signed_url()
+
+
+class FileCreateSerializer(PreSignedUrlMixin, serializers.ModelSerializer):
     pre_signed_post_data = serializers.SerializerMethodField(read_only=True)
     url = serializers.SerializerMethodField(read_only=True)
 
@@ -60,7 +94,7 @@ class FileCreateSerializer(serializers.ModelSerializer):
         return instance.get_pre_signed_post_data()
 
     def get_url(self, instance):
-        return instance.get_pre_signed_url()
+        return self.get_pre_signed_url(instance)
 
         # TODO: detection code needs to be corrected, some issue with gt models
         # gt_detection_region_annotation is not found in instance.gt_detections.detection_regions.gt_detection_region_annotation
@@ -79,18 +113,20 @@ class FileCreateSerializer(serializers.ModelSerializer):
         model = File
         fields = ["id", "file_set", "name", "path", "image", "pre_signed_post_data", "url"]
         read_only_fields = ["file_set"]
+        list_serializer_class = PreSignedUrlListSerializer
 
 
-class FileReadSerializer(serializers.ModelSerializer):
+class FileReadSerializer(PreSignedUrlMixin, serializers.ModelSerializer):
     url = serializers.SerializerMethodField(read_only=True)
 
     def get_url(self, instance):
-        return instance.get_pre_signed_url()
+        return self.get_pre_signed_url(instance)
 
     class Meta:
         model = File
         fields = ["id", "file_set", "name", "url"]
         read_only_fields = ["file_set", "name"]
+        list_serializer_class = PreSignedUrlListSerializer
 
 
 class FileSetCreateSerializer(serializers.ModelSerializer):
@@ -155,8 +191,7 @@ class FileSetCreateSerializer(serializers.ModelSerializer):
             if self.context["request"].data.get("use_case", None) is not None:
                 use_case = self.context["request"].data.get("use_case", None)
             else:
-                helpers_module = importlib.import_module("apps.classif_ai.helpers")
-                use_case = getattr(helpers_module, connection.tenant.schema_name + "_get_use_case_id")(data)
+                use_case = require_tenant_hook("get_use_case_id")(data)
             try:
                 data["upload_session_id"] = UploadSession.objects.get(is_live=True, use_case=use_case).id
             except UploadSession.DoesNotExist:
@@ -166,39 +201,24 @@ class FileSetCreateSerializer(serializers.ModelSerializer):
                 subscription_id = data["subscription"].id
             else:
                 subscription_id = self.instance.subscription_id
-            config = Subscription.objects.get(id=subscription_id).file_set_meta_info
-            helpers_module = importlib.import_module("apps.classif_ai.helpers")
-            try:
-                data = getattr(helpers_module, connection.tenant.schema_name + "_populate_meta_info")(data)
-            except AttributeError:
-                pass
+            populate_meta_info = get_tenant_hook("populate_meta_info")
+            if populate_meta_info is not None:
+                data = populate_meta_info(data)
             meta_info = data.get("meta_info", {})
-            sub_fields = {}
-            for field in config:
-                serializer_field = getattr(serializers, field["field_type"])
-                sub_fields[field["field"]] = serializer_field(**field["field_props"])
-
-            FileSetMetaInfoSerializer = type("FileSetMetaInfoSerializer", (serializers.Serializer,), sub_fields)
-            serializer_data = {}
-            for key, val in meta_info.items():
-                serializer_data[key] = val
-            serializer = FileSetMetaInfoSerializer(data=serializer_data)
-            unknown = set(serializer_data) - set(serializer.fields)
+            validator = get_file_set_meta_info_validator(subscription_id)
+            unknown = validator.unknown_fields(meta_info)
             if unknown:
                 raise ValidationError("Unknown field(s): {}".format(", ".join(unknown)))
+            serializer = validator.serializer(meta_info)
             if not serializer.is_valid():
                 raise ValidationError(serializer.errors)
         return data
 
     def create(self, validated_data):
         with transaction.atomic():
-            helpers_module = importlib.import_module("apps.classif_ai.helpers")
-            try:
-                validated_data = getattr(helpers_module, connection.tenant.schema_name + "_populate_meta_info")(
-                    validated_data
-                )
-            except AttributeError:
-                pass
+            populate_meta_info = get_tenant_hook("populate_meta_info")
+            if populate_meta_info is not None:
+                validated_data = populate_meta_info(validated_data)
             try:
                 files_data = validated_data.pop("files")
             except KeyError:
@@ -1001,12 +1021,13 @@ class TagSerializer(serializers.ModelSerializer):
         fields = ["id", "name", "description"]
 
 
-class WaferMapSerializer(serializers.ModelSerializer):
+class WaferMapSerializer(PreSignedUrlMixin, serializers.ModelSerializer):
     tags = TagSerializer(many=True, read_only=True)
     wafer_url = serializers.SerializerMethodField(read_only=True)
+    pre_signed_url_path_field = "image_path"
 
     def get_wafer_url(self, instance):
-        return instance.get_pre_signed_url()
+        return self.get_pre_signed_url(instance)
 
     def create(self, validated_data):
         image_path = (
@@ -1046,12 +1067,14 @@ class WaferMapSerializer(serializers.ModelSerializer):
             "coordinate_meta_info",
             "defect_pattern_info",
         ]
+        list_serializer_class = PreSignedUrlListSerializer
 
 
-class WaferMapReadSerializer(serializers.ModelSerializer):
+class WaferMapReadSerializer(PreSignedUrlMixin, serializers.ModelSerializer):
     total_images = serializers.SerializerMethodField(read_only=True)
     upload_session_name = serializers.SerializerMethodField(read_only=True)
     wafer_url = serializers.SerializerMethodField(read_only=True)
+    pre_signed_url_path_field = "image_path"
 
     def update(self, instance, validated_data):
         """[
@@ -1081,17 +1104,43 @@ class WaferMapReadSerializer(serializers.ModelSerializer):
         return instance
 
     def get_wafer_url(self, instance):
-        return instance.get_pre_signed_url()
+        return self.get_pre_signed_url(instance)
+
+    @staticmethod
+    def annotate_queryset(queryset):
+        """[annotates total_images and upload_session_name on the wafers, so that listing them takes a constant
+        number of queries]"""
+        return queryset.annotate(
+            total_images=Coalesce(
+                Subquery(
+                    File.objects.filter(file_set__wafer=OuterRef("pk"))
+                    .order_by()
+                    .values("file_set__wafer")
+                    .annotate(count=Count("id"))
+                    .values("count"),
+                    output_field=IntegerField(),
+                ),
+                0,
+            ),
+            upload_session_name=Subquery(
+                FileSet.objects.filter(wafer=OuterRef("pk")).order_by("id").values("upload_session__name")[:1]
+            ),
+        )
 
     def get_total_images(self, instance):
+        if hasattr(instance, "total_images"):
+            return instance.total_images
         return File.objects.filter(file_set__wafer=instance).count()
 
     def get_upload_session_name(self, instance):
+        if hasattr(instance, "upload_session_name"):
+            return instance.upload_session_name
         queryset = FileSet.objects.filter(wafer=instance).values_list("upload_session__name", flat=True)
         return queryset.first()
 
     class Meta:
         model = WaferMap
+        list_serializer_class = PreSignedUrlListSerializer
         fields = [
             "id",
             "organization_wafer_id",
@@ -8,6 +8,7 @@ from django.db.models.functions.comparison import Cast, Coalesce
 from django.db.models.query import QuerySet
 from django.db.models.query_utils import Q, FilteredRelation
 from apps.classif_ai.models import File, UseCase
+from apps.classif_ai.service import metric_rollup_service
 from apps.classif_ai.service.metrics_service import (
     ClasswiseMetrics,
     CommonMetrics,
@@ -376,8 +377,15 @@ def missclassification_defect_level(request: Dict) -> MissclassificationDefectLe
 
 
 def classwise_metrics_defect_level(request: Dict) -> ClasswiseMetricsDefectLevelResponse:
+    return ClasswiseMetricsDefectLevelResponse(classwise_distribution_defect_level(request), many=True).data[:]
+
+
+def classwise_distribution_defect_level(request: Dict) -> List[Dict]:
+    rollups = metric_rollup_service.get_rollups(request)
+    if rollups is not None:
+        return ClasswiseMetrics.defect_level_from_rollups(rollups)
     input_queryset = get_query_set(request)
-    return ClasswiseMetricsDefectLevelResponse(ClasswiseMetrics.defect_level(input_queryset), many=True).data[:]
+    return ClasswiseMetrics.defect_level(input_queryset)
 
 
 def classwise_metrics_use_case_level(request: Dict) -> ClasswiseMetricsUseCaseLevelResponse:
@@ -475,10 +483,16 @@ def auto_classification_metrics_use_case_on_wafer_timeseries(
 def auto_classification_metrics_use_case_on_file_timeseries(
     request: Dict,
 ) -> UseCaseAutoClassificationTimeSeriesResponse:
-    input_queryset = get_query_set(request)
-    use_case_data = DistributionMetrics.file_distribution(
-        input_queryset, group_by=["use_case_id", "effective_date"], order_by=["use_case_id", "effective_date"]
-    )
+    rollups = metric_rollup_service.get_rollups(request)
+    if rollups is not None:
+        use_case_data = DistributionMetrics.rollup_distribution(
+            rollups, group_by=["use_case_id", "effective_date"], order_by=["use_case_id", "effective_date"]
+        )
+    else:
+        input_queryset = get_query_set(request)
+        use_case_data = DistributionMetrics.file_distribution(
+            input_queryset, group_by=["use_case_id", "effective_date"], order_by=["use_case_id", "effective_date"]
+        )
     use_case_data = use_case_data.values(
         "use_case_id", "effective_date", "total", "auto_classified", "auto_classified_percentage"
     )
@@ -537,6 +551,14 @@ def distribution_metrics_use_case_on_wafer(request):
 
 
 def distribution_metrics_use_case_on_file(request):
+    rollups = metric_rollup_service.get_rollups(request)
+    if rollups is not None:
+        return DistributionMetrics.rollup_distribution(
+            rollups,
+            group_by=["use_case_id", "use_case_name", "ml_model_id", "ml_model_name"],
+            order_by=["accuracy_percentage"],
+            order="asc",
+        )
     input_queryset = get_query_set(request)
     distribution = DistributionMetrics.file_distribution(
         input_queryset,
@@ -583,8 +605,7 @@ def cohort_metrics_defect_level(request: Dict):
         del request.get("file_set_filters")["file_set__accuracy"]
     else:
         raise ValidationError("auto_classification or accuracy ranges are not present")
-    input_queryset = get_query_set(request)
-    distribution = ClasswiseMetrics.defect_level(input_queryset)
+    distribution = classwise_distribution_defect_level(request)
     cohorts = {}
     overall_count = 0
     for index in range(0, len(accuracy_ranges_list) - 1):
@@ -719,6 +740,9 @@ def accuracy_metrics(request):
         distribution = DistributionMetrics.file_distribution(input_queryset, group_by=["wafer_id", "wafer_threshold"])
         return DistributionMetrics.wafer_distribution(distribution)
     elif request.get("unit") == "file":
+        rollups = metric_rollup_service.get_rollups(request)
+        if rollups is not None:
+            return DistributionMetrics.rollup_distribution(rollups)
         input_queryset = get_query_set(request)
         distribution = DistributionMetrics.file_distribution(input_queryset)
         return distribution
@@ -0,0 +1,140 @@
+from typing import Dict, Iterable, List
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+
+from apps.classif_ai.models import (
+    GTClassification,
+    GTClassificationDefect,
+    GTDetection,
+    GTDetectionRegion,
+    GTDetectionRegionDefect,
+    UseCase,
+    UserClassification,
+    UserClassificationDefect,
+    UserDetection,
+    UserDetectionRegion,
+    UserDetectionRegionDefect,
+)
+from apps.classif_ai.service.metric_rollup_service import mark_files_stale
+
+### how are user annotations promoted to GT?
+# Same result as calling copy_to_gt on every user annotation, with a fixed number of queries per batch:
+# the GT rows of the files are kept (created if missing) and their is_no_defect is updated, all their defects /
+# regions are deleted with one query and recreated with bulk inserts.
+
+
+def validate_use_case_type(annotation_model, file_ids: Iterable[int], use_case_type: str) -> None:
+    """[raises ValidationError if any of the files doesn't belong to a use case of the given type, same check as
+    UserClassification.save / UserDetection.save with a single query for all the files]"""
+    other_type = (
+        UseCase.objects.filter(file_sets__files__id__in=list(file_ids))
+        .exclude(type=use_case_type)
+        .values_list("type", flat=True)
+        .first()
+    )
+    if other_type is not None:
+        raise ValidationError(
+            f"Can't create {annotation_model._meta.verbose_name} for a '{other_type}' use case type."
+        )
+
+
+def _upsert_gt(gt_model, is_no_defect_by_file_id: Dict[int, bool]) -> Dict[int, int]:
+    """[creates the missing GT rows of the files and sets is_no_defect on the existing ones,
+    returns {file_id: gt_id}]"""
+    gt_ids = dict(gt_model.objects.filter(file_id__in=is_no_defect_by_file_id).values_list("file_id", "id"))
+    for is_no_defect in (True, False):
+        gt_model.objects.filter(
+            id__in=[
+                gt_id for file_id, gt_id in gt_ids.items() if is_no_defect_by_file_id[file_id] is is_no_defect
+            ]
+        ).update(is_no_defect=is_no_defect)
+    created = gt_model.objects.bulk_create(
+        [
+            gt_model(file_id=file_id, is_no_defect=is_no_defect)
+            for file_id, is_no_defect in is_no_defect_by_file_id.items()
+            if file_id not in gt_ids
+        ]
+    )
+    gt_ids.update({gt.file_id: gt.id for gt in created})
+    return gt_ids
+
+
+def promote_user_classifications(user_classification_ids: Iterable[int]) -> None:
+    """[copies the given user classifications to GTClassification / GTClassificationDefect]"""
+    # a file has one GT, if several users annotated it the last user classification wins as it did with copy_to_gt
+    classification_ids_by_file_id = dict(
+        UserClassification.objects.filter(id__in=list(user_classification_ids)).values_list("file_id", "id")
+    )
+    if not classification_ids_by_file_id:
+        return
+    defect_ids_by_classification_id = {}
+    for classification_id, defect_id in UserClassificationDefect.objects.filter(
+        classification_id__in=classification_ids_by_file_id.values()
+    ).values_list("classification_id", "defect_id"):
+        defect_ids_by_classification_id.setdefault(classification_id, []).append(defect_id)
+    defect_ids_by_file_id = {
+        file_id: defect_ids_by_classification_id.get(classification_id, [])
+        for file_id, classification_id in classification_ids_by_file_id.items()
+    }
+    with transaction.atomic():
+        gt_ids = _upsert_gt(
+            GTClassification, {file_id: not defect_ids for file_id, defect_ids in defect_ids_by_file_id.items()}
+        )
+        GTClassificationDefect.objects.filter(classification_id__in=gt_ids.values()).delete()
+        GTClassificationDefect.objects.bulk_create(
+            [
+                GTClassificationDefect(classification_id=gt_ids[file_id], defect_id=defect_id)
+                for file_id, defect_ids in defect_ids_by_file_id.items()
+                for defect_id in defect_ids
+            ]
+        )
+        # update / bulk_create don't send post_save, the rollups are marked stale here instead
+        mark_files_stale(defect_ids_by_file_id.keys())
+
+
+def promote_user_detections(user_detection_ids: Iterable[int]) -> None:
+    """[copies the given user detections to GTDetection / GTDetectionRegion / GTDetectionRegionDefect]"""
+    # a file has one GT, if several users annotated it the last user detection wins as it did with copy_to_gt
+    user_detections = {
+        user_detection["file_id"]: user_detection
+        for user_detection in UserDetection.objects.filter(id__in=list(user_detection_ids)).values(
+            "id", "file_id", "is_no_defect"
+        )
+    }.values()
+    if not user_detections:
+        return
+    detection_ids_with_defects = [
+        user_detection["id"] for user_detection in user_detections if user_detection["is_no_defect"] is False
+    ]
+    user_regions = list(
+        UserDetectionRegion.objects.filter(detection_id__in=detection_ids_with_defects).values(
+            "id", "detection__file_id", "region"
+        )
+    )
+    defect_ids_by_region_id = {}
+    for region_id, defect_id in UserDetectionRegionDefect.objects.filter(
+        detection_region_id__in=[user_region["id"] for user_region in user_regions]
+    ).values_list("detection_region_id", "defect_id"):
+        defect_ids_by_region_id.setdefault(region_id, []).append(defect_id)
+    with transaction.atomic():
+        gt_ids = _upsert_gt(
+            GTDetection,
+            {user_detection["file_id"]: user_detection["is_no_defect"] for user_detection in user_detections},
+        )
+        GTDetectionRegion.objects.filter(detection_id__in=gt_ids.values()).delete()
+        gt_regions: List[GTDetectionRegion] = GTDetectionRegion.objects.bulk_create(
+            [
+                GTDetectionRegion(
+                    detection_id=gt_ids[user_region["detection__file_id"]], region=user_region["region"]
+                )
+                for user_region in user_regions
+            ]
+        )
+        GTDetectionRegionDefect.objects.bulk_create(
+            [
+                GTDetectionRegionDefect(detection_region=gt_region, defect_id=defect_id)
+                for user_region, gt_region in zip(user_regions, gt_regions)
+                for defect_id in defect_ids_by_region_id.get(user_region["id"], [])
+            ]
+        )
@@ -0,0 +1,261 @@
+from datetime import date, time, timedelta
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.db.models.fields import DateField
+from django.db.models.functions import Cast, TruncDate, TruncDay
+from django.db.models.query import QuerySet
+from django.utils import timezone
+
+from apps.classif_ai.models import ClassificationMetricRollup, File, StaleClassificationMetricRollup
+from apps.classif_ai.tasks import refresh_classification_metric_rollups
+
+### what is rolled up?
+# ClassificationMetricRollup keeps, per (day, use case, model, gt defect, model defect), the counts the file level
+# distribution metrics are made of: total, auto_classified, audited and accurate (missed = audited - accurate).
+# The day is the creation date of the file. A (day, use case) slice is always rebuilt as a whole from the
+# classification tables, so the rollups can't drift from the source data.
+
+### how is it kept up to date?
+# Every change of a GT / model classification marks the (day, use case) slice of the file stale, once the change is
+# committed. Saves are caught by post_save, the bulk writes and deletes mark their files stale explicitly, and a change
+# of an ml model's confidence threshold marks all the slices of the model. The first change marking a slice stale
+# queues refresh_classification_metric_rollups, which rebuilds all the stale slices together after
+# CLASSIFICATION_METRIC_ROLLUP_REFRESH_DELAY seconds.
+
+RollupSlice = Tuple[date, int]
+REQUEST_TIME_TOLERANCE = timedelta(minutes=1)
+
+# request filters the rollups can answer, anything else is served from the classification tables
+ROLLUP_FILE_SET_FILTERS = {
+    "file_set__created_ts__gte",
+    "file_set__created_ts__lte",
+    "file_set__use_case__type__in",
+    "file_set__use_case__in",
+}
+
+
+def file_rollup_slices(file_ids: Iterable[int]) -> Set[RollupSlice]:
+    """[returns the (day, use case) rollup slices the given files belong to]"""
+    return set(
+        File.objects.filter(id__in=list(file_ids), file_set__use_case__type="CLASSIFICATION")
+        .annotate(date=TruncDate("created_ts"))
+        .values_list("date", "file_set__use_case_id")
+        .distinct()
+    )
+
+
+def mark_files_stale(file_ids: Iterable[int]) -> None:
+    """[marks the rollups of the given files stale once the current transaction is committed]"""
+    if not settings.CLASSIFICATION_METRIC_ROLLUPS_ENABLED:
+        return
+    # the slices are resolved right away, the files may not exist anymore after the commit
+    slices = file_rollup_slices(file_ids)
+    if slices:
+        transaction.on_commit(lambda: mark_stale(slices))
+
+
+def mark_ml_model_stale(ml_model_id: int) -> None:
+    """[marks the rollups of the ml model stale once the current transaction is committed]"""
+    if not settings.CLASSIFICATION_METRIC_ROLLUPS_ENABLED:
+        return
+    slices = set(
+        ClassificationMetricRollup.objects.filter(ml_model_id=ml_model_id).values_list("date", "use_case_id").distinct()
+    )
+    if slices:
+        transaction.on_commit(lambda: mark_stale(slices))
+
+
+def mark_stale(slices: Set[RollupSlice]) -> None:
+    """[marks the given slices stale and queues the rollup refresh if any of them wasn't already waiting for one]"""
+    sql = """
+        insert into {} (date, use_case_id, created_ts)
+        values {}
+        on conflict (date, use_case_id) do nothing
+        returning id
+    """.format(
+        StaleClassificationMetricRollup._meta.db_table, ", ".join(["(%s, %s, now())"] * len(slices))
+    )
+    params = [value for rollup_slice in slices for value in rollup_slice]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        newly_stale = cursor.fetchall()
+    if newly_stale:
+        refresh_classification_metric_rollups.apply_async(
+            kwargs={"schema": connection.tenant.schema_name},
+            countdown=settings.CLASSIFICATION_METRIC_ROLLUP_REFRESH_DELAY,
+        )
+
+
+def refresh_stale_rollups() -> int:
+    """[rebuilds the rollups of all the stale slices, returns the number of slices rebuilt]"""
+    with transaction.atomic():
+        # rows are locked by the delete, a concurrent refresh waits and then finds nothing left to rebuild
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "delete from {} returning date, use_case_id".format(StaleClassificationMetricRollup._meta.db_table)
+            )
+            slices = set(cursor.fetchall())
+        refresh_rollups(slices)
+    return len(slices)
+
+
+def refresh_rollups(slices: Set[RollupSlice]) -> None:
+    """[rebuilds the rollups of the given (day, use case) slices]"""
+    if not slices:
+        return
+    rollup_filter = Q()
+    file_filter = Q()
+    for rollup_date, use_case_id in slices:
+        rollup_filter |= Q(date=rollup_date, use_case_id=use_case_id)
+        file_filter |= Q(created_ts__date=rollup_date, file_set__use_case_id=use_case_id)
+    with transaction.atomic():
+        ClassificationMetricRollup.objects.filter(rollup_filter).delete()
+        _insert_rollups(rollup_source_queryset(file_filter))
+
+
+def rebuild_rollups(date__gte: Optional[date] = None) -> None:
+    """[rebuilds all the rollups of the current tenant, or only the ones from date__gte onwards]"""
+    rollup_filter = Q()
+    file_filter = Q()
+    if date__gte is not None:
+        rollup_filter = Q(date__gte=date__gte)
+        file_filter = Q(created_ts__date__gte=date__gte)
+    with transaction.atomic():
+        ClassificationMetricRollup.objects.filter(rollup_filter).delete()
+        _insert_rollups(rollup_source_queryset(file_filter))
+
+
+def rollup_source_queryset(file_filter: Q) -> QuerySet:
+    """[same rows as classification_service.get_query_set, limited to the columns the rollups are made of]"""
+    return (
+        File.objects.filter(
+            file_filter & Q(model_classifications__isnull=False, file_set__use_case__type="CLASSIFICATION")
+        )
+        .annotate(
+            file_id=F("id"),
+            effective_date=Cast(TruncDay("created_ts"), DateField()),
+            use_case_id=F("file_set__use_case_id"),
+            ml_model_id=F("model_classifications__ml_model_id"),
+            gt_classification=F("gt_classifications"),
+            gt_defect_id=F("gt_classifications__gt_classification_annotations__defect_id"),
+            model_defect_id=F("model_classifications__model_classification_annotations__defect_id"),
+            confidence=F("model_classifications__model_classification_annotations__confidence"),
+            confidence_threshold=F("model_classifications__ml_model__confidence_threshold"),
+        )
+        .values(
+            "file_id",
+            "effective_date",
+            "use_case_id",
+            "ml_model_id",
+            "gt_classification",
+            "gt_defect_id",
+            "model_defect_id",
+            "confidence",
+            "confidence_threshold",
+        )
+        .distinct()
+    )
+
+
+def _insert_rollups(source_queryset: QuerySet) -> None:
+    sql, params = source_queryset.query.sql_with_params()
+    output_sql = """
+        insert into {} (
+            date, use_case_id, ml_model_id, gt_defect_id, model_defect_id,
+            total_count, auto_classified_count, audited_count, accurate_count, updated_ts
+        )
+        select
+            effective_date, use_case_id, ml_model_id, gt_defect_id, model_defect_id,
+            count(*),
+            count(*) filter(where confidence_threshold <= confidence),
+            count(*) filter(where confidence_threshold <= confidence and gt_classification is not null),
+            count(*) filter(
+                where confidence_threshold <= confidence
+                and gt_classification is not null
+                and gt_defect_id = model_defect_id
+            ),
+            now()
+        from ({}) "table"
+        group by effective_date, use_case_id, ml_model_id, gt_defect_id, model_defect_id
+    """.format(
+        ClassificationMetricRollup._meta.db_table, sql
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(output_sql, params)
+
+
+def rollup_filter(request: Dict) -> Optional[Q]:
+    """[translates the metrics request into a filter on the rollups,
+    returns None if the request has filters the rollups can't answer]"""
+    if not settings.CLASSIFICATION_METRIC_ROLLUPS_ENABLED:
+        return None
+    file_set_filters = request.get("file_set_filters") or {}
+    ml_model_filters = request.get("ml_model_filters") or {}
+    if set(file_set_filters.keys()) - ROLLUP_FILE_SET_FILTERS:
+        return None
+    if list(file_set_filters.get("file_set__use_case__type__in", ["CLASSIFICATION"])) != ["CLASSIFICATION"]:
+        return None
+    # the rollups are per model, picking the latest classification of every file (a subquery) can't be rolled up
+    if set(ml_model_filters.keys()) != {"model_classifications__ml_model__in"}:
+        return None
+    ml_model_ids = ml_model_filters["model_classifications__ml_model__in"]
+    if not isinstance(ml_model_ids, (list, tuple)):
+        return None
+    date_filter = rollup_date_filter(
+        file_set_filters.get("file_set__created_ts__gte"), file_set_filters.get("file_set__created_ts__lte")
+    )
+    if date_filter is None:
+        return None
+    query = Q(ml_model_id__in=ml_model_ids) & date_filter
+    if file_set_filters.get("file_set__use_case__in") is not None:
+        query &= Q(use_case_id__in=file_set_filters.get("file_set__use_case__in"))
+    return query
+
+
+def rollup_date_filter(date__gte, date__lte) -> Optional[Q]:
+    """[translates the created_ts range into a range of whole days, returns None if it doesn't fall on day boundaries]
+
+    The rollups are dated by the file's creation, the request filters on the file set's creation. Files are created
+    along with their file set, so the two only differ for file sets created right before midnight.
+    """
+    query = Q()
+    if date__gte is not None:
+        date__gte = _aware(date__gte)
+        if date__gte.time() != time(0):
+            return None
+        query &= Q(date__gte=date__gte.date())
+    if date__lte is not None:
+        date__lte = _aware(date__lte)
+        if date__lte.time() == time(0):
+            query &= Q(date__lt=date__lte.date())
+        elif date__lte >= timezone.now() - REQUEST_TIME_TOLERANCE:
+            # the default upper bound is the time of the request, i.e. everything up to now
+            query &= Q(date__lte=date__lte.date())
+        else:
+            return None
+    return query
+
+
+def _aware(value):
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value)
+    return timezone.localtime(value)
+
+
+def get_rollups(request: Dict) -> Optional[QuerySet]:
+    """[rollups matching the request with the columns the metrics group on, None if the request can't be served
+    from the rollups]"""
+    query = rollup_filter(request)
+    if query is None:
+        return None
+    time_function = request.get("time_function") or TruncDay
+    return ClassificationMetricRollup.objects.filter(query).annotate(
+        effective_date=Cast(time_function("date"), DateField()),
+        use_case_name=F("use_case__name"),
+        ml_model_name=F("ml_model__name"),
+        gt_defect_name=F("gt_defect__name"),
+        model_defect_name=F("model_defect__name"),
+    )
@@ -111,6 +111,75 @@ class ClasswiseMetrics:
             del output[None]
         return list(output.values())
 
+    @staticmethod
+    def defect_level_from_rollups(input_queryset: QuerySet) -> List[Dict]:
+        """[classwise data at defect level calculated from the daily classification metric rollups]
+
+        Args:
+            input_queryset ([QuerySet]): [rollups annotated with 'gt_defect_name' and 'model_defect_name']
+
+        Returns:
+            [List[Dict]]: [same output as defect_level]
+        """
+        rows = input_queryset.values(
+            "gt_defect_id", "gt_defect_name", "model_defect_id", "model_defect_name"
+        ).annotate(total=Sum("total_count"), auto_classified=Sum("auto_classified_count"))
+        output = {}
+        gt_defect_ids = set()
+        for row in rows:
+            gt_defect_id = row.get("gt_defect_id")
+            model_defect_id = row.get("model_defect_id")
+            for defect_id, defect_name in [
+                (gt_defect_id, row.get("gt_defect_name")),
+                (model_defect_id, row.get("model_defect_name")),
+            ]:
+                if output.get(defect_id) is None:
+                    output[defect_id] = {
+                        "gt_defect_id": defect_id,
+                        "gt_defect_name": defect_name,
+                        "accurate": 0,
+                        "auto_classified": 0,
+                        "missed": 0,
+                        "extra": 0,
+                        "total": 0,
+                        "total_gt_defects": 0,
+                        "total_model_defects": 0,
+                    }
+            gt_defect_ids.add(gt_defect_id)
+            auto_classified = row.get("auto_classified") or 0
+            output.get(gt_defect_id)["total"] += row.get("total") or 0
+            output.get(gt_defect_id)["auto_classified"] += auto_classified
+            if gt_defect_id is not None:
+                output.get(gt_defect_id)["total_gt_defects"] += auto_classified
+            if model_defect_id is not None:
+                output.get(model_defect_id)["total_model_defects"] += auto_classified
+            if gt_defect_id == model_defect_id:
+                output.get(gt_defect_id)["accurate"] += auto_classified
+            else:
+                output.get(gt_defect_id)["missed"] += auto_classified
+                output.get(model_defect_id)["extra"] += auto_classified
+        for gt_defect_id in gt_defect_ids:
+            defect = output.get(gt_defect_id)
+            if defect.get("total") > 0:
+                defect["auto_classified_percentage"] = round(
+                    100 * defect.get("auto_classified") / defect.get("total"), 0
+                )
+            if defect.get("auto_classified") > 0:
+                defect["accuracy_percentage"] = round(100 * defect.get("accurate") / defect.get("auto_classified"), 0)
+                defect["missed_percentage"] = round(100 * defect.get("missed") / defect.get("auto_classified"), 0)
+            model_predicted = defect.get("extra") + defect.get("accurate")
+            if model_predicted > 0:
+                defect["extra_percentage"] = round(100 * defect.get("extra") / model_predicted, 0)
+            if defect.get("total_gt_defects") > 0:
+                defect["recall_percentage"] = round(100 * defect.get("accurate") / defect.get("total_gt_defects"), 0)
+            if defect.get("total_model_defects") > 0:
+                defect["precision_percentage"] = round(
+                    100 * defect.get("accurate") / defect.get("total_model_defects"), 0
+                )
+        if output.get(None) is not None:
+            del output[None]
+        return list(output.values())
+
     @staticmethod
     def use_case_level(input_queryset: QuerySet) -> List[Dict]:
         """[classwise data at use case level]
@@ -696,6 +765,35 @@ class DistributionMetrics:
                 )
             ),
         }
+        return DistributionMetrics.aggregate_distribution(
+            input_queryset, aggregated_query, group_by, order_by, order, nulls_first
+        )
+
+    @staticmethod
+    def rollup_distribution(
+        input_queryset: QuerySet, group_by=None, order_by=None, order=None, nulls_first=True
+    ) -> List[Dict]:
+        """file_distribution calculated from the daily classification metric rollups"""
+        total = Coalesce(Sum("total_count"), 0)
+        auto_classified = Coalesce(Sum("auto_classified_count"), 0)
+        audited = Coalesce(Sum("audited_count"), 0)
+        accurate = Coalesce(Sum("accurate_count"), 0)
+        aggregated_query = {
+            "total": total,
+            "auto_classified": auto_classified,
+            "manual": total - auto_classified,
+            "auto_classified_percentage": Round((100 * Cast(auto_classified, FloatField())) / NullIf(total, 0)),
+            "audited": audited,
+            "accurate": accurate,
+            "inaccurate": audited - accurate,
+            "accuracy_percentage": Round((100 * Cast(accurate, FloatField())) / NullIf(audited, 0)),
+        }
+        return DistributionMetrics.aggregate_distribution(
+            input_queryset, aggregated_query, group_by, order_by, order, nulls_first
+        )
+
+    @staticmethod
+    def aggregate_distribution(input_queryset: QuerySet, aggregated_query, group_by, order_by, order, nulls_first):
         if group_by is not None:
             input_queryset = input_queryset.values(*group_by).annotate(**aggregated_query)
         else:
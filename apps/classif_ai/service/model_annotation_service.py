@@ -0,0 +1,159 @@
+from typing import Dict, Iterable, List, Tuple
+
+from django.contrib.gis.geos import Polygon
+from django.db import transaction
+
+from apps.classif_ai.models import (
+    Defect,
+    ModelClassification,
+    ModelClassificationDefect,
+    ModelDetection,
+    ModelDetectionRegion,
+    ModelDetectionRegionDefect,
+)
+from apps.classif_ai.service.metric_rollup_service import mark_files_stale
+
+
+def region_to_polygon(coordinates: Dict) -> Polygon:
+    minx = coordinates["x"]
+    miny = coordinates["y"]
+    maxx = coordinates["x"] + coordinates["w"]
+    maxy = coordinates["y"] + coordinates["h"]
+    return Polygon(((minx, miny), (minx, maxy), (maxx, maxy), (maxx, miny), (minx, miny)))
+
+
+def iterate_defects(defects) -> Iterable[Tuple[int, object]]:
+    """[yields (defect_id, confidence) from either the inference output format {"<defect_id>": {"confidence": 0.8}}
+    or the api format [{"defect_id": 1, "confidence": 0.8}]]"""
+    if isinstance(defects, dict):
+        for defect_id, info in defects.items():
+            yield int(defect_id), info["confidence"]
+    else:
+        for defect in defects:
+            yield int(defect["defect_id"]), defect["confidence"]
+
+
+class ModelAnnotationBulkWriter:
+    """
+    [Writes the model annotations (classifications / detections) of many files with one bulk insert per table inside
+    a single transaction. The defects are resolved with a single query for the whole batch.]
+
+    Args:
+        ml_model_id: id of the model whose output is being written
+    """
+
+    def __init__(self, ml_model_id: int):
+        self.ml_model_id = ml_model_id
+
+    @staticmethod
+    def organization_defect_codes(defect_ids) -> Dict[int, str]:
+        return dict(Defect.objects.filter(id__in=set(defect_ids)).values_list("id", "organization_defect_code"))
+
+    @staticmethod
+    def add_organization_defect_codes(files: List[Dict], defect_codes: Dict[int, str]) -> None:
+        for file in files:
+            for file_region in file["file_regions"]:
+                if not isinstance(file_region["defects"], dict):
+                    continue
+                for defect_id, info in file_region["defects"].items():
+                    organization_defect_code = defect_codes.get(int(defect_id), None)
+                    if organization_defect_code:
+                        info["organization_defect_code"] = organization_defect_code
+
+    def write_classifications(self, files: List[Dict]) -> List[Dict]:
+        """[creates the ModelClassification and ModelClassificationDefect rows for the given inference output files]
+
+        Args:
+            files (List[Dict]): [{"id": <file_id>, "file_regions": [{"defects": {"<defect_id>": {"confidence": 0.8}}}]}]
+
+        Returns:
+            List[Dict]: the input files with organization_defect_code added to every defect that has one
+        """
+        defect_ids = set()
+        with transaction.atomic():
+            classifications = ModelClassification.objects.bulk_create(
+                [
+                    ModelClassification(
+                        file_id=file["id"], ml_model_id=self.ml_model_id, is_no_defect=len(file["file_regions"]) == 0
+                    )
+                    for file in files
+                ]
+            )
+            classification_defects = []
+            for classification, file in zip(classifications, files):
+                for file_region in file["file_regions"]:
+                    for defect_id, confidence in iterate_defects(file_region["defects"]):
+                        defect_ids.add(defect_id)
+                        classification_defects.append(
+                            ModelClassificationDefect(
+                                classification=classification, defect_id=defect_id, confidence=confidence
+                            )
+                        )
+            ModelClassificationDefect.objects.bulk_create(classification_defects)
+            # bulk_create doesn't send post_save, the rollups are marked stale here instead
+            mark_files_stale([file["id"] for file in files])
+            self.add_organization_defect_codes(files, self.organization_defect_codes(defect_ids))
+        return files
+
+    def write_detections(self, files: List[Dict]) -> List[Dict]:
+        """[creates the ModelDetection, ModelDetectionRegion and ModelDetectionRegionDefect rows for the given
+        inference output files]
+
+        Args:
+            files (List[Dict]): [{"id": <file_id>, "file_regions": [{"region": {"coordinates": {x, y, w, h}},
+                "defects": {"<defect_id>": {"confidence": 0.8}}, "model_output_meta_info": {}}]}]
+
+        Returns:
+            List[Dict]: the input files with organization_defect_code added to every defect that has one
+        """
+        with transaction.atomic():
+            detections = ModelDetection.objects.bulk_create(
+                [
+                    ModelDetection(
+                        file_id=file["id"], ml_model_id=self.ml_model_id, is_no_defect=len(file["file_regions"]) == 0
+                    )
+                    for file in files
+                ]
+            )
+            defect_ids = self.write_detection_regions(
+                [(detection, file["file_regions"]) for detection, file in zip(detections, files)]
+            )
+            self.add_organization_defect_codes(files, self.organization_defect_codes(defect_ids))
+        return files
+
+    @staticmethod
+    def write_detection_regions(detections_with_regions: List[Tuple[ModelDetection, List[Dict]]]) -> set:
+        """[creates the regions and the region defects of already saved detections]
+
+        Args:
+            detections_with_regions: [(ModelDetection, [{"region": {"coordinates": {}}, "defects": ...}])]
+
+        Returns:
+            set: ids of all the defects written
+        """
+        detection_regions = []
+        region_defects = []
+        for detection, file_regions in detections_with_regions:
+            for file_region in file_regions:
+                detection_regions.append(
+                    ModelDetectionRegion(
+                        detection=detection,
+                        region=region_to_polygon(file_region["region"]["coordinates"]),
+                        model_output_meta_info=file_region.get("model_output_meta_info", {}),
+                    )
+                )
+                region_defects.append(list(iterate_defects(file_region["defects"])))
+        with transaction.atomic():
+            detection_regions = ModelDetectionRegion.objects.bulk_create(detection_regions)
+            detection_region_defects = []
+            defect_ids = set()
+            for detection_region, defects in zip(detection_regions, region_defects):
+                for defect_id, confidence in defects:
+                    defect_ids.add(defect_id)
+                    detection_region_defects.append(
+                        ModelDetectionRegionDefect(
+                            detection_region=detection_region, defect_id=defect_id, confidence=confidence
+                        )
+                    )
+            ModelDetectionRegionDefect.objects.bulk_create(detection_region_defects)
+        return defect_ids
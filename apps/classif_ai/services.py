@@ -6,30 +6,31 @@ import os
 import shutil
 import sys
 import tempfile
+import time
 import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
 from functools import reduce
 from operator import ior
 
-import boto3
 import requests
-from django.contrib.gis.geos import Polygon
 from django.contrib.postgres.aggregates.general import ArrayAgg
-from django.contrib.postgres.fields.jsonb import KeyTextTransform
+from django.contrib.postgres.fields.jsonb import KeyTextTransform, KeyTransform
 from django.core.exceptions import ValidationError
 from django.db import transaction, connection
 from django.db.models import Count
 from django.db.models import Q, Min
 from django.db.models.functions import TruncWeek, TruncMonth, TruncDay
+from django.utils import timezone
 from sixsense.settings import IMAGE_HANDLER_QUEUE_URL, INFERENCE_QUEUE_REGION
 
 from apps.classif_ai.helpers import (
     build_query,
-    calculate_iou,
     inference_output_queue,
     is_same_region,
     convert_datetime_to_str,
-    get_env,
+    get_ordered_defect_ids,
+    get_time_function,
     create_celery_format_message,
 )
 from apps.classif_ai.models import (
@@ -44,11 +45,6 @@ from apps.classif_ai.models import (
     MlModelDeploymentHistory,
     UploadSession,
     TrainingSession,
-    ModelClassification,
-    ModelDetection,
-    ModelClassificationDefect,
-    ModelDetectionRegion,
-    ModelDetectionRegionDefect,
     UserClassification,
     UserClassificationDefect,
     UserDetection,
@@ -59,8 +55,17 @@ from apps.classif_ai.models import (
     GTDetection,
     WaferMap,
 )
+from apps.classif_ai.region_matching import RegionMatcher
+from apps.classif_ai.service.gt_promotion_service import (
+    promote_user_classifications,
+    promote_user_detections,
+    validate_use_case_type,
+)
+from apps.classif_ai.service.metric_rollup_service import mark_files_stale
+from apps.classif_ai.service.model_annotation_service import ModelAnnotationBulkWriter
 from apps.classif_ai.serializers import FileSetCreateSerializer
-from common.services import S3Service
+from apps.classif_ai.tasks import perform_file_set_inference
+from common.services import S3Service, get_boto3_client
 from sixsense import settings
 from sixsense.settings import (
     GF7_DATA_PREP_PATH,
@@ -77,33 +82,15 @@ logger = logging.getLogger(__name__)
 class FileRegionService:
     def find_matching_region(self, source_regions, target_region, model_type):
         matching_region = None
-        for source_region in source_regions:
-            if model_type == "CLASSIFICATION":
+        if model_type == "CLASSIFICATION":
+            for source_region in source_regions:
                 if list(target_region.defects)[0] == list(source_region.defects)[0]:
-                    matching_region = [source_region, None]
-            else:
-                iou = calculate_iou(
-                    [
-                        source_region.region["coordinates"]["x"],
-                        source_region.region["coordinates"]["y"],
-                        source_region.region["coordinates"]["x"] + source_region.region["coordinates"]["w"],
-                        source_region.region["coordinates"]["y"] + source_region.region["coordinates"]["h"],
-                    ],
-                    [
-                        target_region.region["coordinates"]["x"],
-                        target_region.region["coordinates"]["y"],
-                        target_region.region["coordinates"]["x"] + target_region.region["coordinates"]["w"],
-                        target_region.region["coordinates"]["y"] + target_region.region["coordinates"]["h"],
-                    ],
-                )
-                if iou > FileRegion.IOU_THRESHOLD_FOR_DETECTION_CORRECTNESS:
-                    if matching_region:
-                        if matching_region[1] < iou:
-                            matching_region = [source_region, iou]
-                    else:
-                        matching_region = [source_region, iou]
-        if matching_region:
-            return matching_region[0]
+                    matching_region = source_region
+        else:
+            matching_region, _ = RegionMatcher(source_regions).best_match(
+                target_region.region, FileRegion.IOU_THRESHOLD_FOR_DETECTION_CORRECTNESS
+            )
+        return matching_region
 
 
 class CopyFeedbackService:
@@ -244,63 +231,17 @@ class InferenceService:
                 headers={"Content-Type": "application/json"},
             ).json()
         else:
-            if (
-                MlModel.models.get(connection.tenant.schema_name, None) is None
-                or MlModel.models[connection.tenant.schema_name].get(ml_model.id, None) is None
-            ):
-                MlModel.load_model(ml_model.id)
-            model_output: dict = MlModel.models[connection.tenant.schema_name][ml_model.id].predict(file_set_data.data)
+            model_output: dict = MlModel.get_loaded_model(ml_model.id).predict(file_set_data.data)
         logger.info("model Output:")
         logger.info(model_output)
         return model_output
 
     def create_classification_ml_model_annotations(self, model_output: dict):
-        for file in model_output["files"]:
-            is_no_defect = False
-            if len(file["file_regions"]) == 0:
-                is_no_defect = True
-            classification = ModelClassification.objects.create(
-                file_id=file["id"], ml_model_id=self.ml_model_id, is_no_defect=is_no_defect
-            )
-            for file_region in file["file_regions"]:
-                for defect_id, info in file_region["defects"].items():
-                    saved_classification = ModelClassificationDefect.objects.create(
-                        classification=classification, defect_id=defect_id, confidence=info["confidence"]
-                    )
-                    organization_defect_code = saved_classification.defect.organization_defect_code
-                    if organization_defect_code:
-                        file_region["defects"][defect_id]["organization_defect_code"] = organization_defect_code
+        ModelAnnotationBulkWriter(self.ml_model_id).write_classifications(model_output["files"])
         return model_output
 
     def create_detection_ml_model_annotations(self, model_output: dict):
-        for file in model_output["files"]:
-            is_no_defect = False
-            if len(file["file_regions"]) == 0:
-                is_no_defect = True
-            detection = ModelDetection.objects.create(
-                file_id=file["id"], ml_model_id=self.ml_model_id, is_no_defect=is_no_defect
-            )
-            for file_region in file["file_regions"]:
-                coordinates = file_region["region"]["coordinates"]
-                minx = coordinates["x"]
-                miny = coordinates["y"]
-                maxx = coordinates["x"] + coordinates["w"]
-                maxy = coordinates["y"] + coordinates["h"]
-                detection_region = ModelDetectionRegion.objects.create(
-                    detection=detection,
-                    region=Polygon(
-                        ((minx, miny), (minx, maxy), (maxx, maxy), (maxx, miny), (minx, miny)),
-                    ),
-                    model_output_meta_info=file_region.get("model_output_meta_info", {}),
-                )
-                for defect_id, info in file_region["defects"].items():
-                    saved_detection_defect = ModelDetectionRegionDefect.objects.create(
-                        detection_region=detection_region, defect_id=defect_id, confidence=info["confidence"]
-                    )
-                    organization_defect_code = saved_detection_defect.defect.organization_defect_code
-                    if organization_defect_code:
-                        file_region["defects"][defect_id]["organization_defect_code"] = organization_defect_code
-
+        ModelAnnotationBulkWriter(self.ml_model_id).write_detections(model_output["files"])
         return model_output
 
     def validate(self):
@@ -344,7 +285,7 @@ class InferenceService:
         s3_service.upload_file(temp_file.name, s3_key)
         return s3_key
 
-    def perform_sagemaker_async_inference(self):
+    def sagemaker_async_inference_message(self):
         file_set_serializer = FileSetCreateSerializer(instance=self.file_set())
         file_set_data = file_set_serializer.data
         body = {
@@ -362,8 +303,11 @@ class InferenceService:
             "defect_pattern_info": self.file_set().wafer.defect_pattern_info if self.file_set().wafer else None,
         }
         # ToDo: Use celery signature to push the message instead of manually creating the message
-        message = create_celery_format_message("main.run_inference", args=[json.dumps(body)])
-        client = boto3.client("sqs", region_name=INFERENCE_QUEUE_REGION)
+        return create_celery_format_message("main.run_inference", args=[json.dumps(body)])
+
+    def perform_sagemaker_async_inference(self):
+        message = self.sagemaker_async_inference_message()
+        client = get_boto3_client("sqs", region_name=INFERENCE_QUEUE_REGION)
         try:
             resp = client.send_message(
                 QueueUrl=INFERENCE_QUEUE,
@@ -447,6 +391,93 @@ class InferenceService:
                 raise e
 
 
+class InferenceDispatchService:
+    # SQS accepts at most 10 messages in a single send_message_batch call.
+    SQS_BATCH_SIZE = 10
+
+    def __init__(self, file_set_inference_queue_ids):
+        self.file_set_inference_queue_ids = file_set_inference_queue_ids
+
+    def pending_queues(self):
+        return (
+            FileSetInferenceQueue.objects.filter(id__in=self.file_set_inference_queue_ids, status="PENDING")
+            .select_related("ml_model__use_case")
+            .order_by("id")
+        )
+
+    def dispatch(self):
+        """publishes the pending file set inference queues to the inference workers.
+
+        Returns:
+            dict: {"dispatched": int, "failed": int}
+        """
+        if INFERENCE_METHOD == "SAGEMAKER_ASYNC":
+            return self.publish_to_sqs()
+        dispatched = 0
+        for queue in self.pending_queues().iterator():
+            perform_file_set_inference.delay(
+                file_set_id=queue.file_set_id, ml_model_id=queue.ml_model_id, schema=connection.schema_name
+            )
+            dispatched += 1
+        return {"dispatched": dispatched, "failed": 0}
+
+    def publish_to_sqs(self):
+        client = get_boto3_client("sqs", region_name=INFERENCE_QUEUE_REGION)
+        queues = list(self.pending_queues())
+        dispatched = 0
+        failed = 0
+        for start in range(0, len(queues), self.SQS_BATCH_SIZE):
+            entries = {}
+            failed_queues = []
+            for queue in queues[start : start + self.SQS_BATCH_SIZE]:
+                inference_service = InferenceService(ml_model_id=queue.ml_model_id, file_set_id=queue.file_set_id)
+                inference_service._ml_model = queue.ml_model
+                inference_service._file_set_inference_queue = queue
+                try:
+                    entries[str(queue.id)] = (queue, inference_service.sagemaker_async_inference_message())
+                except Exception as e:
+                    logger.error(f"Could not prepare the inference message of file set inference queue {queue.id}: {e}")
+                    failed_queues.append(queue)
+            successful_queues = []
+            if entries:
+                try:
+                    response = client.send_message_batch(
+                        QueueUrl=INFERENCE_QUEUE,
+                        Entries=[
+                            {"Id": entry_id, "MessageBody": message} for entry_id, (_, message) in entries.items()
+                        ],
+                    )
+                    results = [(item["Id"], item["MessageId"]) for item in response.get("Successful", [])]
+                    results.extend((item["Id"], None) for item in response.get("Failed", []))
+                except client.exceptions.BatchRequestTooLong:
+                    # The combined payload is above the SQS limit, fall back to one message per queue.
+                    results = []
+                    for entry_id, (_, message) in entries.items():
+                        try:
+                            response = client.send_message(QueueUrl=INFERENCE_QUEUE, MessageBody=message)
+                            results.append((entry_id, response["MessageId"]))
+                        except (client.exceptions.InvalidMessageContents, client.exceptions.UnsupportedOperation):
+                            results.append((entry_id, None))
+                for entry_id, message_id in results:
+                    queue = entries[entry_id][0]
+                    if message_id is None:
+                        failed_queues.append(queue)
+                    else:
+                        queue.status = "PROCESSING"
+                        queue.inference_id = message_id
+                        successful_queues.append(queue)
+            for queue in failed_queues:
+                queue.status = "FAILED"
+            for queue in successful_queues + failed_queues:
+                queue.updated_ts = timezone.now()
+            FileSetInferenceQueue.objects.bulk_update(
+                successful_queues + failed_queues, ["status", "inference_id", "updated_ts"]
+            )
+            dispatched += len(successful_queues)
+            failed += len(failed_queues)
+        return {"dispatched": dispatched, "failed": failed}
+
+
 class AnalysisService:
     def __init__(self, file_set_filters=None, ml_model_filters=None, auto_model=False):
         self._auto_model = auto_model
@@ -463,6 +494,7 @@ class AnalysisService:
         self._true_positives_count = None
         self._false_negatives_count = None
         self._false_positives_count = None
+        self._true_negatives_count = None
         self._gt_regions = None
         self._detected_file_regions = None
         self._overall_metrics = None
@@ -615,62 +647,27 @@ class AnalysisService:
     def detected_file_regions(self):
         if self._detected_file_regions is not None:
             return self._detected_file_regions
-        ml_models_grouped_by_type = {}
-        for ml_model in self.ml_models():
-            if ml_models_grouped_by_type.get(ml_model.type, None) is None:
-                ml_models_grouped_by_type[ml_model.type] = []
-            ml_models_grouped_by_type[ml_model.type].append(ml_model.id)
-        classification_and_detection_detected_file_regions = FileRegion.objects.none()
-        classification_detected_file_regions = FileRegion.objects.none()
-        for model_type, model_ids in ml_models_grouped_by_type.items():
-            if model_type == "CLASSIFICATION_AND_DETECTION":
-                classification_and_detection_detected_file_regions = (
-                    self.file_regions()
-                    .filter(
-                        # Q(detection_correctness__isnull=True) &
-                        # Q(classification_correctness__isnull=False) |
-                        Q(detection_correctness=True)
-                    )
-                    .filter(ml_model_id__in=model_ids)
-                )
-            elif model_type == "CLASSIFICATION":
-                classification_detected_file_regions = self.file_regions().filter(
-                    classification_correctness__isnull=False
-                )
+        (
+            classification_and_detection_detected_file_regions,
+            classification_detected_file_regions,
+        ) = self._detected_file_regions_by_type()
         detected_file_regions = (
             classification_and_detection_detected_file_regions | classification_detected_file_regions
         )
         self._detected_file_regions = detected_file_regions
         return self._detected_file_regions
 
-    def true_positives_count(self):
-        if self._true_positives_count is not None:
-            return self._true_positives_count
-        # detected_file_regions = self.file_regions().filter(Q(detection_correctness__isnull=True) & Q(classification_correctness__isnull=False) | Q(detection_correctness=True))
-        detected_file_regions = self.detected_file_regions()
-        correctly_classified_defects = detected_file_regions.filter(classification_correctness=True).values("defects")
-        self._true_positives_count = 0
-        for defect in correctly_classified_defects:
-            for _ in defect["defects"]:
-                self._true_positives_count += 1
-        incorrect_classified_regions = detected_file_regions.filter(classification_correctness=False)
-        # ToDo: user_feedback_regions_for_incorrect_ai_regions should have a separate method as its used multiple times
-        user_feedback_regions_for_incorrect_ai_regions = FileRegion.objects.filter(
-            ai_region__in=incorrect_classified_regions
-        )
-        for region in user_feedback_regions_for_incorrect_ai_regions:
-            for def_id in region.defects:
-                if def_id in region.ai_region.defects:
-                    self._true_positives_count += 1
-        print("TP COUNT:" + str(self._true_positives_count))
-        return self._true_positives_count
+    def _detected_file_regions_by_type(self, include_user_feedback=False):
+        """splits the detected file regions into the ones belonging to CLASSIFICATION_AND_DETECTION models and the
+        ones belonging to CLASSIFICATION models
 
-    def false_negatives_count(self):
-        if self._false_negatives_count is not None:
-            return self._false_negatives_count
-        # calculate false negatives
-        self._false_negatives_count = 0
-        # detected_file_regions = self.file_regions().filter(Q(detection_correctness__isnull=True) & Q(classification_correctness__isnull=False) | Q(detection_correctness=True))
+        Args:
+            include_user_feedback (bool, optional): True implies user feedback regions are treated as detected for
+                CLASSIFICATION models. Defaults to False.
+
+        Returns:
+            (QuerySet, QuerySet): combined model regions, classification model regions
+        """
         ml_models_grouped_by_type = {}
         for ml_model in self.ml_models():
             if ml_models_grouped_by_type.get(ml_model.type, None) is None:
@@ -681,126 +678,136 @@ class AnalysisService:
         for model_type, model_ids in ml_models_grouped_by_type.items():
             if model_type == "CLASSIFICATION_AND_DETECTION":
                 classification_and_detection_detected_file_regions = (
-                    self.file_regions()
-                    .filter(
-                        # Q(detection_correctness__isnull=True) &
-                        # Q(classification_correctness__isnull=False) |
-                        Q(detection_correctness=True)
-                    )
-                    .filter(ml_model_id__in=model_ids)
+                    self.file_regions().filter(detection_correctness=True).filter(ml_model_id__in=model_ids)
                 )
             elif model_type == "CLASSIFICATION":
-                classification_detected_file_regions = self.file_regions().filter(
-                    Q(classification_correctness__isnull=False) | Q(is_user_feedback=True)
-                )
-        detected_file_regions = (
-            classification_and_detection_detected_file_regions | classification_detected_file_regions
+                classification_filter = Q(classification_correctness__isnull=False)
+                if include_user_feedback:
+                    classification_filter |= Q(is_user_feedback=True)
+                classification_detected_file_regions = self.file_regions().filter(classification_filter)
+        return classification_and_detection_detected_file_regions, classification_detected_file_regions
+
+    @staticmethod
+    def _region_sql_with_params(queryset, fields):
+        # An empty queryset can't be compiled to sql, hence it's replaced with one that never matches any row.
+        if queryset.query.is_empty():
+            queryset = FileRegion.objects.filter(id__isnull=True)
+        return queryset.values(*fields).query.sql_with_params()
+
+    def _calculate_label_counts(self):
+        """calculates the true positive, false negative and false positive label counts in a single sql statement.
+        Every defect present in a region is counted as a label, the defect ids are the keys of the defects json.
+
+        Returns:
+            [dict]: {"true_positives": int, "false_negatives": int, "false_positives": int}
+        """
+        combined_regions, classification_regions = self._detected_file_regions_by_type()
+        _, fn_classification_regions = self._detected_file_regions_by_type(include_user_feedback=True)
+        tp_sql, tp_params = self._region_sql_with_params(
+            self.detected_file_regions(), ["id", "defects", "classification_correctness"]
         )
-        under_detected_regions = detected_file_regions.filter(ai_region__isnull=True, is_user_feedback=True).values(
-            "defects"
+        fn_sql, fn_params = self._region_sql_with_params(
+            combined_regions | fn_classification_regions, ["id", "defects", "ai_region_id", "is_user_feedback"]
         )
-        for region in under_detected_regions:
-            for def_id in region["defects"]:
-                self._false_negatives_count += 1
-        user_feedback_regions_for_incorrect_ai_regions = (
-            self.file_regions()
-            .filter(ai_region__in=FileRegion.objects.filter(classification_correctness=False))
-            .select_related("ai_region")
+        scoped_sql, scoped_params = self._region_sql_with_params(self.file_regions(), ["id", "defects", "ai_region_id"])
+        fp_classification_sql, fp_classification_params = self._region_sql_with_params(
+            classification_regions, ["id", "classification_correctness"]
+        )
+        fp_combined_sql, fp_combined_params = self._region_sql_with_params(
+            combined_regions, ["id", "defects", "classification_correctness"]
+        )
+        # ai regions marked incorrect are compared label by label with the user feedback regions created for them.
+        # For false positives only the first feedback region (lowest id) of an ai region is considered.
+        sql = """
+            with tp_regions as ({tp_sql}),
+            fn_regions as ({fn_sql}),
+            scoped_regions as ({scoped_sql}),
+            fp_classification_regions as ({fp_classification_sql}),
+            fp_combined_regions as ({fp_combined_sql})
+            select
+                (
+                    select count(*) from tp_regions r cross join lateral jsonb_object_keys(r.defects) k
+                    where r.classification_correctness is true
+                ) + (
+                    select count(*) from {table} u
+                    inner join tp_regions r on u.ai_region_id = r.id
+                    cross join lateral jsonb_object_keys(u.defects) k
+                    where r.classification_correctness is false and r.defects ? k
+                ) as true_positives,
+                (
+                    select count(*) from fn_regions r cross join lateral jsonb_object_keys(r.defects) k
+                    where r.ai_region_id is null and r.is_user_feedback is true
+                ) + (
+                    select count(*) from scoped_regions u
+                    inner join {table} a on u.ai_region_id = a.id
+                    cross join lateral jsonb_object_keys(u.defects) k
+                    where a.classification_correctness is false and not a.defects ? k
+                ) as false_negatives,
+                (
+                    select count(*) from fp_classification_regions r where r.classification_correctness is false
+                ) + (
+                    select count(*) from fp_combined_regions r
+                    cross join lateral (
+                        select c.defects from {table} c where c.ai_region_id = r.id order by c.id limit 1
+                    ) first_feedback
+                    cross join lateral jsonb_object_keys(r.defects) k
+                    where r.classification_correctness is false and not first_feedback.defects ? k
+                ) as false_positives
+        """.format(
+            tp_sql=tp_sql,
+            fn_sql=fn_sql,
+            scoped_sql=scoped_sql,
+            fp_classification_sql=fp_classification_sql,
+            fp_combined_sql=fp_combined_sql,
+            table=connection.ops.quote_name(FileRegion._meta.db_table),
         )
-        for region in user_feedback_regions_for_incorrect_ai_regions:
-            for def_id in region.defects:
-                if def_id not in region.ai_region.defects:
-                    self._false_negatives_count += 1
-        print("FN COUNT:" + str(self._false_negatives_count))
+        params = tp_params + fn_params + scoped_params + fp_classification_params + fp_combined_params
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            true_positives, false_negatives, false_positives = cursor.fetchone()
+        self._true_positives_count = true_positives
+        self._false_negatives_count = false_negatives
+        self._false_positives_count = false_positives
+        logger.debug(f"TP COUNT: {true_positives}, FN COUNT: {false_negatives}, FP COUNT: {false_positives}")
+        return {
+            "true_positives": true_positives,
+            "false_negatives": false_negatives,
+            "false_positives": false_positives,
+        }
+
+    def true_positives_count(self):
+        if self._true_positives_count is None:
+            self._calculate_label_counts()
+        return self._true_positives_count
+
+    def false_negatives_count(self):
+        if self._false_negatives_count is None:
+            self._calculate_label_counts()
         return self._false_negatives_count
 
     def false_positives_count(self):
-        if self._false_positives_count is not None:
-            return self._false_positives_count
-
-        # calculate false positives
-        self._false_positives_count = 0
-        # detected_file_regions = self.file_regions().filter(Q(detection_correctness__isnull=True) & Q(classification_correctness__isnull=False) | Q(detection_correctness=True))
-        ml_models_grouped_by_type = {}
-        for ml_model in self.ml_models():
-            if ml_models_grouped_by_type.get(ml_model.type, None) is None:
-                ml_models_grouped_by_type[ml_model.type] = []
-            ml_models_grouped_by_type[ml_model.type].append(ml_model.id)
-        classification_and_detection_detected_file_regions = FileRegion.objects.none()
-        classification_detected_file_regions = FileRegion.objects.none()
-        for model_type, model_ids in ml_models_grouped_by_type.items():
-            if model_type == "CLASSIFICATION_AND_DETECTION":
-                classification_and_detection_detected_file_regions = (
-                    self.file_regions()
-                    .filter(
-                        # Q(detection_correctness__isnull=True) &
-                        # Q(classification_correctness__isnull=False) |
-                        Q(detection_correctness=True)
-                    )
-                    .filter(ml_model_id__in=model_ids)
-                )
-            elif model_type == "CLASSIFICATION":
-                classification_detected_file_regions = self.file_regions().filter(
-                    classification_correctness__isnull=False
-                )
-        # detected_file_regions = classification_and_detection_detected_file_regions | classification_detected_file_regions
-        incorrect_classified_combined_file_regions = classification_and_detection_detected_file_regions.filter(
-            classification_correctness=False
-        )
-        incorrect_classified_classification_file_regions = classification_detected_file_regions.filter(
-            classification_correctness=False
-        )
-        self._false_positives_count = incorrect_classified_classification_file_regions.count()
-        for region in incorrect_classified_combined_file_regions:
-            for def_id in region.defects:
-                try:
-                    if def_id not in region.file_regions.first().defects:
-                        self._false_positives_count += 1
-                except:
-                    continue
-        # ff = detected_file_regions.filter(classification_correctness=False)
-        # detected_file_region_ids = []
-        # for fr in ff:
-        #     detected_file_region_ids.append(fr.id)
-        # if model_type == 'CLASSIFICATION_AND_DETECTION':
-        #     for region in ff:
-        #         for def_id in region.defects:
-        #             try:
-        #                 if def_id not in region.file_regions.first().defects:
-        #                     self._false_positives_count += 1
-        #             except:
-        #                 continue
-        # elif model_type == 'CLASSIFICATION':
-        #     self._false_positives_count = ff.count()
-        print("FP COUNT:" + str(self._false_positives_count))
+        if self._false_positives_count is None:
+            self._calculate_label_counts()
         return self._false_positives_count
 
     def true_negatives_count(self):
-        all_defect_ids = (
-            self.detected_file_regions()
-            .annotate(defect_ids=JsonKeys("defects"))
-            .values_list("defect_ids", flat=True)
-            .distinct()
-        )
-        true_negatives = 0
-        for defect_id in all_defect_ids:
-            true_negatives += (
-                self.detected_file_regions()
-                .filter(classification_correctness=True)
-                .exclude(defects__has_key=str(defect_id))
-                .annotate(defect_ids=JsonKeys("defects"))
-                .count()
+        if self._true_negatives_count is not None:
+            return self._true_negatives_count
+        # summed over every defect present in the detected regions
+        ctes, params = self._class_wise_ctes()
+        sql = """
+            {ctes}
+            select coalesce(
+                sum(t.correct_labels - p.correct_labels + t.feedback_labels - p.feedback_labels), 0
             )
-
-            true_negatives += (
-                self.detected_file_regions()
-                .filter(is_user_feedback=True)
-                .exclude(defects__has_key=str(defect_id), ai_region__defects__has_key=str(defect_id))
-                .annotate(defect_ids=JsonKeys("defects"))
-                .count()
-            )
-
-        return true_negatives
+            from tn_present p cross join tn_totals t
+        """.format(
+            ctes=ctes
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            self._true_negatives_count = cursor.fetchone()[0]
+        return self._true_negatives_count
 
     def classification_accuracy(self):
         if self.ml_models().count() > 1:
@@ -880,14 +887,342 @@ class AnalysisService:
         except ZeroDivisionError as e:
             return "N/A"
 
+    def accuracy_trend(self, time_function=TruncDay):
+        """calculates the classification, detection and overall accuracy of every time bucket of the file sets in a
+        single sql statement. The metrics of a bucket are the ones a separate AnalysisService limited to the file
+        sets created in that bucket would return.
+
+        Args:
+            time_function (Trunc, optional): TruncDay, TruncWeek or TruncMonth. Defaults to TruncDay.
+
+        Returns:
+            [list]: [{"bucket": datetime, "classification_accuracy", "detection_accuracy", "overall_accuracy"}]
+                ordered by bucket
+        """
+        ml_models_grouped_by_type = self.ml_models_grouped_by_type()
+        has_classification_models = "CLASSIFICATION" in ml_models_grouped_by_type
+        combined_model_ids = ml_models_grouped_by_type.get("CLASSIFICATION_AND_DETECTION", [])
+        buckets_sql, buckets_params = (
+            self.file_sets().annotate(bucket=time_function("created_ts")).values("bucket").distinct().query
+        ).sql_with_params()
+        scoped_sql, scoped_params = self._region_sql_with_params(
+            self.file_regions().annotate(bucket=time_function("file__file_set__created_ts")),
+            [
+                "id",
+                "bucket",
+                "defects",
+                "ai_region_id",
+                "is_user_feedback",
+                "is_removed",
+                "classification_correctness",
+                "detection_correctness",
+                "ml_model_id",
+            ],
+        )
+        # Every region keeps the bucket of its file set, the ctes below are the grouped versions of the counts
+        # _calculate_label_counts, true_negatives_count, detection_accuracy and overall_accuracy are made of.
+        sql = """
+            with scoped as ({scoped_sql}),
+            regions as (
+                select s.*,
+                    (s.detection_correctness is true and s.ml_model_id = any(%s)) as is_combined,
+                    (%s and s.classification_correctness is not null) as is_classification,
+                    (%s and s.is_user_feedback is true) as is_classification_feedback,
+                    (select count(*) from jsonb_object_keys(s.defects)) as label_count
+                from scoped s
+            ),
+            detected as (
+                select * from regions r where r.is_combined or r.is_classification
+            ),
+            region_counts as (
+                select r.bucket,
+                    count(*) filter (where r.is_combined or r.is_classification) as detected,
+                    count(*) filter (
+                        where (r.is_combined or r.is_classification) and r.classification_correctness is true
+                    ) as detected_correct,
+                    coalesce(sum(r.label_count) filter (
+                        where (r.is_combined or r.is_classification) and r.classification_correctness is true
+                    ), 0) as tp_correct_labels,
+                    coalesce(sum(r.label_count) filter (
+                        where (r.is_combined or r.is_classification or r.is_classification_feedback)
+                        and r.ai_region_id is null and r.is_user_feedback is true
+                    ), 0) as fn_new_region_labels,
+                    count(*) filter (
+                        where r.is_classification and r.classification_correctness is false
+                    ) as fp_classification,
+                    count(*) filter (where r.detection_correctness is true) as correct_detections,
+                    count(*) filter (
+                        where r.is_user_feedback is false and r.detection_correctness is not null
+                    ) as ai_regions,
+                    count(*) filter (
+                        where r.ai_region_id is null and r.is_user_feedback is true and r.is_removed is false
+                    ) as new_regions,
+                    coalesce(sum(r.label_count) filter (
+                        where r.is_user_feedback is false
+                        and (r.detection_correctness is not null or r.classification_correctness is not null)
+                    ), 0) as ai_feedback_labels,
+                    coalesce(sum(r.label_count) filter (
+                        where r.ai_region_id is null and r.is_user_feedback is true and r.is_removed is false
+                    ), 0) as new_region_labels
+                from regions r
+                group by r.bucket
+            ),
+            tp_feedback as (
+                select r.bucket, count(*) as count from detected r
+                inner join {table} u on u.ai_region_id = r.id
+                cross join lateral jsonb_object_keys(u.defects) k
+                where r.classification_correctness is false and r.defects ? k
+                group by r.bucket
+            ),
+            modified_labels as (
+                select u.bucket,
+                    count(*) filter (where a.classification_correctness is false) as fn_count,
+                    count(*) filter (where u.is_user_feedback is true and u.is_removed is false) as new_label_count
+                from regions u
+                inner join {table} a on u.ai_region_id = a.id
+                cross join lateral jsonb_object_keys(u.defects) k
+                where not a.defects ? k
+                group by u.bucket
+            ),
+            fp_combined as (
+                select r.bucket, count(*) as count from detected r
+                cross join lateral (
+                    select c.defects from {table} c where c.ai_region_id = r.id order by c.id limit 1
+                ) first_feedback
+                cross join lateral jsonb_object_keys(r.defects) k
+                where r.is_combined and r.classification_correctness is false and not first_feedback.defects ? k
+                group by r.bucket
+            ),
+            labelled as (
+                select r.bucket, r.defects, r.classification_correctness, r.is_user_feedback, r.label_count,
+                    a.defects as ai_defects
+                from detected r left join {table} a on a.id = r.ai_region_id
+            ),
+            tn_totals as (
+                select bucket,
+                    coalesce(sum(label_count) filter (where classification_correctness is true), 0)
+                    + coalesce(sum(label_count) filter (where is_user_feedback is true), 0) as labels
+                from labelled
+                group by bucket
+            ),
+            tn_present as (
+                select r.bucket, k,
+                    coalesce(sum(r.label_count) filter (where r.classification_correctness is true), 0)
+                    + coalesce(sum(r.label_count) filter (where r.is_user_feedback is true and r.ai_defects ? k), 0)
+                    as labels
+                from labelled r cross join lateral jsonb_object_keys(r.defects) k
+                group by r.bucket, k
+            ),
+            tn as (
+                select p.bucket, sum(t.labels - p.labels) as count
+                from tn_present p inner join tn_totals t on t.bucket = p.bucket
+                group by p.bucket
+            )
+            select
+                b.bucket,
+                coalesce(c.detected, 0),
+                coalesce(c.detected_correct, 0),
+                coalesce(c.tp_correct_labels, 0) + coalesce(tp_feedback.count, 0),
+                coalesce(c.fn_new_region_labels, 0) + coalesce(m.fn_count, 0),
+                coalesce(c.fp_classification, 0) + coalesce(fp_combined.count, 0),
+                coalesce(tn.count, 0),
+                coalesce(c.correct_detections, 0),
+                coalesce(c.ai_regions, 0),
+                coalesce(c.new_regions, 0),
+                coalesce(c.ai_feedback_labels, 0) + coalesce(c.new_region_labels, 0) + coalesce(m.new_label_count, 0)
+            from ({buckets_sql}) b
+            left join region_counts c on c.bucket = b.bucket
+            left join tp_feedback on tp_feedback.bucket = b.bucket
+            left join modified_labels m on m.bucket = b.bucket
+            left join fp_combined on fp_combined.bucket = b.bucket
+            left join tn on tn.bucket = b.bucket
+            order by b.bucket
+        """.format(
+            scoped_sql=scoped_sql,
+            buckets_sql=buckets_sql,
+            table=connection.ops.quote_name(FileRegion._meta.db_table),
+        )
+        params = (
+            list(scoped_params)
+            + [combined_model_ids, has_classification_models, has_classification_models]
+            + list(buckets_params)
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+
+        ml_models = list(self.ml_models()[:2])
+        classification_type = ml_models[0].classification_type if len(ml_models) == 1 else None
+        trend = []
+        for row in rows:
+            # sums of counts come back as decimals
+            bucket, counts = row[0], [int(count) for count in row[1:]]
+            detected, detected_correct, true_positives, false_negatives, false_positives = counts[:5]
+            true_negatives, correct_detections, ai_regions, new_regions, total_labels = counts[5:]
+            classification_accuracy = "N/A"
+            try:
+                if classification_type == "MULTI_LABEL":
+                    classification_accuracy = round(
+                        ((true_positives + true_negatives) * 100)
+                        / (true_positives + true_negatives + false_negatives + false_positives),
+                        2,
+                    )
+                elif classification_type == "SINGLE_LABEL":
+                    classification_accuracy = round((detected_correct * 100) / detected)
+            except ZeroDivisionError as e:
+                pass
+            try:
+                detection_accuracy = round((100 * correct_detections) / (ai_regions + new_regions), 2)
+            except ZeroDivisionError as e:
+                detection_accuracy = "N/A"
+            try:
+                overall_accuracy = round((100 * true_positives) / total_labels, 2)
+            except ZeroDivisionError as e:
+                overall_accuracy = "N/A"
+            trend.append(
+                {
+                    "bucket": bucket,
+                    "classification_accuracy": classification_accuracy,
+                    "detection_accuracy": detection_accuracy,
+                    "overall_accuracy": overall_accuracy,
+                }
+            )
+        return trend
+
+    def _class_wise_ctes(self):
+        """builds the common table expressions the class wise matrix is calculated from. Every defect present in a
+        region is a label, the tp / fp / fn ctes hold the number of regions per defect id (text), the tn ctes hold
+        label counts.
+
+        Returns:
+            (str, list): sql starting with "with", params
+        """
+        ml_models_grouped_by_type = self.ml_models_grouped_by_type()
+        has_classification_models = "CLASSIFICATION" in ml_models_grouped_by_type
+        has_classification_and_detection_models = "CLASSIFICATION_AND_DETECTION" in ml_models_grouped_by_type
+        region_fields = [
+            "id",
+            "defects",
+            "classification_correctness",
+            "is_user_feedback",
+            "is_removed",
+            "ai_region_id",
+        ]
+        detected_sql, detected_params = self._region_sql_with_params(self.detected_file_regions(), region_fields)
+        scoped_sql, scoped_params = self._region_sql_with_params(self.file_regions(), region_fields)
+        # true negatives of a defect are the labels of the correctly classified regions without that defect, plus the
+        # labels of the feedback regions where either the region or its ai region doesn't have that defect.
+        # They are calculated as all the labels minus the labels of the regions having the defect.
+        ctes = """
+            with detected as ({detected_sql}),
+            scoped as ({scoped_sql}),
+            tp as (
+                select k as defect_id, count(distinct r.id) as count
+                from detected r cross join lateral jsonb_object_keys(r.defects) k
+                where r.classification_correctness is true or (
+                    r.classification_correctness is false and exists (
+                        select 1 from {table} f where f.ai_region_id = r.id and f.defects ? k and f.is_removed is false
+                    )
+                )
+                group by k
+            ),
+            fp as (
+                select k as defect_id, count(distinct r.id) as count
+                from detected r cross join lateral jsonb_object_keys(r.defects) k
+                where r.classification_correctness is false and (
+                    %s or (
+                        %s and r.is_removed is false
+                        and not exists (select 1 from {table} f where f.ai_region_id = r.id and f.defects ? k)
+                    )
+                )
+                group by k
+            ),
+            fn as (
+                select defect_id, count(distinct id) as count from (
+                    select r.id, k as defect_id from scoped r cross join lateral jsonb_object_keys(r.defects) k
+                    where %s and r.is_user_feedback is true and r.is_removed is false
+                    and not exists (select 1 from {table} f where f.ai_region_id = r.id)
+                    union all
+                    select r.id, feedback.k as defect_id from detected r
+                    cross join lateral (
+                        select distinct jsonb_object_keys(f.defects) as k from {table} f where f.ai_region_id = r.id
+                    ) feedback
+                    where %s and r.classification_correctness is false and r.is_removed is false
+                    and not r.defects ? feedback.k
+                ) fn_regions
+                group by defect_id
+            ),
+            labelled as (
+                select r.id, r.defects, r.classification_correctness, r.is_user_feedback, a.defects as ai_defects,
+                (select count(*) from jsonb_object_keys(r.defects)) as label_count
+                from detected r left join {table} a on a.id = r.ai_region_id
+            ),
+            tn_totals as (
+                select
+                    coalesce(sum(label_count) filter (where classification_correctness is true), 0) as correct_labels,
+                    coalesce(sum(label_count) filter (where is_user_feedback is true), 0) as feedback_labels
+                from labelled
+            ),
+            tn_present as (
+                select k as defect_id,
+                    coalesce(sum(r.label_count) filter (where r.classification_correctness is true), 0)
+                        as correct_labels,
+                    coalesce(
+                        sum(r.label_count) filter (where r.is_user_feedback is true and r.ai_defects ? k), 0
+                    ) as feedback_labels
+                from labelled r cross join lateral jsonb_object_keys(r.defects) k
+                group by k
+            )
+        """.format(
+            detected_sql=detected_sql,
+            scoped_sql=scoped_sql,
+            table=connection.ops.quote_name(FileRegion._meta.db_table),
+        )
+        params = (
+            list(detected_params)
+            + list(scoped_params)
+            + [
+                has_classification_models,
+                has_classification_and_detection_models,
+                has_classification_models,
+                has_classification_and_detection_models,
+            ]
+        )
+        return ctes, params
+
     def class_wise_matrix_data(self):
-        # model_type = MlModel.objects.get(id=ml_model_ids[0]).type
-        defects = Defect.objects.filter(ml_models__in=self.ml_models())
+        """calculates true positives, false positives, false negatives, true negatives, precision and recall of every
+        defect of the selected models in a single sql statement"""
+        ctes, params = self._class_wise_ctes()
+        defects_sql, defects_params = (
+            Defect.objects.filter(ml_models__in=self.ml_models()).values("id", "name").query.sql_with_params()
+        )
+        sql = """
+            {ctes}
+            select
+                d.id,
+                d.name,
+                coalesce(tp.count, 0) as true_positives,
+                coalesce(fp.count, 0) as false_positives,
+                coalesce(fn.count, 0) as false_negatives,
+                t.correct_labels - coalesce(p.correct_labels, 0) + t.feedback_labels - coalesce(p.feedback_labels, 0)
+                    as true_negatives
+            from ({defects_sql}) d
+            cross join tn_totals t
+            left join tp on tp.defect_id = d.id::text
+            left join fp on fp.defect_id = d.id::text
+            left join fn on fn.defect_id = d.id::text
+            left join tn_present p on p.defect_id = d.id::text
+        """.format(
+            ctes=ctes, defects_sql=defects_sql
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params + list(defects_params))
+            rows = cursor.fetchall()
         data = []
-        for defect in defects:
-            true_positives_count = self.true_positive_file_regions_for_defect(defect.id).count()
-            false_positives_count = self.false_positive_file_regions_for_defect(defect.id).count()
-            false_negatives_count = self.false_negative_file_regions_for_defect(defect.id).count()
+        for row in rows:
+            defect_id, defect_name = row[0], row[1]
+            true_positives_count, false_positives_count, false_negatives_count, true_negatives_count = row[2:]
             try:
                 precision = true_positives_count / (true_positives_count + false_positives_count)
                 precision = round(precision * 100, 2)
@@ -898,10 +1233,11 @@ class AnalysisService:
                 recall = None
             data.append(
                 {
-                    "defect": {"id": defect.id, "name": defect.name},
+                    "defect": {"id": defect_id, "name": defect_name},
                     "true_positives": {"count": true_positives_count, "file_set_ids": []},
                     "false_positives": {"count": false_positives_count, "file_set_ids": []},
                     "false_negatives": {"count": false_negatives_count, "file_set_ids": []},
+                    "true_negatives": {"count": true_negatives_count, "file_set_ids": []},
                     "precision": precision,
                     "recall": recall,
                 }
@@ -1068,6 +1404,20 @@ class AnalysisService:
         return yield_loss
 
     def yield_loss_trend_grouped_by_defect(self, defect_id_map, imp_defects, time_format="daily", priority=False):
+        """calculates the ai reject count and yield loss of every (defect, time bucket) in a single sql statement.
+        The unit count of a bucket is the sum of the InitialTotal of its distinct lots.
+
+        Args:
+            defect_id_map (dict): {defect_id: name} of the defects to report
+            imp_defects (list): ids of the defects that make a file set rejected
+            time_format (str, optional): "daily", "weekly" or "monthly". Defaults to "daily".
+            priority (bool, optional): True implies a file set is only counted for its highest priority defect.
+                Defaults to False.
+
+        Returns:
+            [dict]: {defect_id: {"name": str, time_str: {"percentage", "ai_reject_count", "total_unit_count"}}}
+        """
+        time_function = get_time_function(time_format)
         defective_file_sets = (
             self.file_sets()
             .filter(
@@ -1077,11 +1427,10 @@ class AnalysisService:
                 meta_info__has_keys=["InitialTotal", "lot_id"],
                 files__file_regions__is_user_feedback=False,
             )
-            .values("id")
-            .annotate(defect=JsonKeys("files__file_regions__defects"))
+            .annotate(defect=JsonKeys("files__file_regions__defects"), time_val=time_function("created_ts"))
+            .values("id", "defect", "time_val")
             .distinct()
         )
-
         distinct_initial_total = (
             self.file_sets()
             .filter(
@@ -1089,81 +1438,228 @@ class AnalysisService:
                 meta_info__InitialTotal__isnull=False,
                 meta_info__has_keys=["InitialTotal"],
             )
-            .values("meta_info__lot_id", "meta_info__InitialTotal")
+            .annotate(
+                lot_id=KeyTransform("lot_id", "meta_info"),
+                initial_total=KeyTransform("InitialTotal", "meta_info"),
+                time_val=time_function("created_ts"),
+            )
+            .values("lot_id", "initial_total", "time_val")
             .distinct()
         )
-
-        if time_format == "monthly":
-            defective_file_sets = defective_file_sets.annotate(time_val=TruncMonth("created_ts"))
-            distinct_initial_total = distinct_initial_total.annotate(time_val=TruncMonth("created_ts"))
-        elif time_format == "weekly":
-            defective_file_sets = defective_file_sets.annotate(time_val=TruncWeek("created_ts"))
-            distinct_initial_total = distinct_initial_total.annotate(time_val=TruncWeek("created_ts"))
+        if not defect_id_map or defective_file_sets.query.is_empty() or distinct_initial_total.query.is_empty():
+            return {}
+        defective_sql, defective_params = defective_file_sets.query.sql_with_params()
+        initial_total_sql, initial_total_params = distinct_initial_total.query.sql_with_params()
+        params = list(defective_params)
+        if priority:
+            ordered_defect_ids = get_ordered_defect_ids()
+            # every file set is only kept for the first of its defects in ORDERED_DEFECT_IDS
+            counted_sql = """
+                select distinct on (id) id, defect, time_val from defective
+                order by id, array_position(%s::int[], defect::int)
+            """
+            params.append(ordered_defect_ids)
         else:
-            defective_file_sets = defective_file_sets.annotate(time_val=TruncDay("created_ts"))
-            distinct_initial_total = distinct_initial_total.annotate(time_val=TruncDay("created_ts"))
+            counted_sql = "select id, defect, time_val from defective"
+        sql = """
+            with defective as ({defective_sql}),
+            counted as ({counted_sql}),
+            unit_counts as (
+                select time_val, sum((initial_total #>> '{{}}')::numeric) as total_unit_count
+                from ({initial_total_sql}) initial_totals
+                group by time_val
+            )
+            select c.defect::int, c.time_val, count(*), u.total_unit_count
+            from counted c inner join unit_counts u on u.time_val = c.time_val
+            where c.defect = any(%s)
+            group by c.defect, c.time_val, u.total_unit_count
+            order by c.defect::int, c.time_val
+        """.format(
+            defective_sql=defective_sql, counted_sql=counted_sql, initial_total_sql=initial_total_sql
+        )
+        params += list(initial_total_params) + [[str(defect_id) for defect_id in defect_id_map]]
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+
+        response = {}
+        for defect_id, time_val, num, den in rows:
+            if defect_id not in response:
+                response[defect_id] = {"name": defect_id_map[defect_id]}
+            den = int(den)
+            response[defect_id][convert_datetime_to_str(time_val, time_format)] = {
+                "percentage": round(num * 100 / den, 2),
+                "ai_reject_count": num,
+                "total_unit_count": den,
+            }
+        return response
 
-        defective_file_sets = list(defective_file_sets)
-        time_val_initial_total = {}
-        for obj in distinct_initial_total:
-            time_val = obj["time_val"]
-            if time_val not in time_val_initial_total:
-                time_val_initial_total[time_val] = 0
-            time_val_initial_total[time_val] += int(obj["meta_info__InitialTotal"])
+    def over_rejected_file_sets(self, include_defects, exclude_defects):
+        """file sets the ai rejected for insignificant defects only, or didn't reject at all
 
-        defect_time_val_file_sets = {}
-        file_set_id_defect_ids = {}
+        Args:
+            include_defects (list): ids of the insignificant defects
+            exclude_defects (list): ids of all the other defects
 
-        ordered_defect_ids = get_env().list("ORDERED_DEFECT_IDS", cast=int, default=[1, 2, 4, 5, 3, 6])
+        Returns:
+            [QuerySet]: FileSet
+        """
+        if not self._auto_model:
+            return self.file_sets().filter(
+                Q(
+                    files__file_regions__defects__has_any_keys=include_defects,
+                    files__file_regions__is_user_feedback=False,
+                )
+                | Q(files__file_regions__isnull=True)
+            )
+        filters = []
+        model_id_file_set_map = self.get_auto_model_file_set_ids_map()
+        for model_id, file_set_ids in model_id_file_set_map.items():
+            file_set_ids = list(file_set_ids)
+            filter = ~Q(
+                id__in=FileRegion.objects.filter(
+                    ml_model_id=model_id, is_user_feedback=False, defects__has_any_keys=exclude_defects
+                ).values_list("file__file_set__id", flat=True)
+            ) & Q(id__in=file_set_ids)
+            filters.append(filter)
+        if not filters:
+            return FileSet.objects.none()
+        return FileSet.objects.filter(reduce(ior, filters))
+
+    def overkill_by_lot(self, include_defects, exclude_defects, time_format="daily"):
+        """calculates the over reject count of every (time bucket, lot) in a single sql statement, along with the
+        totals of the lot's machine in that bucket and over the whole period (window functions). The over rejected
+        file sets are bucketed like their lots, daily ones used to be counted over their whole month.
 
-        ordered_defect_ids = ordered_defect_ids + list(
-            Defect.objects.exclude(id__in=ordered_defect_ids).order_by("created_ts").values_list("id", flat=True)
-        )
+        Args:
+            include_defects (list): ids of the insignificant defects
+            exclude_defects (list): ids of all the other defects
+            time_format (str, optional): "daily", "weekly" or "monthly". Defaults to "daily".
 
-        if priority:
-            for obj in defective_file_sets:
-                if obj["id"] not in file_set_id_defect_ids:
-                    file_set_id_defect_ids[obj["id"]] = set()
-                file_set_id_defect_ids[obj["id"]].add(int(obj["defect"]))
-            for file_set_id, defect_ids in file_set_id_defect_ids.items():
-                for defect_id in ordered_defect_ids:
-                    if defect_id in defect_ids:
-                        defect_ids.remove(defect_id)
-                        break
-                for i, obj in enumerate(defective_file_sets):
-                    if obj["id"] == file_set_id and int(obj["defect"]) in defect_ids:
-                        defective_file_sets.pop(i)
-
-        for obj in defective_file_sets:
-            defect_id = int(obj["defect"])
-            if defect_id in defect_id_map:
-                time_val = obj["time_val"]
-                if defect_id not in defect_time_val_file_sets:
-                    defect_time_val_file_sets[defect_id] = {}
-                    defect_time_val_file_sets[defect_id][time_val] = [obj["id"]]
-                else:
-                    if time_val not in defect_time_val_file_sets[defect_id]:
-                        defect_time_val_file_sets[defect_id][time_val] = [obj["id"]]
-                    else:
-                        defect_time_val_file_sets[defect_id][time_val].append(obj["id"])
+        Returns:
+            [list]: [{"time_val", "lot_id", "machine_no", "total_unit_count", "over_reject_count",
+                "machine_total_unit_count", "machine_over_reject_count", "overall_total_unit_count",
+                "overall_over_reject_count"}] ordered by time_val, machine_no, lot_id
+        """
+        time_function = get_time_function(time_format)
+        over_rejected = (
+            self.over_rejected_file_sets(include_defects, exclude_defects)
+            .annotate(lot_id=KeyTransform("lot_id", "meta_info"), time_val=time_function("created_ts"))
+            .values("id", "lot_id", "time_val")
+            .distinct()
+        )
+        lots = (
+            self.file_sets()
+            .filter(file_set_inference_queues__status="FINISHED")
+            .annotate(
+                lot_id=KeyTransform("lot_id", "meta_info"),
+                initial_total=KeyTransform("InitialTotal", "meta_info"),
+                machine_no=KeyTransform("MachineNo", "meta_info"),
+                time_val=time_function("created_ts"),
+            )
+            .values("lot_id", "initial_total", "machine_no", "time_val")
+            .distinct()
+        )
+        if lots.query.is_empty():
+            return []
+        if over_rejected.query.is_empty():
+            # an empty queryset can't be compiled to sql, hence it's replaced with one that never matches any row
+            over_rejected = (
+                FileSet.objects.filter(id__isnull=True)
+                .annotate(lot_id=KeyTransform("lot_id", "meta_info"), time_val=time_function("created_ts"))
+                .values("id", "lot_id", "time_val")
+            )
+        over_rejected_sql, over_rejected_params = over_rejected.query.sql_with_params()
+        lots_sql, lots_params = lots.query.sql_with_params()
+        # a lot is counted once per time bucket, lots without a lot_id or InitialTotal are left out
+        sql = """
+            with lots as (
+                select distinct on (time_val, lot_id)
+                    time_val, lot_id, machine_no, (initial_total #>> '{{}}')::numeric as total_unit_count
+                from ({lots_sql}) lot_meta_info
+                where coalesce(lot_id #>> '{{}}', '') not in ('', '0')
+                and coalesce(initial_total #>> '{{}}', '') not in ('', '0')
+                order by time_val, lot_id
+            ),
+            over_reject_counts as (
+                select time_val, lot_id, count(*) as over_reject_count
+                from ({over_rejected_sql}) over_rejected
+                group by time_val, lot_id
+            ),
+            lot_counts as (
+                select l.*, coalesce(c.over_reject_count, 0) as over_reject_count
+                from lots l
+                left join over_reject_counts c on c.time_val = l.time_val and c.lot_id = l.lot_id
+                where l.total_unit_count <> 0
+            )
+            select
+                time_val,
+                lot_id,
+                machine_no,
+                total_unit_count,
+                over_reject_count,
+                sum(total_unit_count) over (partition by time_val, machine_no) as machine_total_unit_count,
+                sum(over_reject_count) over (partition by time_val, machine_no) as machine_over_reject_count,
+                sum(total_unit_count) over (partition by machine_no) as overall_total_unit_count,
+                sum(over_reject_count) over (partition by machine_no) as overall_over_reject_count
+            from lot_counts
+            order by time_val, machine_no, lot_id
+        """.format(
+            lots_sql=lots_sql, over_rejected_sql=over_rejected_sql
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, list(lots_params) + list(over_rejected_params))
+            columns = [col[0] for col in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
 
-        response = {}
+    def overkill_trend(self, include_defects, exclude_defects, time_format="daily"):
+        """groups the lots of overkill_by_lot into the overkill charts
 
-        for defect_id in defect_time_val_file_sets:
-            if defect_id not in response:
-                response[defect_id] = {"name": defect_id_map[defect_id]}
-                for time_val in defect_time_val_file_sets[defect_id]:
-                    num = len(defect_time_val_file_sets[defect_id][time_val])
-                    den = time_val_initial_total[time_val]
-                    percentage = round(num * 100 / den, 2)
-                    time_str = convert_datetime_to_str(time_val, time_format)
-                    response[defect_id][time_str] = {
-                        "percentage": percentage,
-                        "ai_reject_count": num,
-                        "total_unit_count": den,
-                    }
+        Args:
+            include_defects (list): ids of the insignificant defects
+            exclude_defects (list): ids of all the other defects
+            time_format (str, optional): "daily", "weekly" or "monthly". Defaults to "daily".
 
-        return response
+        Returns:
+            [dict]: {"overkill_scatter": {time_str: [lot]}, "overkill_trend": [{"date_range": time_str, machine_no:
+                counts}], "machine_wise_overkill_rate": {machine_no: counts}}, the counts being
+                {"percentage", "over_reject_count", "total_unit_count"}
+        """
+        overkill_scatter_plot = {}
+        overkill_trend = {}
+        machine_wise_overkill_rate = {}
+        for lot in self.overkill_by_lot(include_defects, exclude_defects, time_format):
+            time_str = convert_datetime_to_str(lot["time_val"], time_format)
+            machine_no = lot["machine_no"]
+            total_unit_count = int(lot["total_unit_count"])
+            overkill_scatter_plot.setdefault(time_str, []).append(
+                {
+                    "machine_no": machine_no,
+                    "lot_id": lot["lot_id"],
+                    "percentage": round(lot["over_reject_count"] * 100 / total_unit_count, 2),
+                    "over_reject_count": lot["over_reject_count"],
+                    "total_unit_count": total_unit_count,
+                }
+            )
+            machine_total_unit_count = int(lot["machine_total_unit_count"])
+            machine_over_reject_count = int(lot["machine_over_reject_count"])
+            overkill_trend.setdefault(time_str, {"date_range": time_str})[machine_no] = {
+                "total_unit_count": machine_total_unit_count,
+                "over_reject_count": machine_over_reject_count,
+                "percentage": round(machine_over_reject_count * 100 / machine_total_unit_count, 2),
+            }
+            overall_total_unit_count = int(lot["overall_total_unit_count"])
+            overall_over_reject_count = int(lot["overall_over_reject_count"])
+            machine_wise_overkill_rate[machine_no] = {
+                "percentage": round(100 * overall_over_reject_count / overall_total_unit_count, 2),
+                "over_reject_count": overall_over_reject_count,
+                "total_unit_count": overall_total_unit_count,
+            }
+        return {
+            "overkill_scatter": overkill_scatter_plot,
+            "overkill_trend": list(overkill_trend.values()),
+            "machine_wise_overkill_rate": machine_wise_overkill_rate,
+        }
 
     def calculate_yield_loss_scatter_plot(self, imp_defects, time_format="daily"):
         machine_defective_file_set_counts = (
@@ -1606,6 +2102,12 @@ class AnalysisService:
 
 
 class StitchImageService:
+    """[stitches the images of an upload session into a new upload session. The stitched images are uploaded by a
+    bounded pool of STITCH_UPLOAD_WORKERS threads as combine_images hands them over, and their file sets / files are
+    inserted in batches while the next uploads run, so a stitch takes about as long as its slowest stage]"""
+
+    DB_WRITE_BATCH_SIZE = 500
+
     def stitch(self, upload_session_id):
         sys.path.append(GF7_DATA_PREP_PATH)
         from create_ui_folder import combine_images
@@ -1620,7 +2122,39 @@ class StitchImageService:
             subscription_id=old_upload_session.subscription_id,
             use_case_id=old_upload_session.use_case_id,
         )
-        all_new_local_files = combine_images(
+        # seconds spent in each stage, the upload is the sum over the workers
+        timings = {"combine": 0.0, "upload": 0.0, "db_write": 0.0}
+        started_at = time.perf_counter()
+        s3_client = S3Service().s3_client
+        max_pending = 2 * settings.STITCH_UPLOAD_WORKERS
+        pending = set()
+        uploaded = []
+        failed_count = 0
+
+        def upload(name, local_path, path):
+            upload_started_at = time.perf_counter()
+            s3_client.upload_file(local_path, AWS_STORAGE_BUCKET_NAME, path)
+            return name, path, time.perf_counter() - upload_started_at
+
+        def collect(done):
+            nonlocal failed_count
+            for future in done:
+                try:
+                    name, path, upload_time = future.result()
+                except Exception as e:
+                    logger.error(f"Could not upload a stitched image of upload session {upload_session_id}: {e}")
+                    failed_count += 1
+                    continue
+                timings["upload"] += upload_time
+                uploaded.append((name, path))
+
+        def write(batch):
+            db_write_started_at = time.perf_counter()
+            self._create_file_sets(new_upload_session, batch)
+            timings["db_write"] += time.perf_counter() - db_write_started_at
+
+        combine_started_at = time.perf_counter()
+        stitched = combine_images(
             file_paths,
             os.path.join(str(upload_session_id), str(uuid.uuid1().hex)),
             {
@@ -1629,15 +2163,55 @@ class StitchImageService:
                 "bucket": AWS_STORAGE_BUCKET_NAME,
             },
         )
-        for name, path in all_new_local_files.items():
-            file_set = FileSet.objects.create(
-                upload_session=new_upload_session, subscription_id=old_upload_session.subscription_id
+        # combine_images returns {name: local path}, a generator of (name, local path) lets the uploads start while
+        # the stitching goes on
+        stitched = iter(stitched.items() if isinstance(stitched, dict) else stitched)
+        with ThreadPoolExecutor(max_workers=settings.STITCH_UPLOAD_WORKERS) as executor:
+            while True:
+                next_image = next(stitched, None)
+                timings["combine"] += time.perf_counter() - combine_started_at
+                if next_image is None:
+                    break
+                name, local_path = next_image
+                # File.default_path reads the tenant from the connection, which is thread local
+                pending.add(executor.submit(upload, name, local_path, File.default_path(name)))
+                if len(pending) >= max_pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                if len(uploaded) >= self.DB_WRITE_BATCH_SIZE:
+                    write(uploaded[:])
+                    uploaded.clear()
+                combine_started_at = time.perf_counter()
+            collect(wait(pending).done)
+        write(uploaded)
+        timings["total"] = time.perf_counter() - started_at
+        logger.info(
+            f"Stitched upload session {upload_session_id} into {new_upload_session.id}, "
+            f"{failed_count} upload(s) failed: "
+            + json.dumps({stage: round(seconds, 3) for stage, seconds in timings.items()})
+        )
+        return timings
+
+    @staticmethod
+    def _create_file_sets(upload_session, images):
+        """[creates a file set with a single file for each of the (name, path) uploaded images]"""
+        if not images:
+            return
+        with transaction.atomic():
+            # bulk_create skips FileSet.save, the fields it sets from the upload session are set here
+            file_sets = FileSet.objects.bulk_create(
+                [
+                    FileSet(
+                        upload_session=upload_session,
+                        subscription_id=upload_session.subscription_id,
+                        use_case_id=upload_session.use_case_id,
+                    )
+                    for _ in images
+                ]
+            )
+            File.objects.bulk_create(
+                [File(file_set=file_set, name=name, path=path) for file_set, (name, path) in zip(file_sets, images)]
             )
-            file = File(name=name, file_set=file_set)
-            file.save()
-            s3_service = S3Service()
-            s3_service.upload_file(path, file.path)
-        return
 
 
 class BulkFeedbackService:
@@ -1807,6 +2381,8 @@ class UserAnnotationBulkActionService:
                     defect_ids
                 ):
                     raise ValidationError("Usecase not tagged to all defects provided in the request")
+            # bulk_create doesn't call UserClassification.save, the use case type is checked once for all the files
+            validate_use_case_type(UserClassification, file_ids, "CLASSIFICATION")
             all_use_case_types = all_use_cases.values_list("classification_type", flat=True).distinct()
             if len(all_use_case_types) > 1:
                 raise ValidationError("We don't support bulk create for different use case type file sets")
@@ -1861,8 +2437,7 @@ class UserAnnotationBulkActionService:
                 UserClassificationDefect.objects.bulk_create(user_classification_defects, ignore_conflicts=True)
 
             # ToDo: The following code to copy to GT should be removed once the UI has a feature to assign the GT
-            for user_classification in user_classifications:
-                user_classification.copy_to_gt()
+            promote_user_classifications([user_classification.id for user_classification in user_classifications])
 
     def classification_bulk_replace(self, file_ids, original_defect, new_defect, user_id):
         with transaction.atomic():
@@ -1879,8 +2454,7 @@ class UserAnnotationBulkActionService:
                 user_id=user_id,
             )
             # ToDo: The following code to copy to GT should be removed once the UI has a feature to assign the GT
-            for user_classification in user_classifications:
-                user_classification.copy_to_gt()
+            promote_user_classifications(user_classifications.values_list("id", flat=True))
 
     def classification_bulk_remove(self, file_ids, defect_ids, user_id, remove_all=False):
         with transaction.atomic():
@@ -1923,9 +2497,8 @@ class UserAnnotationBulkActionService:
                 )
                 # ToDo: The following code to copy to GT should be removed once the UI has a feature to assign the GT
                 GTClassification.objects.filter(file_id__in=file_ids).delete()
-                if user_classifications.exists():
-                    for user_classification in user_classifications:
-                        user_classification.copy_to_gt()
+                mark_files_stale(file_ids)
+                promote_user_classifications(user_classifications.values_list("id", flat=True))
 
     def detection_bulk_remove(self, file_ids, defect_ids, user_id, remove_all=False):
         with transaction.atomic():
@@ -1972,9 +2545,7 @@ class UserAnnotationBulkActionService:
                 )
                 # ToDo: The following code to copy to GT should be removed once the UI has a feature to assign the GT
                 GTDetection.objects.filter(file_id__in=file_ids).delete()
-                if user_detections.exists():
-                    for user_detection in user_detections:
-                        user_detection.copy_to_gt()
+                promote_user_detections(user_detections.values_list("id", flat=True))
 
     def detection_bulk_replace(self, file_ids, original_defect, new_defect, user_id):
         if not file_ids:
@@ -1992,5 +2563,4 @@ class UserAnnotationBulkActionService:
                 user_id=user_id,
             )
             # ToDo: The following code to copy to GT should be removed once the UI has a feature to assign the GT
-            for user_detection in user_detections:
-                user_detection.copy_to_gt()
+            promote_user_detections(user_detections.values_list("id", flat=True))
@@ -3,7 +3,7 @@ import sys
 from datetime import datetime
 
 from celery import shared_task, states
-from celery.signals import before_task_publish
+from celery.signals import before_task_publish, worker_process_init
 from django.core.exceptions import ValidationError
 
 logger = logging.getLogger(__name__)
@@ -43,7 +43,7 @@ def perform_retraining(self, training_session_id, schema="public"):
     from django.db.models import Q
     from django_tenants.utils import get_public_schema_name, get_tenant_model
     from apps.classif_ai.models import TrainingSession, TrainingSessionFileSet, FileRegion
-    from apps.classif_ai.helpers import calculate_iou
+    from apps.classif_ai.region_matching import match_regions_bulk
     from sixsense import settings
 
     sys.path.append(settings.DS_MODEL_INVOCATION_PATH)
@@ -88,62 +88,72 @@ def perform_retraining(self, training_session_id, schema="public"):
     ml_model.save()
     for start in range(0, total, batch_size):
         end = min(start + batch_size, total)
+        feedback_regions_by_file = {}
         for tfs in qs[start:end]:
             for file, regions in tfs.defects.items():
-                ai_regions = FileRegion.objects.filter(
-                    ml_model_id=training_session.new_ml_model_id, file_id=file, is_user_feedback=False
-                )
+                feedback_regions_by_file.setdefault(str(file), []).extend(regions)
+        if not feedback_regions_by_file:
+            continue
+        ai_regions_by_file = {}
+        for ai_region in FileRegion.objects.filter(
+            ml_model_id=training_session.new_ml_model_id,
+            file_id__in=list(feedback_regions_by_file.keys()),
+            is_user_feedback=False,
+        ):
+            ai_regions_by_file.setdefault(str(ai_region.file_id), []).append(ai_region)
+        if ml_model.type == "CLASSIFICATION":
+            matches = {}
+            for file, regions in feedback_regions_by_file.items():
+                matches[file] = []
                 for region in regions:
                     matching_region = None
-                    for ai_region in ai_regions:
-                        if ml_model.type == "CLASSIFICATION":
-                            if list(ai_region.defects)[0] == list(region["defects"])[0]:
-                                matching_region = [ai_region, None]
-                        else:
-                            iou = calculate_iou(
-                                [
-                                    region["region"]["coordinates"]["x"],
-                                    region["region"]["coordinates"]["y"],
-                                    region["region"]["coordinates"]["x"] + region["region"]["coordinates"]["w"],
-                                    region["region"]["coordinates"]["y"] + region["region"]["coordinates"]["h"],
-                                ],
-                                [
-                                    ai_region.region["coordinates"]["x"],
-                                    ai_region.region["coordinates"]["y"],
-                                    ai_region.region["coordinates"]["x"] + ai_region.region["coordinates"]["w"],
-                                    ai_region.region["coordinates"]["y"] + ai_region.region["coordinates"]["h"],
-                                ],
-                            )
-                            if iou > 0.4:
-                                if matching_region:
-                                    if matching_region[1] < iou:
-                                        matching_region = [ai_region, iou]
-                                else:
-                                    matching_region = [ai_region, iou]
-                    file_region = FileRegion(
-                        file_id=file,
-                        ml_model_id=training_session.new_ml_model_id,
-                        defects=region["defects"],
-                        region=region["region"],
-                        is_user_feedback=True,
-                    )
-                    if matching_region and ml_model.type == "CLASSIFICATION":
-                        matching_region[0].classification_correctness = True
-                        matching_region[0].save()
-                    elif matching_region:
-                        file_region.ai_region_id = matching_region[0].id
-                        file_region.save()
-                    else:
-                        file_region.save()
-                for ai_region in ai_regions.all():
-                    if ml_model.type == "CLASSIFICATION" and ai_region.classification_correctness == None:
-                        ai_region.classification_correctness = False
-                        ai_region.save()
-                    elif ml_model.type != "CLASSIFICATION" and ai_region.detection_correctness == None:
-                        ai_region.is_removed = True
-                        ai_region.classification_correctness = False
-                        ai_region.detection_correctness = False
-                        ai_region.save()
+                    for ai_region in ai_regions_by_file.get(file, []):
+                        if list(ai_region.defects)[0] == list(region["defects"])[0]:
+                            matching_region = ai_region
+                    matches[file].append((region, matching_region, None))
+        else:
+            matches = match_regions_bulk(
+                feedback_regions_by_file,
+                ai_regions_by_file,
+                FileRegion.IOU_THRESHOLD_FOR_DETECTION_CORRECTNESS,
+                get_target_region=lambda region: region["region"],
+            )
+        for file, file_matches in matches.items():
+            for region, matching_region, _ in file_matches:
+                file_region = FileRegion(
+                    file_id=file,
+                    ml_model_id=training_session.new_ml_model_id,
+                    defects=region["defects"],
+                    region=region["region"],
+                    is_user_feedback=True,
+                )
+                if matching_region and ml_model.type == "CLASSIFICATION":
+                    matching_region.classification_correctness = True
+                    matching_region.save()
+                elif matching_region:
+                    file_region.ai_region_id = matching_region.id
+                    file_region.save()
+                else:
+                    file_region.save()
+        # Saving the feedback regions updates the correctness of the matched ai regions, the ones left without
+        # feedback are marked incorrect.
+        unmatched_ai_regions = FileRegion.objects.filter(
+            ml_model_id=training_session.new_ml_model_id,
+            file_id__in=list(feedback_regions_by_file.keys()),
+            is_user_feedback=False,
+        )
+        if ml_model.type == "CLASSIFICATION":
+            unmatched_ai_regions = unmatched_ai_regions.filter(classification_correctness__isnull=True)
+        else:
+            unmatched_ai_regions = unmatched_ai_regions.filter(detection_correctness__isnull=True)
+        for ai_region in unmatched_ai_regions:
+            if ml_model.type == "CLASSIFICATION":
+                ai_region.classification_correctness = False
+            else:
+                ai_region.is_removed = True
+                ai_region.classification_correctness = False
+                ai_region.detection_correctness = False
+            ai_region.save()
 
 
 @shared_task(bind=True, ignore_result=True)
@@ -182,7 +192,35 @@ def copy_images_to_folder(self, input_data, schema="public"):
     set_schema(schema)
     from apps.classif_ai.models import FileSet
 
-    FileSet.objects.copy(input_data)
+    return FileSet.objects.copy(input_data)
+
+
+@shared_task(bind=True)
+def dispatch_file_set_inference(self, description, file_set_inference_queue_ids, schema="public"):
+    set_schema(schema)
+    from apps.classif_ai.services import InferenceDispatchService
+
+    result = InferenceDispatchService(file_set_inference_queue_ids).dispatch()
+    logger.info(f"Schema_name: {schema}, {description}: {result}")
+    return result
+
+
+@shared_task(bind=True, ignore_result=True)
+def refresh_classification_metric_rollups(self, schema="public"):
+    set_schema(schema)
+    from apps.classif_ai.service.metric_rollup_service import refresh_stale_rollups
+
+    refreshed = refresh_stale_rollups()
+    logger.info(f"Schema_name: {schema}, Refreshed classification metric rollups of {refreshed} day(s)")
+
+
+@shared_task(bind=True)
+def run_tenant_command(self, command_name, command_args, schema="public"):
+    from apps.classif_ai.tenant_runner import run_command_for_tenant
+
+    result = run_command_for_tenant(schema, command_name, command_args)
+    logger.info(f"Schema_name: {schema}, {command_name} took {result['seconds']}s, error: {result['error']}")
+    return result
 
 
 @before_task_publish.connect
@@ -207,3 +245,26 @@ def task_sent_handler(sender=None, headers=None, body=None, **kwargs):
                 task_args=info["argsrepr"],
                 task_kwargs=info["kwargsrepr"],
             )
+
+
+@worker_process_init.connect
+def warmup_model_cache(**kwargs):
+    """Loads the deployed models of every tenant into the model cache of the newly started worker process, so that
+    the first inference requests don't pay for downloading and loading the models."""
+    from django.conf import settings
+
+    if not settings.MODEL_CACHE_WARMUP_ON_WORKER_START:
+        return
+    from django.db import connection
+    from django_tenants.utils import get_public_schema_name, get_tenant_model
+    from apps.classif_ai.models import MlModel
+
+    for tenant in get_tenant_model().objects.exclude(schema_name=get_public_schema_name()):
+        try:
+            connection.set_tenant(tenant, include_public=True)
+            loaded_model_ids = MlModel.warmup_models()
+            logger.info(f"Schema_name: {tenant.schema_name}, Warmed up models: {loaded_model_ids}")
+        except Exception as e:
+            logger.exception(f"Model cache warmup failed for schema {tenant.schema_name}: {e}")
+    connection.set_schema_to_public()
+    logger.info(f"Model cache stats after warmup: {MlModel.models.stats()}")
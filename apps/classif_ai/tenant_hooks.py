@@ -0,0 +1,87 @@
+from typing import Callable, Dict, Optional, Tuple
+
+from django.core import checks
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DatabaseError, connection
+
+### what are tenant hooks?
+# Functions customizing the upload flow of a single tenant (e.g. reading the meta info from the file names). They are
+# registered explicitly with register_tenant_hook when their module is imported, i.e. once at startup, and looked up
+# by (schema name, hook) with a dict lookup.
+
+HOOKS = {
+    # (data) -> use case id of a live upload which doesn't specify it
+    "get_use_case_id",
+    # (data) -> data with meta_info filled in, before it's validated and saved
+    "populate_meta_info",
+    # (meta_file_path, subscription_id) -> meta info read from the header / yield xml of an upload session
+    "header_xml_to_dict",
+    "yield_xml_to_dict",
+    # (file_set) -> ml model the file set is inferred with when it's uploaded with perform_inference
+    "get_default_model_for_file_set",
+}
+# hooks every tenant needs, they are reported by the tenant_hooks check instead of failing on the first upload
+REQUIRED_HOOKS = ("get_use_case_id", "get_default_model_for_file_set")
+
+_hooks: Dict[Tuple[str, str], Callable] = {}
+
+
+def register_tenant_hook(schema_name: str, hook: str) -> Callable[[Callable], Callable]:
+    """[decorator registering the function as the given hook of the tenant]"""
+    if hook not in HOOKS:
+        raise ImproperlyConfigured(f"Unknown tenant hook '{hook}'")
+
+    def decorator(function: Callable) -> Callable:
+        if (schema_name, hook) in _hooks:
+            raise ImproperlyConfigured(f"The '{hook}' hook of tenant '{schema_name}' is already registered")
+        _hooks[(schema_name, hook)] = function
+        return function
+
+    return decorator
+
+
+def get_tenant_hook(hook: str, schema_name: Optional[str] = None) -> Optional[Callable]:
+    """[returns the hook of the tenant, the current one by default, None if it doesn't have one]"""
+    if schema_name is None:
+        schema_name = connection.tenant.schema_name
+    return _hooks.get((schema_name, hook))
+
+
+def require_tenant_hook(hook: str, schema_name: Optional[str] = None) -> Callable:
+    """[same as get_tenant_hook, raises ImproperlyConfigured if the tenant doesn't have the hook]"""
+    if schema_name is None:
+        schema_name = connection.tenant.schema_name
+    function = _hooks.get((schema_name, hook))
+    if function is None:
+        raise ImproperlyConfigured(f"Tenant '{schema_name}' has no '{hook}' hook")
+    return function
+
+
+@checks.register(checks.Tags.database)
+def check_tenant_hooks(app_configs, databases=None, **kwargs):
+    """[warns about the tenants missing one of the REQUIRED_HOOKS, runs with migrate and check --database]"""
+    if not databases:
+        return []
+    from django_tenants.utils import get_public_schema_name, get_tenant_model
+
+    try:
+        schema_names = list(
+            get_tenant_model()
+            .objects.exclude(schema_name=get_public_schema_name())
+            .values_list("schema_name", flat=True)
+        )
+    except DatabaseError:
+        # the tenants table doesn't exist before the first migration
+        return []
+    warnings = []
+    for schema_name in schema_names:
+        missing = [hook for hook in REQUIRED_HOOKS if (schema_name, hook) not in _hooks]
+        if missing:
+            warnings.append(
+                checks.Warning(
+                    f"Tenant '{schema_name}' has no {', '.join(missing)} hook(s)",
+                    hint="Register them with apps.classif_ai.tenant_hooks.register_tenant_hook",
+                    id="classif_ai.W001",
+                )
+            )
+    return warnings
@@ -0,0 +1,111 @@
+import logging
+import multiprocessing
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from io import StringIO
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from django.core.management import call_command
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+### how are the commands of every tenant run?
+# A tenant's run of a command only touches the tenant's schema, so the tenants are run side by side instead of one
+# after the other: in a bounded pool of processes forked from the calling one, or as run_tenant_command celery tasks
+# with at most `concurrency` of them in flight. Every tenant's run is timed and its failure is caught and reported
+# without stopping the others, the total time is roughly the one of the slowest tenant.
+
+TenantResult = Dict[str, Optional[object]]
+
+
+def get_tenant_schema_names(schema_names: Optional[Iterable[str]] = None) -> List[str]:
+    """[returns the given schema names, all the tenants except the public one by default]"""
+    from django_tenants.utils import get_public_schema_name, get_tenant_model
+
+    tenants = get_tenant_model().objects.exclude(schema_name=get_public_schema_name())
+    if schema_names is not None:
+        tenants = tenants.filter(schema_name__in=list(schema_names))
+    return list(tenants.order_by("schema_name").values_list("schema_name", flat=True))
+
+
+def run_command_for_tenant(schema_name: str, command_name: str, command_args: List[str]) -> TenantResult:
+    """[runs the management command in the schema of the tenant, returns its output, duration and error if it
+    failed]"""
+    from apps.classif_ai.tasks import set_schema
+
+    stdout = StringIO()
+    stderr = StringIO()
+    error = None
+    started_at = time.perf_counter()
+    try:
+        set_schema(schema_name)
+        call_command(command_name, *command_args, stdout=stdout, stderr=stderr)
+    except (Exception, SystemExit) as e:
+        # SystemExit / CommandError of a single tenant mustn't stop the others
+        logger.exception(f"Schema_name: {schema_name}, {command_name} failed: {e}")
+        error = f"{type(e).__name__}: {e}"
+    return {
+        "schema": schema_name,
+        "seconds": round(time.perf_counter() - started_at, 3),
+        "output": stdout.getvalue() + stderr.getvalue(),
+        "error": error,
+    }
+
+
+def _run_in_process_pool(
+    schema_names: List[str], command_name: str, command_args: List[str], concurrency: int
+) -> Iterator[TenantResult]:
+    # the forked processes mustn't share the connections of this one, they open their own
+    connections.close_all()
+    with ProcessPoolExecutor(max_workers=concurrency, mp_context=multiprocessing.get_context("fork")) as executor:
+        futures = {
+            executor.submit(run_command_for_tenant, schema_name, command_name, command_args): schema_name
+            for schema_name in schema_names
+        }
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    yield future.result()
+                except Exception as e:
+                    # the process running the tenant died
+                    error = f"{type(e).__name__}: {e}"
+                    yield {"schema": futures[future], "seconds": None, "output": "", "error": error}
+
+
+def _run_as_celery_tasks(
+    schema_names: List[str], command_name: str, command_args: List[str], concurrency: int, poll_interval: float = 1
+) -> Iterator[TenantResult]:
+    from apps.classif_ai.tasks import run_tenant_command
+
+    queued = list(schema_names)
+    in_flight = {}
+    while queued or in_flight:
+        while queued and len(in_flight) < concurrency:
+            schema_name = queued.pop(0)
+            in_flight[schema_name] = run_tenant_command.delay(command_name, command_args, schema=schema_name)
+        ready = [schema_name for schema_name, async_result in in_flight.items() if async_result.ready()]
+        if not ready:
+            time.sleep(poll_interval)
+        for schema_name in ready:
+            async_result = in_flight.pop(schema_name)
+            if async_result.successful():
+                yield async_result.result
+            else:
+                yield {"schema": schema_name, "seconds": None, "output": "", "error": repr(async_result.result)}
+
+
+def run_command_for_tenants(
+    command_name: str,
+    command_args: List[str],
+    schema_names: List[str],
+    concurrency: int = 4,
+    use_celery: bool = False,
+) -> Iterator[TenantResult]:
+    """[runs the management command for every tenant, at most concurrency of them at a time, yields the result of
+    every tenant as soon as it's done]"""
+    if use_celery:
+        return _run_as_celery_tasks(schema_names, command_name, command_args, concurrency)
+    return _run_in_process_pool(schema_names, command_name, command_args, concurrency)
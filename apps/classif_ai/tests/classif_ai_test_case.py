@@ -7,6 +7,7 @@ from datetime import datetime, timedelta
 from apps.subscriptions.models import Subscription
 from apps.users.models import SubOrganization
 from apps.packs.models import Pack
+from common.services import Boto3ClientRegistry
 from sixsense.settings import AWS_STORAGE_BUCKET_NAME
 from sixsense.tenant_test_case import SixsenseTenantTestCase
 
@@ -72,6 +73,8 @@ class ClassifAiTestCase(SixsenseTenantTestCase):
 
     def setUp(self):
         super(ClassifAiTestCase, self).setUp()
+        # Clients cached by a previous test may have been created outside of this test's mock.
+        Boto3ClientRegistry.reset()
         conn = boto3.resource("s3", region_name="us-east-1")
         # We need to create the bucket since this is all in Moto's 'virtual' AWS account
         conn.create_bucket(Bucket=AWS_STORAGE_BUCKET_NAME)
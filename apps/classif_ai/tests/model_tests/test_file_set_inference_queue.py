@@ -59,3 +59,25 @@ class FileSetInferenceQueueTest(ValidationErrorTestMixin, ClassifAiTestCase):
         )
         with self.assertValidationErrors(["__all__"]):
             file_set_inference_queue.full_clean()
+
+    def test_partial_create(self):
+        valid_meta_info = {"tray_id": "abcd", "Pass": 1, "row_and_col_id": "xyz", "StartDate": "2020-08-01 06:00"}
+        new_file_set = FileSet.objects.create(
+            upload_session=self.upload_session, subscription=self.subscription, meta_info=valid_meta_info
+        )
+        task_id = FileSetInferenceQueue.objects.partial_create(
+            [
+                FileSetInferenceQueue(file_set=self.file_set, ml_model=self.ml_model, status="PENDING"),
+                FileSetInferenceQueue(file_set=new_file_set, ml_model=self.ml_model, status="PENDING"),
+                FileSetInferenceQueue(file_set=new_file_set, ml_model=self.ml_model, status="PENDING"),
+            ]
+        )
+        self.assertIsNotNone(task_id)
+        self.assertEqual(FileSetInferenceQueue.objects.filter(file_set=self.file_set).count(), 3)
+        self.assertEqual(FileSetInferenceQueue.objects.filter(file_set=new_file_set, status="PENDING").count(), 1)
+
+        task_id = FileSetInferenceQueue.objects.partial_create(
+            [FileSetInferenceQueue(file_set=new_file_set, ml_model=self.ml_model, status="PENDING")]
+        )
+        self.assertIsNone(task_id)
+        self.assertEqual(FileSetInferenceQueue.objects.filter(file_set=new_file_set).count(), 1)
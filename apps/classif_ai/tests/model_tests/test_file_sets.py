@@ -102,3 +102,38 @@ class FileSetTest(ValidationErrorTestMixin, IntegrityErrorTestMixin, ClassifAiTe
         self.assertFalse(File.objects.filter(id=file.id).exists())
         self.assertFalse(FileRegion.objects.filter(id=file_region.id).exists())
         self.assertFalse(FileSetInferenceQueue.objects.filter(id=file_set_inference_queue.id).exists())
+
+    def test_copy(self):
+        file_set = FileSet.objects.create(
+            upload_session=self.upload_session, subscription=self.subscription, meta_info=self.valid_meta_info
+        )
+        File.objects.create(file_set=file_set, name="test-file-1.jpg", path="test/test-file-1.jpg")
+        File.objects.create(file_set=file_set, name="test-file-2.jpg", path="test/test-file-2.jpg")
+        target_upload_session = UploadSession.objects.create(
+            name="test-target-session", subscription=self.subscription, use_case=self.detection_use_case
+        )
+        result = FileSet.objects.copy(
+            {
+                "file_set_filters": {"upload_session_id__in": str(self.upload_session.id)},
+                "upload_session_id": target_upload_session.id,
+            }
+        )
+        self.assertEqual(result, {"file_sets": 1, "files": 2})
+        copied_file_set = FileSet.objects.get(upload_session=target_upload_session)
+        self.assertNotEqual(copied_file_set.id, file_set.id)
+        self.assertEqual(copied_file_set.use_case_id, self.detection_use_case.id)
+        self.assertEqual(copied_file_set.meta_info, self.valid_meta_info)
+        self.assertEqual(
+            sorted(copied_file_set.files.values_list("name", "path")),
+            [("test-file-1.jpg", "test/test-file-1.jpg"), ("test-file-2.jpg", "test/test-file-2.jpg")],
+        )
+
+        # the files already in the upload session are skipped
+        result = FileSet.objects.copy(
+            {
+                "file_set_filters": {"upload_session_id__in": str(self.upload_session.id)},
+                "upload_session_id": target_upload_session.id,
+                "skip_existing_images": True,
+            }
+        )
+        self.assertEqual(result, {"file_sets": 0, "files": 0})
@@ -56,3 +56,14 @@ class ModelClassificationDefectTest(ClassifAiTestCase, ValidationErrorTestMixin,
         model_classification_defect = ModelClassificationDefect(classification=self.classification, defect=self.defect)
         with self.asssertIntegrityErrors(["classification", "defect"]):
             model_classification_defect.save()
+
+    def test_top_defects(self):
+        other_defect = Defect.objects.create(name="other-defect", code="other-code", subscription=self.subscription)
+        ModelClassificationDefect.objects.create(classification=self.classification, defect=other_defect)
+        ml_model_ids = [self.classification.ml_model_id]
+
+        top_defects = ModelClassificationDefect.objects.top_defects(ml_model_ids, [other_defect.id, self.defect.id])
+        self.assertEqual(list(top_defects.values_list("defect_id", flat=True)), [other_defect.id])
+        top_defects = ModelClassificationDefect.objects.top_defects(ml_model_ids, [self.defect.id])
+        self.assertEqual(list(top_defects.values_list("defect_id", flat=True)), [self.defect.id])
+        self.assertFalse(ModelClassificationDefect.objects.top_defects([0], [self.defect.id]).exists())
@@ -0,0 +1,269 @@
+from collections import Counter
+from datetime import datetime, timedelta
+
+import pytz
+from django.db.models.functions import TruncDay, TruncWeek
+
+from apps.classif_ai.models import Defect, File, FileRegion, FileSet, MlModel, MlModelDefect, UploadSession
+from apps.classif_ai.services import AnalysisService
+from apps.classif_ai.tests.classif_ai_test_case import ClassifAiTestCase
+
+DAY_1 = datetime(2021, 10, 4, 10, tzinfo=pytz.UTC)
+DAY_2 = datetime(2021, 10, 5, 10, tzinfo=pytz.UTC)
+# a week later, none of the regions of its file set has any feedback
+DAY_3 = datetime(2021, 10, 12, 10, tzinfo=pytz.UTC)
+
+
+class AnalysisServiceTestCase(ClassifAiTestCase):
+    """a multi-label, a single-label and a detection model along with their regions over 3 days. The regions are
+    bulk created, FileRegion.save would otherwise derive the correctness flags from each other."""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.defects = [
+            Defect.objects.create(name=f"defect-{index}", code=f"defect-{index}", subscription=cls.subscription)
+            for index in range(1, 5)
+        ]
+        # the last defect is never predicted nor given as feedback
+        d1, d2, d3, _ = cls.defects
+        cls.multi_label_model = cls.create_ml_model("multi-label", cls.use_case)
+        cls.single_label_model = cls.create_ml_model("single-label", cls.single_label_use_case)
+        cls.detection_model = cls.create_ml_model("detection", cls.detection_use_case)
+
+        ml_model = cls.multi_label_model
+        file = cls.create_file(ml_model, DAY_1)
+        cls.create_region(file, ml_model, [d1, d2], classification_correctness=True)
+        wrong = cls.create_region(file, ml_model, [d1], classification_correctness=False)
+        cls.create_region(file, ml_model, [d2], ai_region=wrong, is_user_feedback=True)
+        file = cls.create_file(ml_model, DAY_2)
+        wrong = cls.create_region(file, ml_model, [d2, d3], classification_correctness=False)
+        cls.create_region(file, ml_model, [d2], ai_region=wrong, is_user_feedback=True)
+        cls.create_region(file, ml_model, [d1], is_user_feedback=True)
+        file = cls.create_file(ml_model, DAY_3)
+        cls.create_region(file, ml_model, [d1])
+
+        ml_model = cls.single_label_model
+        file = cls.create_file(ml_model, DAY_1)
+        cls.create_region(file, ml_model, [d1], classification_correctness=True)
+        wrong = cls.create_region(file, ml_model, [d2], classification_correctness=False)
+        cls.create_region(file, ml_model, [d1], ai_region=wrong, is_user_feedback=True)
+        file = cls.create_file(ml_model, DAY_2)
+        cls.create_region(file, ml_model, [d1], classification_correctness=True)
+
+        ml_model = cls.detection_model
+        file = cls.create_file(ml_model, DAY_1)
+        cls.create_region(file, ml_model, [d1], detection_correctness=True, classification_correctness=True)
+        wrong = cls.create_region(
+            file, ml_model, [d1, d2], detection_correctness=True, classification_correctness=False
+        )
+        cls.create_region(file, ml_model, [d2, d3], ai_region=wrong, is_user_feedback=True, detection_correctness=True)
+        cls.create_region(file, ml_model, [d3], detection_correctness=False)
+        file = cls.create_file(ml_model, DAY_2)
+        cls.create_region(file, ml_model, [d2], is_user_feedback=True)
+        cls.create_region(file, ml_model, [d1])
+
+    @classmethod
+    def create_ml_model(cls, name, use_case):
+        ml_model = MlModel.objects.create(
+            name=name,
+            code=name,
+            version=1,
+            status="ready_for_deployment",
+            subscription=cls.subscription,
+            use_case=use_case,
+        )
+        for defect in cls.defects:
+            MlModelDefect.objects.create(ml_model=ml_model, defect=defect)
+        return ml_model
+
+    @classmethod
+    def create_file(cls, ml_model, created_ts):
+        upload_session = UploadSession.objects.create(
+            name=f"{ml_model.name}-{created_ts:%Y-%m-%d}", subscription=cls.subscription, use_case=ml_model.use_case
+        )
+        file_set = FileSet.objects.create(upload_session=upload_session, subscription=cls.subscription)
+        FileSet.objects.filter(id=file_set.id).update(created_ts=created_ts)
+        return File.objects.create(file_set=file_set, name="test-file", path="test/test-file")
+
+    @classmethod
+    def create_region(cls, file, ml_model, defects, **fields):
+        region = FileRegion(
+            file=file,
+            ml_model=ml_model,
+            defects={str(defect.id): {"confidence": 0.9} for defect in defects},
+            **fields,
+        )
+        return FileRegion.objects.bulk_create([region])[0]
+
+    def analysis_service(self, ml_model, file_set_filters=None):
+        return AnalysisService(file_set_filters, {"id__in": [ml_model.id]})
+
+
+class AccuracyTrendTest(AnalysisServiceTestCase):
+    def assert_trend(self, ml_model, time_function, period, expected):
+        """expected is {bucket: (classification, detection, overall accuracy)}, every bucket is also compared with an
+        AnalysisService limited to the file sets created in it"""
+        trend = self.analysis_service(ml_model).accuracy_trend(time_function)
+        self.assertEqual([row["bucket"] for row in trend], list(expected))
+        for row in trend:
+            accuracy = (row["classification_accuracy"], row["detection_accuracy"], row["overall_accuracy"])
+            self.assertEqual(accuracy, expected[row["bucket"]])
+            service = self.analysis_service(
+                ml_model, {"created_ts__gte": row["bucket"], "created_ts__lt": row["bucket"] + period}
+            )
+            self.assertEqual(
+                accuracy, (service.classification_accuracy(), service.detection_accuracy(), service.overall_accuracy())
+            )
+
+    def test_multi_label(self):
+        self.assert_trend(
+            self.multi_label_model,
+            TruncDay,
+            timedelta(days=1),
+            {
+                datetime(2021, 10, 4, tzinfo=pytz.UTC): (50.0, "N/A", 50.0),
+                datetime(2021, 10, 5, tzinfo=pytz.UTC): (33.33, 0.0, 33.33),
+                datetime(2021, 10, 12, tzinfo=pytz.UTC): ("N/A", "N/A", "N/A"),
+            },
+        )
+        self.assert_trend(
+            self.multi_label_model,
+            TruncWeek,
+            timedelta(weeks=1),
+            {
+                datetime(2021, 10, 4, tzinfo=pytz.UTC): (55.56, 0.0, 42.86),
+                datetime(2021, 10, 11, tzinfo=pytz.UTC): ("N/A", "N/A", "N/A"),
+            },
+        )
+
+    def test_single_label(self):
+        self.assert_trend(
+            self.single_label_model,
+            TruncDay,
+            timedelta(days=1),
+            {
+                datetime(2021, 10, 4, tzinfo=pytz.UTC): (50, "N/A", 33.33),
+                datetime(2021, 10, 5, tzinfo=pytz.UTC): (100, "N/A", 100.0),
+                datetime(2021, 10, 12, tzinfo=pytz.UTC): ("N/A", "N/A", "N/A"),
+            },
+        )
+
+    def test_detection(self):
+        self.assert_trend(
+            self.detection_model,
+            TruncDay,
+            timedelta(days=1),
+            {
+                datetime(2021, 10, 4, tzinfo=pytz.UTC): (80.0, 100.0, 40.0),
+                datetime(2021, 10, 5, tzinfo=pytz.UTC): ("N/A", 0.0, 0.0),
+                datetime(2021, 10, 12, tzinfo=pytz.UTC): ("N/A", "N/A", "N/A"),
+            },
+        )
+        self.assert_trend(
+            self.detection_model,
+            TruncWeek,
+            timedelta(weeks=1),
+            {
+                datetime(2021, 10, 4, tzinfo=pytz.UTC): (80.0, 75.0, 33.33),
+                datetime(2021, 10, 11, tzinfo=pytz.UTC): ("N/A", "N/A", "N/A"),
+            },
+        )
+
+
+class ClassWiseMatrixTest(AnalysisServiceTestCase):
+    def assert_class_wise_matrix(self, ml_model, expected):
+        """expected is the (tp, fp, fn, tn, precision, recall) of every defect, the tp / fp / fn counts are also
+        compared with the per defect querysets the matrix used to be made of"""
+        service = self.analysis_service(ml_model)
+        rows = {row["defect"]["id"]: row for row in service.class_wise_matrix_data()}
+        self.assertEqual(set(rows), {defect.id for defect in self.defects})
+        for defect, counts in zip(self.defects, expected):
+            row = rows[defect.id]
+            self.assertEqual(row["defect"]["name"], defect.name)
+            self.assertEqual(
+                (
+                    row["true_positives"]["count"],
+                    row["false_positives"]["count"],
+                    row["false_negatives"]["count"],
+                    row["true_negatives"]["count"],
+                    row["precision"],
+                    row["recall"],
+                ),
+                counts,
+            )
+            self.assertEqual(
+                (row["true_positives"]["count"], row["false_positives"]["count"], row["false_negatives"]["count"]),
+                (
+                    service.true_positive_file_regions_for_defect(defect.id).count(),
+                    service.false_positive_file_regions_for_defect(defect.id).count(),
+                    service.false_negative_file_regions_for_defect(defect.id).count(),
+                ),
+            )
+
+    def test_multi_label(self):
+        # the last defect is never predicted, nor is there a feedback of it
+        self.assert_class_wise_matrix(
+            self.multi_label_model,
+            [(1, 1, 1, 0, 50.0, 50.0), (2, 1, 2, 0, 66.67, 50.0), (0, 1, 0, 2, None, None), (0, 0, 0, 2, None, None)],
+        )
+        self.assertEqual(self.analysis_service(self.multi_label_model).true_negatives_count(), 2)
+
+    def test_single_label(self):
+        self.assert_class_wise_matrix(
+            self.single_label_model,
+            [(1, 0, 1, 0, 100.0, 50.0), (0, 1, 0, 1, None, None), (0, 0, 0, 1, None, None), (0, 0, 0, 1, None, None)],
+        )
+
+    def test_detection(self):
+        self.assert_class_wise_matrix(
+            self.detection_model,
+            [(1, 1, 0, 2, 50.0, 100.0), (1, 0, 0, 1, 100.0, 100.0), (0, 0, 1, 3, None, None), (0, 0, 0, 3, None, None)],
+        )
+        self.assertEqual(self.analysis_service(self.detection_model).true_negatives_count(), 6)
+
+
+class LabelCountsTest(AnalysisServiceTestCase):
+    @staticmethod
+    def flags(regions):
+        return Counter(regions.values_list("is_user_feedback", "classification_correctness", "detection_correctness"))
+
+    def test_detected_file_regions_by_type(self):
+        service = self.analysis_service(self.multi_label_model)
+        combined, classification = service._detected_file_regions_by_type()
+        self.assertFalse(combined.exists())
+        self.assertEqual(self.flags(classification), {(False, True, None): 1, (False, False, None): 2})
+        combined, classification = service._detected_file_regions_by_type(include_user_feedback=True)
+        self.assertFalse(combined.exists())
+        self.assertEqual(
+            self.flags(classification), {(False, True, None): 1, (False, False, None): 2, (True, None, None): 3}
+        )
+
+        # the feedback regions of detection models are detected once their detection is marked correct
+        service = self.analysis_service(self.detection_model)
+        for include_user_feedback in [False, True]:
+            combined, classification = service._detected_file_regions_by_type(include_user_feedback)
+            self.assertEqual(
+                self.flags(combined), {(False, True, True): 1, (False, False, True): 1, (True, None, True): 1}
+            )
+            self.assertFalse(classification.exists())
+
+    def test_multi_label(self):
+        # the new feedback region is only a false negative as a user feedback region
+        self.assertEqual(
+            self.analysis_service(self.multi_label_model)._calculate_label_counts(),
+            {"true_positives": 3, "false_negatives": 2, "false_positives": 2},
+        )
+
+    def test_single_label(self):
+        self.assertEqual(
+            self.analysis_service(self.single_label_model)._calculate_label_counts(),
+            {"true_positives": 1, "false_negatives": 1, "false_positives": 1},
+        )
+
+    def test_detection(self):
+        # the new feedback region isn't detected, its detection isn't marked correct
+        self.assertEqual(
+            self.analysis_service(self.detection_model)._calculate_label_counts(),
+            {"true_positives": 2, "false_negatives": 1, "false_positives": 1},
+        )
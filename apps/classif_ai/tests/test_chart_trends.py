@@ -0,0 +1,231 @@
+import os
+from datetime import datetime
+from unittest import mock
+
+import pytz
+
+from apps.classif_ai.management.commands.benchmark_chart_queries import (
+    comparable_overkill_trend,
+    legacy_overkill_trend,
+    legacy_yield_loss_trend,
+)
+from apps.classif_ai.models import Defect, File, FileRegion, FileSet, FileSetInferenceQueue, MlModel, UploadSession
+from apps.classif_ai.services import AnalysisService
+from apps.classif_ai.tests.classif_ai_test_case import ClassifAiTestCase
+
+MONDAY = datetime(2021, 10, 4, 10, tzinfo=pytz.UTC)
+TUESDAY = datetime(2021, 10, 5, 10, tzinfo=pytz.UTC)
+NEXT_MONTH = datetime(2021, 11, 2, 10, tzinfo=pytz.UTC)
+
+
+class ChartTrendTestCase(ClassifAiTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.ml_model = MlModel.objects.create(
+            name="test-model",
+            code="test-code",
+            version=1,
+            status="ready_for_deployment",
+            subscription=cls.subscription,
+            use_case=cls.use_case,
+        )
+        cls.first, cls.second, cls.insignificant = [
+            Defect.objects.create(name=name, code=name, subscription=cls.subscription)
+            for name in ["first", "second", "insignificant"]
+        ]
+        cls.upload_session = UploadSession.objects.create(
+            name="test-upload", subscription=cls.subscription, use_case=cls.use_case
+        )
+
+    @classmethod
+    def create_file_set(cls, created_ts, meta_info, regions=(), is_user_feedback=False, status="FINISHED"):
+        """creates a file set with a file holding a region for each list of defects in regions. The meta info and
+        created_ts are updated afterwards, the subscription's meta info fields don't know the lot fields."""
+        file_set = FileSet.objects.create(upload_session=cls.upload_session, subscription=cls.subscription)
+        FileSet.objects.filter(id=file_set.id).update(created_ts=created_ts, meta_info=meta_info)
+        # saving an inference queue would start the inference
+        FileSetInferenceQueue.objects.bulk_create(
+            [FileSetInferenceQueue(file_set=file_set, ml_model=cls.ml_model, status=status)]
+        )
+        file = File.objects.create(file_set=file_set, name="test-file", path="test/test-file")
+        FileRegion.objects.bulk_create(
+            [
+                FileRegion(
+                    file=file,
+                    ml_model=cls.ml_model,
+                    defects={str(defect.id): {"confidence": 0.9} for defect in defects},
+                    is_user_feedback=is_user_feedback,
+                )
+                for defects in regions
+            ]
+        )
+        return file_set
+
+    def analysis_service(self):
+        return AnalysisService({"subscription_id__in": [self.subscription.id]}, {"id__in": [self.ml_model.id]})
+
+
+class YieldLossTrendTest(ChartTrendTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        first, second, insignificant = cls.first, cls.second, cls.insignificant
+        lot_1 = {"lot_id": "L1", "InitialTotal": 100, "MachineNo": "M1"}
+        lot_2 = {"lot_id": "L2", "InitialTotal": 50, "MachineNo": "M2"}
+        # several file sets of the same lot, its units are counted once
+        cls.create_file_set(MONDAY, lot_1, [[first, second]])
+        cls.create_file_set(MONDAY, lot_1, [[second]])
+        cls.create_file_set(MONDAY, lot_1, [[insignificant]])
+        cls.create_file_set(MONDAY, lot_1)
+        cls.create_file_set(MONDAY, lot_2, [[first]])
+        cls.create_file_set(MONDAY, lot_2, [[second]], is_user_feedback=True)
+        # without an InitialTotal, neither rejected nor counted
+        cls.create_file_set(MONDAY, {"lot_id": "L3"}, [[first]])
+        lot_4 = {"lot_id": "L4", "InitialTotal": 200, "MachineNo": "M1"}
+        cls.create_file_set(TUESDAY, lot_4, [[second]])
+        cls.create_file_set(TUESDAY, lot_4, [[first], [second]])
+        # the lot of an unfinished inference isn't counted
+        cls.create_file_set(TUESDAY, {"lot_id": "L5", "InitialTotal": 1000, "MachineNo": "M1"}, status="PENDING")
+
+    def yield_loss_trend(self, priority=False):
+        defect_id_map = {self.first.id: "first", self.second.id: "second"}
+        imp_defects = [self.first.id, self.second.id]
+        with mock.patch.dict(os.environ, {"ORDERED_DEFECT_IDS": str(self.first.id)}):
+            trend = self.analysis_service().yield_loss_trend_grouped_by_defect(
+                defect_id_map, imp_defects, "daily", priority
+            )
+        if not priority:
+            self.assertEqual(
+                trend, legacy_yield_loss_trend(self.analysis_service(), defect_id_map, imp_defects, "daily")
+            )
+        return trend
+
+    def test_without_priority(self):
+        self.assertEqual(
+            self.yield_loss_trend(),
+            {
+                self.first.id: {
+                    "name": "first",
+                    "2021-10-04": {"percentage": 1.33, "ai_reject_count": 2, "total_unit_count": 150},
+                    "2021-10-05": {"percentage": 0.5, "ai_reject_count": 1, "total_unit_count": 200},
+                },
+                self.second.id: {
+                    "name": "second",
+                    "2021-10-04": {"percentage": 1.33, "ai_reject_count": 2, "total_unit_count": 150},
+                    "2021-10-05": {"percentage": 1.0, "ai_reject_count": 2, "total_unit_count": 200},
+                },
+            },
+        )
+
+    def test_priority(self):
+        # the file sets with both defects are only counted for the first one
+        self.assertEqual(
+            self.yield_loss_trend(priority=True),
+            {
+                self.first.id: {
+                    "name": "first",
+                    "2021-10-04": {"percentage": 1.33, "ai_reject_count": 2, "total_unit_count": 150},
+                    "2021-10-05": {"percentage": 0.5, "ai_reject_count": 1, "total_unit_count": 200},
+                },
+                self.second.id: {
+                    "name": "second",
+                    "2021-10-04": {"percentage": 0.67, "ai_reject_count": 1, "total_unit_count": 150},
+                    "2021-10-05": {"percentage": 0.5, "ai_reject_count": 1, "total_unit_count": 200},
+                },
+            },
+        )
+
+
+class OverkillTrendTest(ChartTrendTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        first, insignificant = cls.first, cls.insignificant
+        lot_1 = {"lot_id": "L1", "InitialTotal": 100, "MachineNo": "M1"}
+        # over rejected: only insignificant defects or no region at all
+        cls.create_file_set(MONDAY, lot_1, [[insignificant]])
+        cls.create_file_set(MONDAY, lot_1)
+        cls.create_file_set(MONDAY, lot_1, [[first]])
+        cls.create_file_set(MONDAY, {"lot_id": "L2", "InitialTotal": 50, "MachineNo": "M1"}, [[insignificant]])
+        cls.create_file_set(MONDAY, {"lot_id": "L3", "InitialTotal": 200, "MachineNo": "M2"}, [[first]])
+        # lots without units are left out
+        cls.create_file_set(MONDAY, {"lot_id": "L4", "InitialTotal": 0, "MachineNo": "M2"}, [[insignificant]])
+        cls.create_file_set(MONDAY, {"lot_id": "L5", "MachineNo": "M2"}, [[insignificant]])
+        # the same lot the next day, a separate lot of the daily buckets only
+        cls.create_file_set(TUESDAY, lot_1, [[insignificant]])
+        cls.create_file_set(TUESDAY, {"lot_id": "L6", "InitialTotal": 300, "MachineNo": "M2"})
+        cls.create_file_set(NEXT_MONTH, {"lot_id": "L7", "InitialTotal": 80, "MachineNo": "M1"}, [[insignificant]])
+
+    def overkill_trend(self, time_format):
+        include_defects = [str(self.insignificant.id)]
+        exclude_defects = [self.first.id, self.second.id]
+        trend = self.analysis_service().overkill_trend(include_defects, exclude_defects, time_format)
+        self.assertEqual(
+            comparable_overkill_trend(trend),
+            comparable_overkill_trend(legacy_overkill_trend(self.analysis_service(), include_defects, time_format)),
+        )
+        return trend
+
+    @staticmethod
+    def lot(machine_no, lot_id, over_reject_count, total_unit_count):
+        return {
+            "machine_no": machine_no,
+            "lot_id": lot_id,
+            "percentage": round(over_reject_count * 100 / total_unit_count, 2),
+            "over_reject_count": over_reject_count,
+            "total_unit_count": total_unit_count,
+        }
+
+    @staticmethod
+    def counts(percentage, over_reject_count, total_unit_count):
+        return {"percentage": percentage, "over_reject_count": over_reject_count, "total_unit_count": total_unit_count}
+
+    def test_daily(self):
+        self.assertEqual(
+            self.overkill_trend("daily"),
+            {
+                "overkill_scatter": {
+                    "2021-10-04": [
+                        self.lot("M1", "L1", 2, 100),
+                        self.lot("M1", "L2", 1, 50),
+                        self.lot("M2", "L3", 0, 200),
+                    ],
+                    "2021-10-05": [self.lot("M1", "L1", 1, 100), self.lot("M2", "L6", 1, 300)],
+                    "2021-11-02": [self.lot("M1", "L7", 1, 80)],
+                },
+                "overkill_trend": [
+                    {"date_range": "2021-10-04", "M1": self.counts(2.0, 3, 150), "M2": self.counts(0.0, 0, 200)},
+                    {"date_range": "2021-10-05", "M1": self.counts(1.0, 1, 100), "M2": self.counts(0.33, 1, 300)},
+                    {"date_range": "2021-11-02", "M1": self.counts(1.25, 1, 80)},
+                ],
+                "machine_wise_overkill_rate": {"M1": self.counts(1.52, 5, 330), "M2": self.counts(0.2, 1, 500)},
+            },
+        )
+
+    def assert_lot_counted_once(self, time_format, october, november):
+        self.assertEqual(
+            self.overkill_trend(time_format),
+            {
+                "overkill_scatter": {
+                    october: [
+                        self.lot("M1", "L1", 3, 100),
+                        self.lot("M1", "L2", 1, 50),
+                        self.lot("M2", "L3", 0, 200),
+                        self.lot("M2", "L6", 1, 300),
+                    ],
+                    november: [self.lot("M1", "L7", 1, 80)],
+                },
+                "overkill_trend": [
+                    {"date_range": october, "M1": self.counts(2.67, 4, 150), "M2": self.counts(0.2, 1, 500)},
+                    {"date_range": november, "M1": self.counts(1.25, 1, 80)},
+                ],
+                "machine_wise_overkill_rate": {"M1": self.counts(2.17, 5, 230), "M2": self.counts(0.2, 1, 500)},
+            },
+        )
+
+    def test_weekly(self):
+        self.assert_lot_counted_once("weekly", "2021-10-04 : 2021-10-11", "2021-11-01 : 2021-11-08")
+
+    def test_monthly(self):
+        self.assert_lot_counted_once("monthly", "2021-10-01 : 2021-10-31", "2021-11-01 : 2021-11-30")
@@ -0,0 +1,161 @@
+from django.contrib.postgres.aggregates import JSONBAgg
+from django.db.models import Count
+
+from apps.classif_ai.models import (
+    Defect,
+    File,
+    FileRegion,
+    FileSet,
+    FileSetInferenceQueue,
+    MlModel,
+    UploadSession,
+)
+from apps.classif_ai.services import AnalysisService
+from apps.classif_ai.tests.classif_ai_test_case import ClassifAiTestCase
+from apps.classif_ai.views.metrics_views import ai_results_csv_rows, prediction_csv_rows
+
+
+class CsvExportTestCase(ClassifAiTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.first, cls.second = [
+            Defect.objects.create(name=name, code=name, subscription=cls.subscription) for name in ["first", "second"]
+        ]
+        cls.upload_sessions = {}
+
+    @classmethod
+    def create_ml_model(cls, name, use_case):
+        ml_model = MlModel.objects.create(
+            name=name,
+            code=name,
+            version=1,
+            status="ready_for_deployment",
+            subscription=cls.subscription,
+            use_case=use_case,
+        )
+        cls.upload_sessions[ml_model.id] = UploadSession.objects.create(
+            name=f"{name}-upload", subscription=cls.subscription, use_case=use_case
+        )
+        return ml_model
+
+    @classmethod
+    def create_file_set(cls, ml_model, file_name, meta_info=None):
+        """creates a file set with a single file and a finished inference of the ml model"""
+        file_set = FileSet.objects.create(
+            upload_session=cls.upload_sessions[ml_model.id], subscription=cls.subscription
+        )
+        if meta_info:
+            # the subscription's meta info fields don't know the lot fields
+            FileSet.objects.filter(id=file_set.id).update(meta_info=meta_info)
+        # saving an inference queue would start the inference
+        FileSetInferenceQueue.objects.bulk_create(
+            [FileSetInferenceQueue(file_set=file_set, ml_model=ml_model, status="FINISHED")]
+        )
+        return File.objects.create(file_set=file_set, name=file_name, path=f"test/{file_name}")
+
+    @classmethod
+    def create_region(cls, file, ml_model, defects, **fields):
+        # bulk created, FileRegion.save would otherwise derive the correctness flags from each other
+        region = FileRegion(
+            file=file,
+            ml_model=ml_model,
+            defects={str(defect.id): {"confidence": 0.9} for defect in defects},
+            **fields,
+        )
+        return FileRegion.objects.bulk_create([region])[0]
+
+
+class PredictionCsvRowsTest(CsvExportTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.multi_label_model = cls.create_ml_model("multi-label", cls.use_case)
+        file = cls.create_file_set(cls.multi_label_model, "a.png")
+        cls.create_region(file, cls.multi_label_model, [cls.first], classification_correctness=True)
+        wrong = cls.create_region(file, cls.multi_label_model, [cls.second], classification_correctness=False)
+        cls.create_region(file, cls.multi_label_model, [cls.first], ai_region=wrong, is_user_feedback=True)
+        cls.create_file_set(cls.multi_label_model, "b.png")
+
+        cls.single_label_model = cls.create_ml_model("single-label", cls.single_label_use_case)
+        file = cls.create_file_set(cls.single_label_model, "c.png")
+        wrong = cls.create_region(file, cls.single_label_model, [cls.first], classification_correctness=False)
+        cls.create_region(file, cls.single_label_model, [cls.second], ai_region=wrong, is_user_feedback=True)
+
+    def prediction_csv_rows(self, ml_model, single_label_classification):
+        file_sets = FileSet.objects.filter(upload_session=self.upload_sessions[ml_model.id]).order_by("id")
+        rows = prediction_csv_rows(file_sets, [ml_model.id], {ml_model.id: ml_model.name}, single_label_classification)
+        self.assertEqual(
+            next(rows), ["File", "Folder", "Coordinates", "AI Predictions", "Ground Truth", "Model", "InferenceStatus"]
+        )
+        return list(rows)
+
+    def test_multi_label(self):
+        # a row per region, the file without any region gets an empty one
+        upload = self.upload_sessions[self.multi_label_model.id].name
+        rows = self.prediction_csv_rows(self.multi_label_model, False)
+        self.assertCountEqual(
+            rows[:3],
+            [
+                ["a.png", upload, {}, "first", "first", "multi-label", "FINISHED"],
+                ["a.png", upload, {}, "second", "", "multi-label", "FINISHED"],
+                ["a.png", upload, {}, "", "first", "multi-label", "FINISHED"],
+            ],
+        )
+        self.assertEqual(rows[3:], [["b.png", upload, None, None, None, "multi-label", "FINISHED"]])
+
+    def test_single_label(self):
+        # a row per file, with the ai predictions and the ground truth of all its regions
+        upload = self.upload_sessions[self.single_label_model.id].name
+        self.assertEqual(
+            self.prediction_csv_rows(self.single_label_model, True),
+            [["c.png", upload, None, "first", "second", "single-label", "FINISHED"]],
+        )
+
+
+class AiResultsCsvRowsTest(CsvExportTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.ml_model = cls.create_ml_model("multi-label", cls.use_case)
+        # the file sets of a lot aren't created one after the other
+        file = cls.create_file_set(cls.ml_model, "a.png", {"lot_id": "L1", "tray_id": "T1"})
+        cls.create_region(file, cls.ml_model, [cls.second])
+        file = cls.create_file_set(cls.ml_model, "b.png", {"lot_id": "L2", "tray_id": "T2"})
+        cls.create_region(file, cls.ml_model, [cls.first])
+        file = cls.create_file_set(cls.ml_model, "c.png", {"lot_id": "L1", "tray_id": "T3"})
+        cls.create_region(file, cls.ml_model, [cls.first])
+        cls.create_region(file, cls.ml_model, [cls.second])
+        # no ai region, the file set is only counted as received
+        cls.create_file_set(cls.ml_model, "d.png", {"lot_id": "L2", "tray_id": "T2"})
+
+    def test_a_row_per_lot(self):
+        # the file sets and counts are queried like the view does
+        analysis_service = AnalysisService(
+            {"subscription_id__in": [self.subscription.id]}, {"id__in": [self.ml_model.id]}
+        )
+        file_sets = (
+            FileSet.objects.filter(files__file_regions__in=analysis_service.ai_regions())
+            .values("id", "meta_info__lot_id", "meta_info__tray_id")
+            .distinct()
+            .annotate(defects=JSONBAgg("files__file_regions__defects"))
+        )
+        file_set_lot_id_count = (
+            analysis_service.file_sets().values("meta_info__lot_id").annotate(count=Count("id", distinct=True))
+        )
+        rows = ai_results_csv_rows(
+            file_sets,
+            file_set_lot_id_count,
+            ["lot_id", "tray_id"],
+            [self.second.id, self.first.id],
+            ["second", "first"],
+        )
+        self.assertEqual(
+            next(rows), ["lot_id", "tray_id", "No. of records received by the platform", "second", "first"]
+        )
+        lot_1, lot_2 = list(rows)
+        # the meta info values of a lot are merged, a file set is counted for its highest priority defect only
+        self.assertEqual(lot_1[0], "L1")
+        self.assertEqual(set(lot_1[1].split(";;")), {"T1", "T3"})
+        self.assertEqual(lot_1[2:], [2, 2, 0])
+        self.assertEqual(lot_2, ["L2", "T2", 2, 0, 1])
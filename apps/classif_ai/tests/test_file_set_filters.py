@@ -0,0 +1,90 @@
+import os
+from types import SimpleNamespace
+from unittest import mock
+
+from django.http import QueryDict
+
+from apps.classif_ai.filters import FileSetFilterSet
+from apps.classif_ai.models import (
+    Defect,
+    File,
+    FileSet,
+    MlModel,
+    ModelClassification,
+    ModelClassificationDefect,
+    UploadSession,
+)
+from apps.classif_ai.tests.classif_ai_test_case import ClassifAiTestCase
+
+
+class AiPredictedLabelPriorityFilterTest(ClassifAiTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.ml_model, cls.other_ml_model = [
+            MlModel.objects.create(
+                name=f"test-model-{version}",
+                code="test-code",
+                version=version,
+                status="ready_for_deployment",
+                subscription=cls.subscription,
+                use_case=cls.use_case,
+            )
+            for version in [1, 2]
+        ]
+        # high is the one listed in ORDERED_DEFECT_IDS, the others are ranked by their creation
+        cls.high, cls.created_first, cls.created_later = [
+            Defect.objects.create(name=name, code=name, subscription=cls.subscription)
+            for name in ["high", "created-first", "created-later"]
+        ]
+        cls.upload_session = UploadSession.objects.create(
+            name="test-upload", subscription=cls.subscription, use_case=cls.use_case
+        )
+        # a higher priority defect along with a non-listed one
+        cls.high_file_set = cls.create_file_set([{cls.ml_model: [cls.high, cls.created_first]}])
+        # non-listed defects only
+        cls.created_first_file_set = cls.create_file_set([{cls.ml_model: [cls.created_first, cls.created_later]}])
+        # the top defects of its files differ
+        cls.per_file_file_set = cls.create_file_set(
+            [{cls.ml_model: [cls.high]}, {cls.ml_model: [cls.created_later]}]
+        )
+        # the higher priority defect is predicted by an ml model which isn't filtered on
+        cls.other_model_file_set = cls.create_file_set(
+            [{cls.ml_model: [cls.created_later], cls.other_ml_model: [cls.high]}]
+        )
+
+    @classmethod
+    def create_file_set(cls, files):
+        """creates a file set with a file for each {ml model: predicted defects}"""
+        file_set = FileSet.objects.create(upload_session=cls.upload_session, subscription=cls.subscription)
+        for classifications in files:
+            file = File.objects.create(file_set=file_set, name="test-file", path="test/test-file")
+            for ml_model, defects in classifications.items():
+                classification = ModelClassification.objects.create(file=file, ml_model=ml_model)
+                for defect in defects:
+                    ModelClassificationDefect.objects.create(classification=classification, defect=defect)
+        return file_set
+
+    def filter_file_sets(self, defect, priority=True):
+        query_params = QueryDict(mutable=True)
+        query_params.update({"ml_model_id__in": str(self.ml_model.id), "ai_predicted_label__in": str(defect.id)})
+        if priority:
+            query_params["priority"] = "true"
+        file_set_filter = FileSetFilterSet(
+            query_params, queryset=FileSet.objects.all(), request=SimpleNamespace(query_params=query_params)
+        )
+        with mock.patch.dict(os.environ, {"ORDERED_DEFECT_IDS": str(self.high.id)}):
+            return set(file_set_filter.qs.values_list("id", flat=True))
+
+    def test_priority(self):
+        self.assertEqual(self.filter_file_sets(self.high), {self.high_file_set.id, self.per_file_file_set.id})
+        self.assertEqual(self.filter_file_sets(self.created_first), {self.created_first_file_set.id})
+        self.assertEqual(
+            self.filter_file_sets(self.created_later), {self.per_file_file_set.id, self.other_model_file_set.id}
+        )
+
+    def test_without_priority(self):
+        self.assertEqual(
+            self.filter_file_sets(self.created_first, priority=False),
+            {self.high_file_set.id, self.created_first_file_set.id},
+        )
@@ -0,0 +1,99 @@
+from django.contrib.auth import get_user_model
+from django.contrib.gis.geos import Polygon
+from django.core.exceptions import ValidationError
+
+from apps.classif_ai.models import (
+    Defect,
+    File,
+    FileSet,
+    GTClassification,
+    GTClassificationDefect,
+    GTDetection,
+    GTDetectionRegion,
+    GTDetectionRegionDefect,
+    UploadSession,
+    UserClassification,
+    UserClassificationDefect,
+    UserDetection,
+    UserDetectionRegion,
+    UserDetectionRegionDefect,
+)
+from apps.classif_ai.service.gt_promotion_service import (
+    promote_user_classifications,
+    promote_user_detections,
+    validate_use_case_type,
+)
+from apps.classif_ai.tests.classif_ai_test_case import ClassifAiTestCase
+
+
+class GTPromotionTest(ClassifAiTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super(GTPromotionTest, cls).setUpTestData()
+        cls.user = get_user_model().objects.create(email="a@a.com", is_superuser=True, is_staff=True)
+        cls.defect = Defect.objects.create(name="test-defect", code="test-code", subscription=cls.subscription)
+        cls.other_defect = Defect.objects.create(name="other-defect", code="other-code", subscription=cls.subscription)
+        cls.classification_files = cls.create_files(cls.use_case, "classification", 3)
+        cls.detection_files = cls.create_files(cls.detection_use_case, "detection", 2)
+
+    @classmethod
+    def create_files(cls, use_case, name, count):
+        upload_session = UploadSession.objects.create(
+            name=f"{name}-session", subscription=cls.subscription, use_case=use_case
+        )
+        file_set = FileSet.objects.create(
+            upload_session=upload_session, subscription=cls.subscription, meta_info={"tray_id": "abcd"}
+        )
+        return [
+            File.objects.create(file_set=file_set, name=f"{name}-{i}", path=f"test/{name}-{i}") for i in range(count)
+        ]
+
+    def test_promote_user_classifications(self):
+        defective, no_defect, existing = self.classification_files
+        # an existing GT is kept and its defects replaced
+        gt_classification = GTClassification.objects.create(file=existing, is_no_defect=True)
+        user_classifications = []
+        annotations = [(defective, [self.defect, self.other_defect]), (no_defect, []), (existing, [self.defect])]
+        for file, defects in annotations:
+            user_classification = UserClassification.objects.create(file=file, user=self.user)
+            for defect in defects:
+                UserClassificationDefect.objects.create(classification=user_classification, defect=defect)
+            user_classifications.append(user_classification.id)
+
+        promote_user_classifications(user_classifications)
+
+        gt_classifications = {gt.file_id: gt for gt in GTClassification.objects.all()}
+        self.assertEqual(gt_classifications[existing.id].id, gt_classification.id)
+        self.assertEqual(
+            {file_id: gt.is_no_defect for file_id, gt in gt_classifications.items()},
+            {defective.id: False, no_defect.id: True, existing.id: False},
+        )
+        self.assertEqual(
+            set(GTClassificationDefect.objects.values_list("classification__file_id", "defect_id")),
+            {(defective.id, self.defect.id), (defective.id, self.other_defect.id), (existing.id, self.defect.id)},
+        )
+
+    def test_promote_user_detections(self):
+        defective, no_defect = self.detection_files
+        region = Polygon(((0, 0), (0.1, 0), (0.1, 0.1), (0, 0.1), (0, 0)))
+        user_detection = UserDetection.objects.create(file=defective, user=self.user)
+        user_region = UserDetectionRegion.objects.create(detection=user_detection, region=region)
+        UserDetectionRegionDefect.objects.create(detection_region=user_region, defect=self.defect)
+        no_defect_detection = UserDetection.objects.create(file=no_defect, user=self.user, is_no_defect=True)
+
+        promote_user_detections([user_detection.id, no_defect_detection.id])
+        # promoting again replaces the regions instead of duplicating them
+        promote_user_detections([user_detection.id])
+
+        self.assertEqual(
+            dict(GTDetection.objects.values_list("file_id", "is_no_defect")), {defective.id: False, no_defect.id: True}
+        )
+        gt_region = GTDetectionRegion.objects.get()
+        self.assertTrue(region.equals(gt_region.region))
+        self.assertEqual(list(GTDetectionRegionDefect.objects.values_list("defect_id", flat=True)), [self.defect.id])
+
+    def test_validate_use_case_type(self):
+        file_ids = [file.id for file in self.classification_files]
+        validate_use_case_type(UserClassification, file_ids, "CLASSIFICATION")
+        with self.assertRaises(ValidationError):
+            validate_use_case_type(UserClassification, file_ids + [self.detection_files[0].id], "CLASSIFICATION")
@@ -0,0 +1,69 @@
+import os
+import tempfile
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+
+from apps.classif_ai.models import File, UploadSession
+from apps.classif_ai.tests.classif_ai_test_case import ClassifAiTestCase
+from common.services import S3Service
+
+
+class IngestFileSetsFromFolderTest(ClassifAiTestCase):
+    def setUp(self):
+        super(IngestFileSetsFromFolderTest, self).setUp()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.folder_path = os.path.join(self.temp_dir.name, "images")
+        os.mkdir(self.folder_path)
+        self.checkpoint = os.path.join(self.temp_dir.name, "checkpoint")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+        super(IngestFileSetsFromFolderTest, self).tearDown()
+
+    def add_images(self, *names):
+        for name in names:
+            with open(os.path.join(self.folder_path, name), "wb") as file:
+                file.write(b"image")
+
+    def ingest(self, **options):
+        options = {
+            "subscription_id": self.subscription.id,
+            "use_case_id": self.use_case.id,
+            "folder_path": self.folder_path,
+            "ui_folder_name": "backfill",
+            "checkpoint": self.checkpoint,
+            "batch_size": 2,
+            "interactive": False,
+            **options,
+        }
+        call_command("ingest_file_sets_from_folder", stdout=open(os.devnull, "w"), **options)
+
+    def test_ingest_and_resume(self):
+        self.add_images("a.bmp", "b.bmp", "c.bmp")
+        self.ingest()
+
+        upload_session = UploadSession.objects.get()
+        files = File.objects.filter(file_set__upload_session=upload_session)
+        self.assertEqual(sorted(files.values_list("name", flat=True)), ["a.bmp", "b.bmp", "c.bmp"])
+        for file in files:
+            self.assertEqual(file.file_set.use_case_id, self.use_case.id)
+            self.assertTrue(S3Service().check_if_key_exists(file.path))
+
+        # running again continues the same upload session with the new files only
+        self.add_images("d.bmp")
+        self.ingest()
+
+        self.assertEqual(UploadSession.objects.get().id, upload_session.id)
+        self.assertEqual(sorted(files.values_list("name", flat=True)), ["a.bmp", "b.bmp", "c.bmp", "d.bmp"])
+
+    def test_resume_with_other_options(self):
+        self.add_images("a.bmp")
+        self.ingest()
+
+        self.add_images("b.bmp")
+        with self.assertRaisesMessage(CommandError, f"use_case_id={self.use_case.id}"):
+            self.ingest(use_case_id=self.single_label_use_case.id)
+        with self.assertRaisesMessage(CommandError, "ui_folder_name='backfill'"):
+            self.ingest(ui_folder_name="other")
+        self.assertEqual(File.objects.filter(file_set__upload_session=UploadSession.objects.get()).count(), 1)
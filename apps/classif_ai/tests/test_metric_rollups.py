@@ -0,0 +1,194 @@
+from datetime import date, datetime, timedelta
+from unittest import mock
+
+import pytz
+from django.db.models import Q
+from django.db.models.functions import TruncDay
+from django.test import SimpleTestCase, override_settings
+from django.utils import timezone
+
+from apps.classif_ai.models import (
+    Defect,
+    File,
+    FileSet,
+    GTClassification,
+    GTClassificationDefect,
+    MlModel,
+    ModelClassification,
+    ModelClassificationDefect,
+    StaleClassificationMetricRollup,
+    UploadSession,
+)
+from apps.classif_ai.service import metric_rollup_service
+from apps.classif_ai.service.classification_service import accuracy_metrics, distribution_metrics_use_case_on_file
+from apps.classif_ai.service.metric_rollup_service import (
+    get_rollups,
+    rebuild_rollups,
+    refresh_stale_rollups,
+    rollup_date_filter,
+    rollup_filter,
+)
+from apps.classif_ai.tests.classif_ai_test_case import ClassifAiTestCase
+
+
+def lookups(query):
+    """flattens a Q made of ANDed lookups into {lookup: value}"""
+    result = {}
+    for child in query.children:
+        if isinstance(child, Q):
+            result.update(lookups(child))
+        else:
+            result[child[0]] = child[1]
+    return result
+
+
+def metrics_request(file_set_filters=None, ml_model_filters=None):
+    filters = {
+        "file_set__created_ts__gte": datetime(2021, 10, 1, tzinfo=pytz.UTC),
+        "file_set__created_ts__lte": datetime(2021, 11, 1, tzinfo=pytz.UTC),
+        "file_set__use_case__type__in": ["CLASSIFICATION"],
+    }
+    filters.update(file_set_filters or {})
+    return {
+        "file_set_filters": filters,
+        "ml_model_filters": ml_model_filters or {"model_classifications__ml_model__in": ["1", "2"]},
+    }
+
+
+@override_settings(CLASSIFICATION_METRIC_ROLLUPS_ENABLED=True)
+class RollupFilterTest(SimpleTestCase):
+    def test_supported_filters(self):
+        query = rollup_filter(metrics_request({"file_set__use_case__in": ["3"]}))
+        self.assertEqual(
+            lookups(query),
+            {
+                "ml_model_id__in": ["1", "2"],
+                "date__gte": date(2021, 10, 1),
+                "date__lt": date(2021, 11, 1),
+                "use_case_id__in": ["3"],
+            },
+        )
+
+    def test_unsupported_filters(self):
+        self.assertIsNone(rollup_filter(metrics_request({"file_set__is_bookmarked": True})))
+        self.assertIsNone(
+            rollup_filter(metrics_request({"file_set__use_case__type__in": ["CLASSIFICATION_AND_DETECTION"]}))
+        )
+        self.assertIsNone(
+            rollup_filter(
+                metrics_request(
+                    ml_model_filters={
+                        "model_classifications__ml_model__in": ["1"],
+                        "model_classifications__ml_model__status__in": ["deployed_in_prod"],
+                    }
+                )
+            )
+        )
+
+    def test_latest_classification_of_file_is_not_served(self):
+        request = metrics_request(ml_model_filters={"model_classifications__ml_model__in": Q()})
+        self.assertIsNone(rollup_filter(request))
+
+    @override_settings(CLASSIFICATION_METRIC_ROLLUPS_ENABLED=False)
+    def test_disabled(self):
+        self.assertIsNone(rollup_filter(metrics_request()))
+
+
+class RollupDateFilterTest(SimpleTestCase):
+    def test_open_ended_range_up_to_now(self):
+        now = timezone.now()
+        self.assertEqual(
+            lookups(rollup_date_filter(datetime(2021, 10, 1, tzinfo=pytz.UTC), now)),
+            {"date__gte": date(2021, 10, 1), "date__lte": now.date()},
+        )
+
+    def test_partial_days_are_not_served(self):
+        self.assertIsNone(rollup_date_filter(datetime(2021, 10, 1, 10, tzinfo=pytz.UTC), None))
+        self.assertIsNone(rollup_date_filter(None, timezone.now() - timedelta(hours=1, minutes=1)))
+
+
+@override_settings(CLASSIFICATION_METRIC_ROLLUPS_ENABLED=True)
+class RollupMetricsTest(ClassifAiTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.ml_model = MlModel.objects.create(
+            name="test-model",
+            code="test-code",
+            version=1,
+            status="deployed_in_prod",
+            is_stable=True,
+            subscription=cls.subscription,
+            use_case=cls.use_case,
+            confidence_threshold=0.5,
+        )
+        defect_1 = Defect.objects.create(name="defect-1", code="defect-1", subscription=cls.subscription)
+        defect_2 = Defect.objects.create(name="defect-2", code="defect-2", subscription=cls.subscription)
+        upload_session = UploadSession.objects.create(
+            name="test-upload", subscription=cls.subscription, use_case=cls.use_case
+        )
+        # (model defect, confidence, gt defect): accurate, inaccurate, audited only above 0.85, not audited
+        for model_defect, confidence, gt_defect in [
+            (defect_1, 0.9, defect_1),
+            (defect_2, 0.6, defect_1),
+            (defect_1, 0.4, defect_1),
+            (defect_2, 0.8, None),
+        ]:
+            file_set = FileSet.objects.create(upload_session=upload_session, subscription=cls.subscription)
+            file = File.objects.create(file_set=file_set, name="test-file", path="test/test-file")
+            classification = ModelClassification.objects.create(file=file, ml_model=cls.ml_model)
+            ModelClassificationDefect.objects.create(
+                classification=classification, defect=model_defect, confidence=confidence
+            )
+            if gt_defect is not None:
+                gt_classification = GTClassification.objects.create(file=file)
+                GTClassificationDefect.objects.create(classification=gt_classification, defect=gt_defect)
+
+    def metrics_request(self):
+        return {
+            "unit": "file",
+            "file_set_filters": {
+                "file_set__created_ts__gte": timezone.localtime().replace(hour=0, minute=0, second=0, microsecond=0),
+                "file_set__created_ts__lte": timezone.now(),
+                "file_set__use_case__type__in": ["CLASSIFICATION"],
+            },
+            "ml_model_filters": {"model_classifications__ml_model__in": [self.ml_model.id]},
+            "time_function": TruncDay,
+        }
+
+    def metrics(self):
+        return [
+            accuracy_metrics(self.metrics_request()),
+            list(distribution_metrics_use_case_on_file(self.metrics_request())),
+        ]
+
+    def assertRollupMetricsEqualLiveOnes(self):
+        self.assertIsNotNone(get_rollups(self.metrics_request()))
+        rollup_metrics = self.metrics()
+        with override_settings(CLASSIFICATION_METRIC_ROLLUPS_ENABLED=False):
+            self.assertIsNone(get_rollups(self.metrics_request()))
+            live_metrics = self.metrics()
+        self.assertEqual(rollup_metrics, live_metrics)
+        return rollup_metrics
+
+    def test_rollup_metrics_match_live_metrics(self):
+        rebuild_rollups()
+        metrics = self.assertRollupMetricsEqualLiveOnes()
+        self.assertEqual(metrics[0]["total"], 4)
+        self.assertEqual(metrics[0]["auto_classified"], 3)
+        self.assertEqual(metrics[0]["audited"], 2)
+        self.assertEqual(metrics[0]["accurate"], 1)
+
+    def test_confidence_threshold_change_marks_the_rollups_stale(self):
+        rebuild_rollups()
+        self.ml_model.confidence_threshold = 0.85
+        with mock.patch.object(metric_rollup_service.refresh_classification_metric_rollups, "apply_async") as refresh:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.ml_model.save()
+        refresh.assert_called_once()
+        self.assertTrue(StaleClassificationMetricRollup.objects.exists())
+
+        self.assertEqual(refresh_stale_rollups(), 1)
+        metrics = self.assertRollupMetricsEqualLiveOnes()
+        self.assertEqual(metrics[0]["auto_classified"], 1)
+        self.assertEqual(metrics[0]["audited"], 1)
@@ -0,0 +1,182 @@
+from decimal import Decimal
+from unittest import mock
+
+from django.db import IntegrityError
+from django.test import override_settings
+from django.utils import timezone
+
+from apps.classif_ai.models import (
+    Defect,
+    File,
+    FileSet,
+    MlModel,
+    ModelClassification,
+    ModelClassificationDefect,
+    ModelDetection,
+    ModelDetectionRegion,
+    ModelDetectionRegionDefect,
+    StaleClassificationMetricRollup,
+    UploadSession,
+)
+from apps.classif_ai.service import metric_rollup_service
+from apps.classif_ai.service.model_annotation_service import ModelAnnotationBulkWriter
+from apps.classif_ai.tests.classif_ai_test_case import ClassifAiTestCase
+
+
+@override_settings(CLASSIFICATION_METRIC_ROLLUPS_ENABLED=True)
+class ModelAnnotationBulkWriterTest(ClassifAiTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.classification_model = cls.create_ml_model("classification", cls.use_case)
+        cls.detection_model = cls.create_ml_model("detection", cls.detection_use_case)
+        cls.coded_defect = Defect.objects.create(
+            name="coded", code="coded", organization_defect_code="ORG-1", subscription=cls.subscription
+        )
+        cls.defect = Defect.objects.create(name="not-coded", code="not-coded", subscription=cls.subscription)
+        cls.file, cls.no_defect_file = [cls.create_file(cls.use_case) for _ in range(2)]
+        cls.detection_file = cls.create_file(cls.detection_use_case)
+
+    @classmethod
+    def create_ml_model(cls, name, use_case):
+        return MlModel.objects.create(
+            name=name,
+            code=name,
+            version=1,
+            status="ready_for_deployment",
+            subscription=cls.subscription,
+            use_case=use_case,
+        )
+
+    @classmethod
+    def create_file(cls, use_case):
+        upload_session = UploadSession.objects.create(
+            name=f"test-upload-{use_case.id}", subscription=cls.subscription, use_case=use_case
+        )
+        file_set = FileSet.objects.create(upload_session=upload_session, subscription=cls.subscription)
+        return File.objects.create(file_set=file_set, name="test-file", path="test/test-file")
+
+    def classification_output(self, *files):
+        """inference output of the classification model, a file with both defects and a file without any"""
+        output = {
+            self.file: [
+                {"defects": {str(self.coded_defect.id): {"confidence": 0.8}, str(self.defect.id): {"confidence": 0.6}}}
+            ],
+            self.no_defect_file: [],
+        }
+        return [{"id": file.id, "file_regions": output[file]} for file in files]
+
+    def write_classifications(self, files):
+        with mock.patch.object(metric_rollup_service.refresh_classification_metric_rollups, "apply_async"):
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                written = ModelAnnotationBulkWriter(self.classification_model.id).write_classifications(files)
+        return written, callbacks
+
+    def classification_rows(self):
+        return (
+            set(ModelClassification.objects.values_list("file_id", "ml_model_id", "is_no_defect")),
+            set(
+                ModelClassificationDefect.objects.values_list("classification__file_id", "defect_id", "confidence")
+            ),
+        )
+
+    def test_write_classifications(self):
+        files, _ = self.write_classifications(self.classification_output(self.file, self.no_defect_file))
+
+        self.assertEqual(
+            files[0]["file_regions"][0]["defects"],
+            {
+                str(self.coded_defect.id): {"confidence": 0.8, "organization_defect_code": "ORG-1"},
+                str(self.defect.id): {"confidence": 0.6},
+            },
+        )
+        self.assertEqual(
+            self.classification_rows(),
+            (
+                {
+                    (self.file.id, self.classification_model.id, False),
+                    (self.no_defect_file.id, self.classification_model.id, True),
+                },
+                {
+                    (self.file.id, self.coded_defect.id, Decimal("0.8")),
+                    (self.file.id, self.defect.id, Decimal("0.6")),
+                },
+            ),
+        )
+        # bulk_create doesn't send post_save, the writer marks the day of the files stale itself
+        self.assertEqual(
+            set(StaleClassificationMetricRollup.objects.values_list("date", "use_case_id")),
+            {(timezone.now().date(), self.use_case.id)},
+        )
+
+    def test_rewrite_classifications(self):
+        self.write_classifications(self.classification_output(self.file))
+        rows = self.classification_rows()
+        StaleClassificationMetricRollup.objects.all().delete()
+
+        # a file is classified once per model, the whole batch is rolled back along with its stale marking
+        with self.assertRaises(IntegrityError):
+            self.write_classifications(self.classification_output(self.no_defect_file, self.file))
+        self.assertEqual(self.classification_rows(), rows)
+        self.assertFalse(StaleClassificationMetricRollup.objects.exists())
+
+    def detection_output(self):
+        """inference output of the detection model, the defects of the second region are in the api format"""
+        return [
+            {
+                "id": self.detection_file.id,
+                "file_regions": [
+                    {
+                        "region": {"coordinates": {"x": 0.25, "y": 0.5, "w": 0.25, "h": 0.125}},
+                        "defects": {str(self.coded_defect.id): {"confidence": 0.9}},
+                        "model_output_meta_info": {"score": 1},
+                    },
+                    {
+                        "region": {"coordinates": {"x": 0.5, "y": 0.25, "w": 0.125, "h": 0.25}},
+                        "defects": [{"defect_id": self.defect.id, "confidence": 0.7}],
+                    },
+                ],
+            }
+        ]
+
+    def detection_rows(self):
+        return (
+            set(ModelDetection.objects.values_list("file_id", "ml_model_id", "is_no_defect")),
+            {
+                (region.region.extent, tuple(region.model_output_meta_info.items()))
+                for region in ModelDetectionRegion.objects.all()
+            },
+            set(
+                ModelDetectionRegionDefect.objects.values_list(
+                    "detection_region__detection__file_id", "defect_id", "confidence"
+                )
+            ),
+        )
+
+    def test_write_detections(self):
+        files = ModelAnnotationBulkWriter(self.detection_model.id).write_detections(self.detection_output())
+
+        self.assertEqual(
+            files[0]["file_regions"][0]["defects"],
+            {str(self.coded_defect.id): {"confidence": 0.9, "organization_defect_code": "ORG-1"}},
+        )
+        self.assertEqual(
+            self.detection_rows(),
+            (
+                {(self.detection_file.id, self.detection_model.id, False)},
+                {((0.25, 0.5, 0.5, 0.625), (("score", 1),)), ((0.5, 0.25, 0.625, 0.5), ())},
+                {
+                    (self.detection_file.id, self.coded_defect.id, Decimal("0.9")),
+                    (self.detection_file.id, self.defect.id, Decimal("0.7")),
+                },
+            ),
+        )
+
+    def test_rewrite_detections(self):
+        writer = ModelAnnotationBulkWriter(self.detection_model.id)
+        writer.write_detections(self.detection_output())
+        rows = self.detection_rows()
+
+        with self.assertRaises(IntegrityError):
+            writer.write_detections(self.detection_output())
+        self.assertEqual(self.detection_rows(), rows)
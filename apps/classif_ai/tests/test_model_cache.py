@@ -0,0 +1,64 @@
+from unittest.mock import MagicMock
+
+from django.test import SimpleTestCase
+
+from apps.classif_ai.model_cache import ModelCache
+
+
+class ModelCacheTest(SimpleTestCase):
+    def test_get_counts_hits_and_misses(self):
+        cache = ModelCache()
+        model = MagicMock()
+        self.assertIsNone(cache.get("tenant_a", 1))
+        cache.put("tenant_a", 1, model)
+        self.assertEqual(cache.get("tenant_a", 1), model)
+        self.assertIsNone(cache.get("tenant_b", 1))
+        stats = cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 2)
+        self.assertEqual(stats["evictions"], 0)
+
+    def test_least_recently_used_model_is_evicted(self):
+        cache = ModelCache(max_models=2)
+        first_model, second_model, third_model = MagicMock(), MagicMock(), MagicMock()
+        cache.put("tenant_a", 1, first_model)
+        cache.put("tenant_a", 2, second_model)
+        cache.get("tenant_a", 1)
+        cache.put("tenant_a", 3, third_model)
+        self.assertIn(("tenant_a", 1), cache)
+        self.assertNotIn(("tenant_a", 2), cache)
+        self.assertIn(("tenant_a", 3), cache)
+        second_model.predictor.destroy.assert_called_once()
+        self.assertEqual(cache.evictions, 1)
+
+    def test_byte_budget(self):
+        cache = ModelCache(max_bytes=100)
+        cache.put("tenant_a", 1, MagicMock(), size=60)
+        cache.put("tenant_a", 2, MagicMock(), size=60)
+        self.assertEqual(len(cache), 1)
+        self.assertIn(("tenant_a", 2), cache)
+        self.assertEqual(cache.total_bytes, 60)
+
+    def test_heaviest_tenant_is_evicted_first(self):
+        cache = ModelCache(max_models=3)
+        cache.put("tenant_b", 1, MagicMock())
+        cache.put("tenant_a", 1, MagicMock())
+        cache.put("tenant_a", 2, MagicMock())
+        cache.put("tenant_b", 2, MagicMock())
+        self.assertIn(("tenant_b", 1), cache)
+        self.assertNotIn(("tenant_a", 1), cache)
+        self.assertIn(("tenant_a", 2), cache)
+        self.assertIn(("tenant_b", 2), cache)
+
+    def test_per_tenant_limit(self):
+        cache = ModelCache(max_models_per_tenant=1)
+        cache.put("tenant_a", 1, MagicMock())
+        cache.put("tenant_b", 1, MagicMock())
+        cache.put("tenant_a", 2, MagicMock())
+        self.assertNotIn(("tenant_a", 1), cache)
+        self.assertIn(("tenant_b", 1), cache)
+        self.assertIn(("tenant_a", 2), cache)
+
+    def test_evict_least_recently_used_when_empty(self):
+        cache = ModelCache()
+        self.assertFalse(cache.evict_least_recently_used())
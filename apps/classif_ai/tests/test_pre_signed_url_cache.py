@@ -0,0 +1,45 @@
+from unittest.mock import MagicMock, patch
+
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+
+from common.file_storage import get_pre_signed_url, get_pre_signed_urls
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class PreSignedUrlCacheTest(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.storage = MagicMock()
+        self.storage.url.side_effect = lambda path: f"https://bucket/{path}?signature=1"
+        patcher = patch("sixsense.settings.DEFAULT_FILE_STORAGE_OBJECT", self.storage)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_urls_are_signed_once(self):
+        urls = get_pre_signed_urls(["a.png", "b.png"])
+        self.assertEqual(
+            urls, {"a.png": "https://bucket/a.png?signature=1", "b.png": "https://bucket/b.png?signature=1"}
+        )
+        self.assertEqual(get_pre_signed_url("a.png"), "https://bucket/a.png?signature=1")
+        get_pre_signed_urls(["a.png", "b.png", "c.png"])
+        self.assertEqual(
+            sorted(call.args[0] for call in self.storage.url.call_args_list), ["a.png", "b.png", "c.png"]
+        )
+
+    def test_empty_paths(self):
+        self.assertEqual(get_pre_signed_urls([None, ""]), {})
+        self.assertIsNone(get_pre_signed_url(None))
+        self.storage.url.assert_not_called()
+
+    def test_urls_are_cached_per_schema(self):
+        with patch("common.file_storage.connection") as connection:
+            # the tenant storages sign the path under the tenant's folder
+            self.storage.url.side_effect = lambda path: f"https://bucket/{connection.schema_name}/{path}"
+            connection.schema_name = "tenant_1"
+            self.assertEqual(get_pre_signed_url("a.png"), "https://bucket/tenant_1/a.png")
+            connection.schema_name = "tenant_2"
+            self.assertEqual(get_pre_signed_url("a.png"), "https://bucket/tenant_2/a.png")
+            connection.schema_name = "tenant_1"
+            self.assertEqual(get_pre_signed_url("a.png"), "https://bucket/tenant_1/a.png")
+        self.assertEqual(self.storage.url.call_count, 2)
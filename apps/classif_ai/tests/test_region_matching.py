@@ -0,0 +1,51 @@
+from django.test import SimpleTestCase
+
+from apps.classif_ai.helpers import calculate_iou
+from apps.classif_ai.region_matching import RegionMatcher, match_regions_bulk, region_to_box
+
+
+def box_region(x, y, w, h):
+    return {"type": "box", "coordinates": {"x": x, "y": y, "w": w, "h": h}}
+
+
+class RegionMatcherTest(SimpleTestCase):
+    def test_best_match_has_highest_iou(self):
+        candidates = [box_region(0.5, 0.5, 0.2, 0.2), box_region(0.1, 0.1, 0.2, 0.2), box_region(0.12, 0.1, 0.2, 0.2)]
+        target = box_region(0.11, 0.1, 0.2, 0.2)
+        matcher = RegionMatcher(candidates, get_region=lambda region: region)
+        matching_region, iou = matcher.best_match(target, 0.4)
+        self.assertIs(matching_region, candidates[1])
+        self.assertAlmostEqual(iou, calculate_iou(region_to_box(candidates[1]), region_to_box(target)))
+
+    def test_no_match_below_threshold(self):
+        matcher = RegionMatcher([box_region(0.1, 0.1, 0.2, 0.2)], get_region=lambda region: region)
+        self.assertEqual(matcher.best_match(box_region(0.25, 0.25, 0.2, 0.2), 0.4), (None, None))
+        self.assertEqual(matcher.best_match(box_region(0.7, 0.7, 0.2, 0.2), 0.4), (None, None))
+
+    def test_non_overlapping_regions_are_prefiltered(self):
+        candidates = [box_region(0.1, 0.1, 0.1, 0.1), box_region(0.6, 0.6, 0.1, 0.1)]
+        matcher = RegionMatcher(candidates, get_region=lambda region: region)
+        ious = matcher.ious(box_region(0.05, 0.05, 0.1, 0.1))
+        self.assertEqual([region for region, _ in ious], [candidates[0]])
+
+    def test_match_regions_bulk(self):
+        candidates_by_file = {
+            "1": [box_region(0.1, 0.1, 0.2, 0.2)],
+            "2": [box_region(0.5, 0.5, 0.2, 0.2)],
+        }
+        targets_by_file = {
+            "1": [box_region(0.1, 0.1, 0.2, 0.2), box_region(0.5, 0.5, 0.2, 0.2)],
+            "2": [box_region(0.5, 0.5, 0.2, 0.2)],
+            "3": [box_region(0.5, 0.5, 0.2, 0.2)],
+        }
+        matches = match_regions_bulk(
+            targets_by_file,
+            candidates_by_file,
+            0.4,
+            get_target_region=lambda region: region,
+            get_region=lambda region: region,
+        )
+        self.assertIs(matches["1"][0][1], candidates_by_file["1"][0])
+        self.assertIsNone(matches["1"][1][1])
+        self.assertIs(matches["2"][0][1], candidates_by_file["2"][0])
+        self.assertIsNone(matches["3"][0][1])
@@ -0,0 +1,85 @@
+import os
+import sys
+import tempfile
+import types
+from unittest import mock
+
+from apps.classif_ai.models import File, FileSet, UploadSession
+from apps.classif_ai.services import StitchImageService
+from apps.classif_ai.tests.classif_ai_test_case import ClassifAiTestCase
+from common.services import S3Service
+
+
+class StitchImageServiceTest(ClassifAiTestCase):
+    def setUp(self):
+        super(StitchImageServiceTest, self).setUp()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.upload_session = UploadSession.objects.create(
+            name="test-upload", subscription=self.subscription, use_case=self.use_case
+        )
+        for name in ["a.bmp", "b.bmp"]:
+            file_set = FileSet.objects.create(upload_session=self.upload_session, subscription=self.subscription)
+            File.objects.create(file_set=file_set, name=name, path=f"test/{name}")
+        self.combined_file_paths = []
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+        super(StitchImageServiceTest, self).tearDown()
+
+    def stitched_images(self):
+        """{name: local path} of the stitched images, the last one is missing so that its upload fails"""
+        images = {}
+        for index in range(5):
+            name = f"stitched-{index}.bmp"
+            images[name] = os.path.join(self.temp_dir.name, name)
+            if index < 4:
+                with open(images[name], "wb") as file:
+                    file.write(b"image")
+        return images
+
+    def stitch(self, combine_images):
+        create_ui_folder = types.ModuleType("create_ui_folder")
+        create_ui_folder.combine_images = combine_images
+        # the uploads are collected 2 at a time and written 2 at a time, so that there are several batches
+        with mock.patch.dict(sys.modules, {"create_ui_folder": create_ui_folder}), mock.patch(
+            "apps.classif_ai.services.settings.STITCH_UPLOAD_WORKERS", 1
+        ), mock.patch.object(StitchImageService, "DB_WRITE_BATCH_SIZE", 2), mock.patch.object(
+            StitchImageService, "_create_file_sets", wraps=StitchImageService._create_file_sets
+        ) as create_file_sets:
+            StitchImageService().stitch(self.upload_session.id)
+        return create_file_sets
+
+    def assert_stitched(self, create_file_sets):
+        self.assertEqual(sorted(self.combined_file_paths), ["test/a.bmp", "test/b.bmp"])
+        new_upload_session = UploadSession.objects.exclude(id=self.upload_session.id).get()
+        self.assertEqual(new_upload_session.use_case_id, self.use_case.id)
+        file_sets = FileSet.objects.filter(upload_session=new_upload_session)
+        self.assertEqual(file_sets.count(), 4)
+        files = File.objects.filter(file_set__in=file_sets)
+        # one file per file set, the image which couldn't be uploaded is skipped
+        self.assertEqual(files.values("file_set_id").distinct().count(), 4)
+        self.assertEqual(
+            sorted(files.values_list("name", flat=True)),
+            ["stitched-0.bmp", "stitched-1.bmp", "stitched-2.bmp", "stitched-3.bmp"],
+        )
+        for file in files:
+            self.assertEqual(file.file_set.use_case_id, self.use_case.id)
+            self.assertTrue(S3Service().check_if_key_exists(file.path))
+
+        batches = [call.args[1] for call in create_file_sets.call_args_list if call.args[1]]
+        self.assertGreater(len(batches), 1)
+        self.assertEqual(sum(len(batch) for batch in batches), 4)
+
+    def test_stitch_dict(self):
+        def combine_images(file_paths, folder, credentials):
+            self.combined_file_paths = list(file_paths)
+            return self.stitched_images()
+
+        self.assert_stitched(self.stitch(combine_images))
+
+    def test_stitch_generator(self):
+        def combine_images(file_paths, folder, credentials):
+            self.combined_file_paths = list(file_paths)
+            yield from self.stitched_images().items()
+
+        self.assert_stitched(self.stitch(combine_images))
@@ -0,0 +1,29 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.test import SimpleTestCase
+
+from apps.classif_ai import tenant_hooks
+from apps.classif_ai.helpers import infineon_populate_meta_info
+from apps.classif_ai.tenant_hooks import get_tenant_hook, register_tenant_hook, require_tenant_hook
+
+
+class TenantHooksTest(SimpleTestCase):
+    def tearDown(self):
+        tenant_hooks._hooks.pop(("test_tenant", "populate_meta_info"), None)
+
+    def test_registered_hooks(self):
+        self.assertIs(get_tenant_hook("populate_meta_info", "infineon"), infineon_populate_meta_info)
+        self.assertIsNone(get_tenant_hook("populate_meta_info", "test_tenant"))
+
+        @register_tenant_hook("test_tenant", "populate_meta_info")
+        def populate_meta_info(data):
+            return data
+
+        self.assertIs(require_tenant_hook("populate_meta_info", "test_tenant"), populate_meta_info)
+        with self.assertRaises(ImproperlyConfigured):
+            register_tenant_hook("test_tenant", "populate_meta_info")(populate_meta_info)
+
+    def test_invalid_hooks(self):
+        with self.assertRaises(ImproperlyConfigured):
+            register_tenant_hook("test_tenant", "unknown_hook")
+        with self.assertRaises(ImproperlyConfigured):
+            require_tenant_hook("get_use_case_id", "test_tenant")
@@ -0,0 +1,17 @@
+from apps.classif_ai.tenant_runner import get_tenant_schema_names, run_command_for_tenant
+from apps.classif_ai.tests.classif_ai_test_case import ClassifAiTestCase
+
+
+class TenantRunnerTest(ClassifAiTestCase):
+    def test_run_command_for_tenant(self):
+        schema_name = self.tenant.schema_name
+        self.assertEqual(get_tenant_schema_names([schema_name]), [schema_name])
+
+        result = run_command_for_tenant(schema_name, "rebuild_classification_metric_rollups", [])
+        self.assertEqual(result["schema"], schema_name)
+        self.assertIsNone(result["error"])
+        self.assertIn("Rebuilt the classification metric rollups", result["output"])
+
+        # the failure is reported instead of raised
+        result = run_command_for_tenant(schema_name, "rebuild_classification_metric_rollups", ["--date-gte", "x"])
+        self.assertIn("ValueError", result["error"])
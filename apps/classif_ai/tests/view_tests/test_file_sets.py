@@ -8,6 +8,7 @@ from apps.classif_ai.models import (
     Defect,
     WaferMap,
     File,
+    FileRegion,
     GTClassification,
     GTClassificationDefect,
     ModelClassification,
@@ -250,6 +251,41 @@ class FileSetFiltersTest(ClassifAiTestCase):
         self.assertEquals(1, response.data["count"])
 
 
+class FileSetDefectsTest(ClassifAiTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        ml_model = MlModel.objects.create(
+            name="test-model",
+            code="test-code",
+            version=1,
+            status="deployed_in_prod",
+            is_stable=True,
+            subscription=cls.subscription,
+            use_case=cls.use_case,
+        )
+        cls.defect = Defect.objects.create(name="test-defect", code="test-defect-code", subscription=cls.subscription)
+        upload_session = UploadSession.objects.create(
+            name="test-upload", subscription=cls.subscription, use_case=cls.use_case
+        )
+        file_set = FileSet.objects.create(upload_session=upload_session, subscription=cls.subscription)
+        cls.file = File.objects.create(file_set=file_set, name="test-file", path="test/test-file")
+        FileRegion.objects.create(
+            file=cls.file, ml_model=ml_model, defects={str(cls.defect.id): {}}, is_user_feedback=True
+        )
+
+    def test_defects(self):
+        response = self.authorized_client.get(
+            f"/api/v1/classif-ai/file-set/defects/?use_case_id__in={self.use_case.id}"
+        )
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.data["count"], 1)
+        file_data = response.data["file_sets"][0]["files"][0]
+        self.assertEquals(file_data["id"], self.file.id)
+        self.assertTrue(file_data["url"])
+        self.assertEquals(file_data["defects"], {"test-defect": 1})
+
+
 # TODO: add celery mock into this
 # class FileSetCopyToFolderTest(ClassifAiTestCase):
 #     @classmethod
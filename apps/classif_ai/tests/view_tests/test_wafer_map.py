@@ -1,6 +1,10 @@
 import json
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
 from apps.classif_ai.tests.classif_ai_test_case import ClassifAiTestCase
-from apps.classif_ai.models import Tag, WaferMap, WaferMapTag
+from apps.classif_ai.models import File, FileSet, Tag, UploadSession, WaferMap, WaferMapTag
 
 
 class WaferMapViewSetTest(ClassifAiTestCase):
@@ -51,3 +55,61 @@ class WaferMapViewSetTest(ClassifAiTestCase):
         # Check status code.
         self.assertEquals(response.status_code, 200)
         self.assertEquals(WaferMapTag.objects.filter(wafer=wafer_map).count(), 0)
+
+    def test_add_wafer_map_tags_in_bulk(self):
+        tag = Tag.objects.create(name="test-tag-bulk")
+        other_wafer_map = WaferMap.objects.create(organization_wafer_id="test-wafer-map-2", meta_data={})
+        wafer_map = WaferMap.objects.get(id=1)
+
+        for expected_count in (1, 0):
+            # tagging again doesn't duplicate the tag
+            response = self.authorized_client.put(
+                "/api/v1/classif-ai/wafer-map/tags/?id__in=1",
+                json.dumps({"tag_ids": [tag.id]}),
+                content_type="application/json",
+            )
+            self.assertEquals(response.status_code, 200)
+            self.assertEquals(response.json()["count"], expected_count)
+        self.assertEquals(WaferMapTag.objects.filter(wafer=wafer_map, tag=tag).count(), 1)
+        # only the wafers matching the filters are tagged
+        self.assertEquals(WaferMapTag.objects.filter(wafer=other_wafer_map).count(), 0)
+
+        response = self.authorized_client.delete(
+            "/api/v1/classif-ai/wafer-map/tags/?id__in=1",
+            json.dumps({"remove_all_tags": True}),
+            content_type="application/json",
+        )
+        self.assertEquals(response.json()["count"], 2)
+
+    def list_wafer_maps(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.authorized_client.get(url)
+        self.assertEquals(response.status_code, 200)
+        return response.json(), len(queries)
+
+    def test_list_wafer_maps(self):
+        upload_session = UploadSession.objects.create(
+            name="wafer-session", subscription=self.subscription, use_case=self.use_case
+        )
+        wafer_map = WaferMap.objects.get(id=1)
+        file_set = FileSet.objects.create(
+            upload_session=upload_session, subscription=self.subscription, wafer=wafer_map, meta_info={"tray_id": "a"}
+        )
+        for i in range(3):
+            File.objects.create(file_set=file_set, name=f"wafer-file-{i}", path=f"test/wafer-file-{i}")
+
+        page, query_count = self.list_wafer_maps("/api/v1/classif-ai/wafer-map/?limit=2")
+        self.assertEquals(len(page["results"]), 1)
+        self.assertEquals(page["results"][0]["total_images"], 3)
+        self.assertEquals(page["results"][0]["upload_session_name"], "wafer-session")
+
+        for i in range(2, 5):
+            WaferMap.objects.create(organization_wafer_id=f"test-wafer-map-{i}", meta_data={})
+        first_page, first_page_query_count = self.list_wafer_maps("/api/v1/classif-ai/wafer-map/?limit=2")
+        self.assertEquals(len(first_page["results"]), 2)
+        # the number of queries doesn't depend on the number of wafers in the page
+        self.assertEquals(first_page_query_count, query_count)
+        second_page, _ = self.list_wafer_maps(first_page["next"])
+        self.assertEquals(
+            {wafer["id"] for wafer in first_page["results"]} & {wafer["id"] for wafer in second_page["results"]}, set()
+        )
@@ -132,5 +132,8 @@ class FileSetInferenceQueueViewSet(BaseViewSet):
                                     file_set_id=file_set["id"], ml_model_id=ml_model["id"], status="PENDING"
                                 )
                             )
-        FileSetInferenceQueue.objects.partial_create(file_set_inference_queues)
-        return Response(status=status.HTTP_201_CREATED)
+        task_id = FileSetInferenceQueue.objects.partial_create(file_set_inference_queues)
+        return Response(
+            {"success": True, "message": "Inference is being queued", "task_id": task_id},
+            status=status.HTTP_201_CREATED,
+        )
@@ -1,4 +1,3 @@
-import importlib
 import logging
 from datetime import datetime, MINYEAR
 
@@ -34,8 +33,11 @@ from apps.classif_ai.serializers import (
     MlModelDetailSerializer,
     FilesetDefectNamesResponse,
 )
+from apps.classif_ai.service.metric_rollup_service import mark_files_stale
 from apps.classif_ai.services import AnalysisService
 from apps.classif_ai.tasks import copy_images_to_folder
+from apps.classif_ai.tenant_hooks import get_tenant_hook
+from common.file_storage import get_pre_signed_urls
 from common.views import BaseViewSet
 from sixsense.settings import PROJECT_START_DATE
 
@@ -197,6 +199,8 @@ class FileSetViewSet(BaseViewSet):
             file_region_history.delete()
             file_regions_with_ai_region_is_not_null.delete()
             file_regions_with_ai_region_is_null.delete()
+            # the classifications of the files are deleted along with them
+            mark_files_stale(files.values_list("id", flat=True))
             # ToDo: Delete the actual files from the storage as well
             files.delete()
             file_set_inference_queues.delete()
@@ -433,6 +437,8 @@ class FileSetViewSet(BaseViewSet):
                 ).order_by("-updated_ts"),
             )
         )
+        file_sets = list(file_sets)
+        pre_signed_urls = get_pre_signed_urls(file.path for file_set in file_sets for file in file_set.files.all())
         defects_id_name_map = {}
         for defect in Defect.objects.all():
             defects_id_name_map[defect.id] = defect.name
@@ -449,7 +455,7 @@ class FileSetViewSet(BaseViewSet):
                         ml_model_id_for_gt = file.file_regions.first().ml_model_id
                         latest_updated_ts = file.file_regions.first().updated_ts
             for file in file_set.files.all():
-                file_data = FileReadSerializer(instance=file).data
+                file_data = FileReadSerializer(instance=file, context={"pre_signed_urls": pre_signed_urls}).data
                 # Collect all valid GT file regions for ml_model_id_for_gt
                 if defects.get(file.id, None) is None:
                     defects[file.id] = []
@@ -566,20 +572,15 @@ class UploadMetaInfoViewSet(viewsets.ViewSet):
         upload_session = UploadSession.objects.get(id=upload_session_id)
         file_sets = upload_session.file_sets.all()
         subscription_id = upload_session.subscription_id
-        helpers_module = importlib.import_module("apps.classif_ai.helpers")
         file = file.file.read()
-        try:
-            header_meta_info = getattr(helpers_module, connection.tenant.schema_name + "_header_xml_to_dict")(
-                meta_file_path=file, subscription_id=subscription_id
-            )
-        except AttributeError:
-            header_meta_info = {}
-        try:
-            yield_meta_info = getattr(helpers_module, connection.tenant.schema_name + "_yield_xml_to_dict")(
-                meta_file_path=file, subscription_id=subscription_id
-            )
-        except AttributeError:
-            yield_meta_info = {}
+        header_xml_to_dict = get_tenant_hook("header_xml_to_dict")
+        header_meta_info = {}
+        if header_xml_to_dict is not None:
+            header_meta_info = header_xml_to_dict(meta_file_path=file, subscription_id=subscription_id)
+        yield_xml_to_dict = get_tenant_hook("yield_xml_to_dict")
+        yield_meta_info = {}
+        if yield_xml_to_dict is not None:
+            yield_meta_info = yield_xml_to_dict(meta_file_path=file, subscription_id=subscription_id)
         for head_item, yield_item in zip(header_meta_info.items(), yield_meta_info.items()):
             with transaction.atomic():
                 file_sets.update(
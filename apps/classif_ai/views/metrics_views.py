@@ -1,9 +1,6 @@
 import csv
-from functools import reduce
-from operator import ior
 import logging
 import sys
-import tempfile
 from calendar import monthrange
 from datetime import datetime, timedelta
 from pydoc import locate
@@ -11,15 +8,14 @@ import requests
 
 import pytz
 from django.contrib.postgres.aggregates import JSONBAgg, ArrayAgg
-from django.db.models import Case, When, Value, IntegerField, Q
+from django.db.models import Case, When, Value, IntegerField, Q, Prefetch
 from django.db.models.aggregates import Count
-from django.db.models.functions import TruncWeek, TruncMonth, TruncDay
-from django.http import HttpResponse
+from django.http import StreamingHttpResponse
 from rest_framework import viewsets, permissions, status
 from rest_framework.decorators import action, api_view, permission_classes
 from rest_framework.response import Response
 
-from apps.classif_ai.helpers import convert_datetime_to_str, get_env
+from apps.classif_ai.helpers import get_env, get_ordered_defect_ids, get_time_function
 from apps.classif_ai.models import (
     FileRegion,
     JsonKeys,
@@ -36,6 +32,8 @@ from sixsense import settings
 
 logger = logging.getLogger(__name__)
 
+CSV_EXPORT_BATCH_SIZE = 500
+
 
 class PerformanceSummaryViewSet(viewsets.ViewSet):
     permission_classes = [permissions.IsAuthenticated]
@@ -159,41 +157,22 @@ class PerformanceSummaryViewSet(viewsets.ViewSet):
                 "trainingsessionfileset__training_session__new_ml_model_id__in"
             ] = analysis_service.ml_models().values_list("id", flat=True)
 
-        if time_format == "monthly":
-            file_set_time_vals = (
-                analysis_service.file_sets().values("created_ts__month", "created_ts__year").distinct()
-            )
-        elif time_format == "weekly":
-            file_set_time_vals = analysis_service.file_sets().values("created_ts__week", "created_ts__year").distinct()
-        else:
-            file_set_time_vals = analysis_service.file_sets().values("created_ts__date", "created_ts__year").distinct()
-
         graphs = {"classification_accuracy": {}, "detection_accuracy": {}, "overall_accuracy": {}}
-        for time_dict in file_set_time_vals:
-            # expr = {"created_ts__date": time}
+        for bucket in analysis_service.accuracy_trend(get_time_function(time_format)):
+            start_date = bucket["bucket"].date()
             if time_format == "monthly":
-                month = time_dict["created_ts__month"]
-                year = time_dict["created_ts__year"]
-                file_set_filters["created_ts__month"] = month
-                file_set_filters["created_ts__year"] = year
-                last_date = monthrange(year, month)[1]
-                time_str = f"{year}-{month}-1 : {year}-{month}-{last_date}"
-                # expr = {"created_ts__month": time}
+                last_date = monthrange(start_date.year, start_date.month)[1]
+                time_str = (
+                    f"{start_date.year}-{start_date.month}-1 : {start_date.year}-{start_date.month}-{last_date}"
+                )
             elif time_format == "weekly":
-                week = time_dict["created_ts__week"]
-                year = time_dict["created_ts__year"]
-                file_set_filters["created_ts__week"] = week
-                file_set_filters["created_ts__year"] = year
-                monday = datetime.strptime(f"{year}-{week-1}-1", "%Y-%W-%w").date()
-                time_str = f"{monday.strftime('%Y-%m-%d')} : {(monday + timedelta(days=6.9)).strftime('%Y-%m-%d')}"
-                # expr = {"created_ts__week": time}
+                end_date = start_date + timedelta(days=6)
+                time_str = f"{start_date.strftime('%Y-%m-%d')} : {end_date.strftime('%Y-%m-%d')}"
             else:
-                file_set_filters["created_ts__date"] = time_dict["created_ts__date"]
-                time_str = time_dict["created_ts__date"].strftime("%Y-%m-%d")
-            analysis_service = AnalysisService(file_set_filters=file_set_filters, ml_model_filters=ml_model_filters)
-            graphs["classification_accuracy"][time_str] = analysis_service.classification_accuracy()
-            graphs["detection_accuracy"][time_str] = analysis_service.detection_accuracy()
-            graphs["overall_accuracy"][time_str] = analysis_service.overall_accuracy()
+                time_str = start_date.strftime("%Y-%m-%d")
+            graphs["classification_accuracy"][time_str] = bucket["classification_accuracy"]
+            graphs["detection_accuracy"][time_str] = bucket["detection_accuracy"]
+            graphs["overall_accuracy"][time_str] = bucket["overall_accuracy"]
 
         # time_val = None
         #
@@ -419,10 +398,7 @@ class ApplicationChartsViewSet(viewsets.ViewSet):
         )
 
         file_set_id_defect_ids = {}
-        ordered_defect_ids = get_env().list("ORDERED_DEFECT_IDS", cast=int, default=[1, 2, 4, 5, 3, 6])
-        ordered_defect_ids = ordered_defect_ids + list(
-            Defect.objects.exclude(id__in=ordered_defect_ids).order_by("created_ts").values_list("id", flat=True)
-        )
+        ordered_defect_ids = get_ordered_defect_ids()
 
         if priority:
             new_ai_file_sets = []
@@ -524,207 +500,8 @@ class ApplicationChartsViewSet(viewsets.ViewSet):
 
         exclude_defects = list(Defect.objects.filter(~Q(id__in=include_defects)).values_list("id", flat=True))
         analysis_service = AnalysisService(file_set_filters, ml_model_filters, auto_model)
-        if not auto_model:
-            file_sets = (
-                analysis_service.file_sets()
-                .filter(
-                    Q(
-                        files__file_regions__defects__has_any_keys=include_defects,
-                        files__file_regions__is_user_feedback=False,
-                    )
-                    | Q(files__file_regions__isnull=True)
-                )
-                .values("id", "meta_info__lot_id")
-                .distinct()
-            )
-        else:
-            filters = []
-            model_id_file_set_map = analysis_service.get_auto_model_file_set_ids_map()
-            for model_id, file_set_ids in model_id_file_set_map.items():
-                file_set_ids = list(file_set_ids)
-                # filter =  (Q(
-                # Q(
-                # files__file_regions__defects__has_any_keys=include_defects,
-                # files__file_regions__is_user_feedback=False,
-                # files__file_regions__ml_model_id=model_id
-                # ) |
-                # ~ Q(
-                # id__in=FileRegion.objects.filter(
-                # ml_model_id=model_id, is_user_feedback=False,
-                # ).values_list('file__file_set__id', flat=True)
-                # )
-                # ) & Q(
-                # id__in=file_set_ids
-                # )
-                # )
-                filter = ~Q(
-                    id__in=FileRegion.objects.filter(
-                        ml_model_id=model_id, is_user_feedback=False, defects__has_any_keys=exclude_defects
-                    ).values_list("file__file_set__id", flat=True)
-                ) & Q(id__in=file_set_ids)
-                filters.append(filter)
-            or_filters = reduce(ior, filters)
-            file_sets = FileSet.objects.filter(or_filters).values("id", "meta_info__lot_id").distinct()
-
-        if time_format == "monthly":
-            distinct_meta_info = (
-                analysis_service.file_sets()
-                .filter(file_set_inference_queues__status="FINISHED")
-                .values("meta_info__lot_id", "meta_info__InitialTotal", "meta_info__MachineNo")
-                .distinct()
-                .annotate(time_val=TruncMonth("created_ts"))
-            )
-            file_sets = file_sets.annotate(time_val=TruncMonth("created_ts"))
-        elif time_format == "weekly":
-            distinct_meta_info = (
-                analysis_service.file_sets()
-                .filter(file_set_inference_queues__status="FINISHED")
-                .values("meta_info__lot_id", "meta_info__InitialTotal", "meta_info__MachineNo")
-                .distinct()
-                .annotate(time_val=TruncWeek("created_ts"))
-            )
-
-            file_sets = file_sets.annotate(time_val=TruncWeek("created_ts"))
-            # file_sets = analysis_service.file_sets().exclude(
-            # files__file_regions__defects__has_any_keys=exclude_defects
-            # ).values('id', 'meta_info__lot_id').distinct().annotate(time_val=TruncWeek('created_ts'))
-        else:
-            distinct_meta_info = (
-                analysis_service.file_sets()
-                .filter(file_set_inference_queues__status="FINISHED")
-                .values("meta_info__lot_id", "meta_info__InitialTotal", "meta_info__MachineNo")
-                .distinct()
-                .annotate(time_val=TruncDay("created_ts"))
-            )
-
-            # file_sets = analysis_service.file_regions().exclude(
-            # defects__has_any_keys=exclude_defects
-            # ).values('file__file_set_id', 'file__file_set__meta_info__lot_id').distinct().annotate(
-            # time_val=TruncDay('file__file_set__created_ts')
-            # )
-            file_sets = file_sets.annotate(time_val=TruncMonth("created_ts"))
-
-        overkill_scatter_plot = {}
-        overkill_trend = {}
-        meta_info_grouped_by_time_val = {}
-        file_set_id_grouped_by_time_val = {}
-        checked_in_lot_ids = {}
-        for meta_info in distinct_meta_info:
-            time_val = meta_info["time_val"]
-            lot_id = meta_info["meta_info__lot_id"]
-            if not time_val in checked_in_lot_ids:
-                checked_in_lot_ids[time_val] = []
-            if meta_info_grouped_by_time_val.get(time_val, None) is None:
-                if lot_id not in checked_in_lot_ids[time_val]:
-                    meta_info_grouped_by_time_val[time_val] = [
-                        [lot_id, meta_info["meta_info__InitialTotal"], meta_info["meta_info__MachineNo"]]
-                    ]
-                    checked_in_lot_ids[time_val].append(lot_id)
-            else:
-                if lot_id not in checked_in_lot_ids[time_val]:
-                    meta_info_grouped_by_time_val[time_val].append(
-                        [lot_id, meta_info["meta_info__InitialTotal"], meta_info["meta_info__MachineNo"]]
-                    )
-                    checked_in_lot_ids[time_val].append(lot_id)
-
-        for file_set in file_sets:
-            time_val = file_set["time_val"]
-            lot_id = file_set["meta_info__lot_id"]
-            if file_set_id_grouped_by_time_val.get(time_val, None) is None:
-                file_set_id_grouped_by_time_val[time_val] = {lot_id: [file_set["id"]]}
-            else:
-                if file_set_id_grouped_by_time_val[time_val].get(lot_id, None) is None:
-                    file_set_id_grouped_by_time_val[time_val][lot_id] = [file_set["id"]]
-                else:
-                    file_set_id_grouped_by_time_val[time_val][lot_id].append(file_set["id"])
-
-        machine_initial_total_count = {}
-
-        for time_val, meta_info in meta_info_grouped_by_time_val.items():
-            scatter_result = []
-            trend_result = []
-            total_inspected = 0
-            for info in meta_info:
-                if info[0] and info[1]:
-                    total_inspected += int(info[1])
-                    try:
-                        count = len(file_set_id_grouped_by_time_val[time_val][info[0]])
-                    except KeyError:
-                        count = 0
-                    if not machine_initial_total_count.get(info[2], None):
-                        machine_initial_total_count[info[2]] = [0, 0]
-                    total_and_count = machine_initial_total_count[info[2]]
-                    total_and_count[0] += count
-                    total_and_count[1] += int(info[1])
-                    try:
-                        overkill_scatter_percentage = round(count * 100 / int(info[1]), 2)
-                        scatter_result.append(
-                            {
-                                "machine_no": info[2],
-                                "lot_id": info[0],
-                                "percentage": overkill_scatter_percentage,
-                                "over_reject_count": count,
-                                "total_unit_count": int(info[1]),
-                            }
-                        )
-                    except ZeroDivisionError:
-                        overkill_scatter_percentage = None
-
-            for scatter in scatter_result:
-                machine_no = scatter["machine_no"]
-                try:
-                    idx = next(i for i, d in enumerate(trend_result) if machine_no in d.values())
-                    trend_result[idx]["over_reject_count"] += scatter["over_reject_count"]
-                    trend_result[idx]["total_unit_count"] += scatter["total_unit_count"]
-                except StopIteration:
-                    trend_result.append(
-                        {
-                            "machine_no": machine_no,
-                            "over_reject_count": scatter["over_reject_count"],
-                            "total_unit_count": scatter["total_unit_count"],
-                        }
-                    )
 
-            for trend in trend_result:
-                trend["percentage"] = round(trend["over_reject_count"] * 100 / trend["total_unit_count"], 2)
-
-            time_str = time_val.strftime("%Y-%m-%d")
-            if time_format == "monthly":
-                year = time_val.year
-                month = time_val.month
-                last_date = monthrange(year, month)[1]
-                time_str = f"{time_str} : {year}-{month}-{last_date}"
-            elif time_format == "weekly":
-                end_date = time_val + timedelta(days=7)
-                time_str = f"{time_str} : {end_date.strftime('%Y-%m-%d')}"
-
-            overkill_scatter_plot[time_str] = scatter_result
-            overkill_trend[time_str] = trend_result
-
-        modified_overkill_trend = []
-        for date in overkill_trend:
-            obj = {"date_range": date}
-            for ele in overkill_trend[date]:
-                obj[ele["machine_no"]] = {
-                    "total_unit_count": ele["total_unit_count"],
-                    "over_reject_count": ele["over_reject_count"],
-                    "percentage": ele["percentage"],
-                }
-            modified_overkill_trend.append(obj)
-
-        response = {
-            "overkill_scatter": overkill_scatter_plot,
-            "overkill_trend": modified_overkill_trend,
-            "machine_wise_overkill_rate": {},
-        }
-
-        for machine, val in machine_initial_total_count.items():
-            response["machine_wise_overkill_rate"][machine] = {
-                "percentage": round(100 * val[0] / val[1], 2),
-                "over_reject_count": val[0],
-                "total_unit_count": val[1],
-            }
-        return Response(response)
+        return Response(analysis_service.overkill_trend(include_defects, exclude_defects, time_format))
 
     @action(
         detail=False,
@@ -854,86 +631,77 @@ class ApplicationChartsViewSet(viewsets.ViewSet):
         return Response({"pre_signed_url": pre_signed_url}, status=status.HTTP_200_OK)
 
 
-@api_view(["GET"])
-@permission_classes((permissions.IsAuthenticated,))
-def prediction_csv(request):
-    file_set_filters = {}
-    ml_model_filters = {}
-    date__gte = datetime(2020, 7, 31, 0, 0, 0, tzinfo=pytz.UTC)
-    date__lte = datetime.now()
-    file_set_filters["created_ts__gte"] = date__gte
-    file_set_filters["created_ts__lte"] = date__lte
-    single_label_classification = True
-
-    for key, val in request.query_params.items():
-        if key == "ml_model_id__in":
-            ml_model_filters["id__in"] = list(map(int, (val.split("-"))))
-        elif key == "subscription_id":
-            file_set_filters["subscription_id__in"] = val.split(",")
-        elif key == "date__gte":
-            file_set_filters["created_ts__gte"] = datetime(*list(map(int, (val.split("-")))), tzinfo=pytz.UTC)
-        elif key == "date__lte":
-            file_set_filters["created_ts__lte"] = datetime(*list(map(int, (val.split("-")))), tzinfo=pytz.UTC)
-        else:
-            file_set_filters[key] = val.split(",")
+class Echo:
+    """An object that implements just the write method of the file-like interface, so that csv.writer returns the
+    formatted row instead of writing it anywhere."""
 
-    ml_model_map = {}
-    for model in MlModel.objects.filter(id__in=ml_model_filters["id__in"]).prefetch_related("use_case"):
-        if model.classification_type != "SINGLE_LABEL":
-            single_label_classification = False
-        ml_model_map[model.id] = model.name
-    upload_session_ids = file_set_filters["upload_session_id__in"]
-    upload_session_names = list(
-        UploadSession.objects.filter(id__in=list(map(int, upload_session_ids))).values_list("name", flat=True)
-    )
+    def write(self, value):
+        return value
 
-    analysis_service = AnalysisService(file_set_filters, ml_model_filters)
-    # files = analysis_service.files().prefetch_related(Prefetch("file_regions", queryset=
-    # FileRegion.objects.filter(ml_model_id__in=list(ml_model_map.keys()))))
-
-    temp_csv = tempfile.NamedTemporaryFile()
-    with open(temp_csv.name, "w", newline="") as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(
-            ["File", "Folder", "Coordinates", "AI Predictions", "Ground Truth", "Model", "InferenceStatus"]
-        )
-        defect_name_map = {}
-        for defect in Defect.objects.all():
-            defect_name_map[defect.id] = defect.name
 
-        all_file_sets = analysis_service.file_sets().prefetch_related("files", "files__file_regions", "upload_session")
-        queue_items = FileSetInferenceQueue.objects.filter(
-            file_set__in=all_file_sets, ml_model_id__in=ml_model_filters["id__in"]
-        ).order_by("created_ts")
+def streaming_csv_response(rows, file_name):
+    writer = csv.writer(Echo())
+    response = StreamingHttpResponse((writer.writerow(row) for row in rows), content_type="application/csv")
+    response["Content-Disposition"] = f"attachment; file_name={file_name}.csv"
+    response["Access-Control-Expose-Headers"] = "Content-Disposition"
+    return response
 
-        model_file_set_task_map = {}
-        for item in queue_items:
-            if not model_file_set_task_map.get(item.ml_model_id, None):
-                model_file_set_task_map[item.ml_model_id] = {item.file_set_id: [item]}
-            else:
-                if not model_file_set_task_map[item.ml_model_id].get(item.file_set_id, None):
-                    model_file_set_task_map[item.ml_model_id][item.file_set_id] = [item]
-                else:
-                    model_file_set_task_map[item.ml_model_id][item.file_set_id].append(item)
 
-        for file_set in all_file_sets:
+def iterate_in_batches(queryset, batch_size=CSV_EXPORT_BATCH_SIZE):
+    """Reads the ids of queryset through a server side cursor and yields them in lists of batch_size."""
+    batch = []
+    for pk in queryset.values_list("id", flat=True).iterator(chunk_size=batch_size):
+        batch.append(pk)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def prediction_csv_rows(file_set_ids, ml_model_ids, ml_model_map, single_label_classification):
+    yield ["File", "Folder", "Coordinates", "AI Predictions", "Ground Truth", "Model", "InferenceStatus"]
+    defect_name_map = dict(Defect.objects.values_list("id", "name"))
+    model_name = None
+    inference_status = None
+    for file_set_ids_batch in iterate_in_batches(file_set_ids):
+        file_sets = (
+            FileSet.objects.filter(id__in=file_set_ids_batch)
+            .order_by("id")
+            .select_related("upload_session")
+            .prefetch_related(
+                "files",
+                Prefetch(
+                    "files__file_regions",
+                    queryset=FileRegion.objects.annotate(feedback_regions_count=Count("file_regions")),
+                ),
+                Prefetch(
+                    "file_set_inference_queues",
+                    queryset=FileSetInferenceQueue.objects.filter(ml_model_id__in=ml_model_ids).order_by(
+                        "created_ts", "id"
+                    ),
+                    to_attr="filtered_inference_queue_items",
+                ),
+            )
+        )
+        for file_set in file_sets:
+            last_queue_item_by_model = {}
+            for item in file_set.filtered_inference_queue_items:
+                last_queue_item_by_model[item.ml_model_id] = item
             ai_defects_slc = []
             gt_defects_slc = []
             for file in file_set.files.all():
                 if not file.file_regions.all():
-                    item = file_set.file_set_inference_queues.filter(ml_model_id__in=ml_model_filters["id__in"]).last()
-                    if item:
-                        model_id = item.ml_model_id
-                        model_name = ml_model_map[model_id]
+                    if file_set.filtered_inference_queue_items:
+                        item = file_set.filtered_inference_queue_items[-1]
+                        model_name = ml_model_map[item.ml_model_id]
                         inference_status = item.status
-                        writer.writerow(
-                            [file.name, file_set.upload_session.name, None, None, None, model_name, inference_status]
-                        )
+                        yield [file.name, file_set.upload_session.name, None, None, None, model_name, inference_status]
                         continue
                 for region in file.file_regions.all():
                     ai_defects = []
                     gt_defects = []
-                    if region.ml_model_id in ml_model_filters["id__in"]:
+                    if region.ml_model_id in ml_model_ids:
                         if region.is_user_feedback is False:
                             for defect_id in region.defects:
                                 defect_name = defect_name_map[int(defect_id)]
@@ -945,7 +713,7 @@ def prediction_csv(request):
                                         region.detection_correctness is True
                                         or region.classification_correctness is True
                                     )
-                                    and region.file_regions.count() == 0
+                                    and region.feedback_regions_count == 0
                                 ):
                                     gt_defects_slc.append(defect_name)
                                     gt_defects.append(defect_name)
@@ -955,140 +723,111 @@ def prediction_csv(request):
                                     defect_name = defect_name_map[int(defect_id)]
                                     gt_defects_slc.append(defect_name)
                                     gt_defects.append(defect_name)
-                        coordinates = region.region
-                        ai_defects = ";".join(ai_defects)
-                        gt_defects = ";".join(gt_defects)
-                        try:
-                            items = model_file_set_task_map[region.ml_model_id][file_set.id]
-                            inference_status = items[-1].status
-                            model_name = ml_model_map[region.ml_model_id]
-                            if not single_label_classification:
-                                writer.writerow(
-                                    [
-                                        file.name,
-                                        file_set.upload_session.name,
-                                        coordinates,
-                                        ai_defects,
-                                        gt_defects,
-                                        model_name,
-                                        inference_status,
-                                    ]
-                                )
-                        except KeyError:
+                        item = last_queue_item_by_model.get(region.ml_model_id, None)
+                        if item is None:
                             continue
+                        inference_status = item.status
+                        model_name = ml_model_map[region.ml_model_id]
+                        if not single_label_classification:
+                            yield [
+                                file.name,
+                                file_set.upload_session.name,
+                                region.region,
+                                ";".join(ai_defects),
+                                ";".join(gt_defects),
+                                model_name,
+                                inference_status,
+                            ]
                 if single_label_classification:
-                    ai_defects_joined = ";".join(ai_defects_slc)
-                    gt_defects_joined = ";".join(gt_defects_slc)
-                    writer.writerow(
-                        [
-                            file.name,
-                            file_set.upload_session.name,
-                            None,
-                            ai_defects_joined,
-                            gt_defects_joined,
-                            model_name,
-                            inference_status,
-                        ]
-                    )
-
-    FilePointer = open(temp_csv.name, "r")
-    response = HttpResponse(FilePointer, content_type="application/csv")
-    file_name = "-".join(upload_session_names)
-    response["Content-Disposition"] = f"attachment; file_name={file_name}.csv"
-    response["Access-Control-Expose-Headers"] = "Content-Disposition"
-
-    return response
+                    yield [
+                        file.name,
+                        file_set.upload_session.name,
+                        None,
+                        ";".join(ai_defects_slc),
+                        ";".join(gt_defects_slc),
+                        model_name,
+                        inference_status,
+                    ]
 
 
 @api_view(["GET"])
 @permission_classes((permissions.IsAuthenticated,))
-def ai_results_csv(request):
+def prediction_csv(request):
     file_set_filters = {}
     ml_model_filters = {}
-    date__gte = settings.PROJECT_START_DATE
+    date__gte = datetime(2020, 7, 31, 0, 0, 0, tzinfo=pytz.UTC)
     date__lte = datetime.now()
     file_set_filters["created_ts__gte"] = date__gte
     file_set_filters["created_ts__lte"] = date__lte
-    subscription_id = None
+    single_label_classification = True
 
     for key, val in request.query_params.items():
         if key == "ml_model_id__in":
-            ml_model_filters["id__in"] = val.split(",")
+            ml_model_filters["id__in"] = list(map(int, (val.split("-"))))
         elif key == "subscription_id":
             file_set_filters["subscription_id__in"] = val.split(",")
-            subscription_id = val
         elif key == "date__gte":
             file_set_filters["created_ts__gte"] = datetime(*list(map(int, (val.split("-")))), tzinfo=pytz.UTC)
         elif key == "date__lte":
             file_set_filters["created_ts__lte"] = datetime(*list(map(int, (val.split("-")))), tzinfo=pytz.UTC)
         else:
             file_set_filters[key] = val.split(",")
-    analysis_service = AnalysisService(file_set_filters, ml_model_filters)
 
-    ordered_defect_ids = get_env().list("ORDERED_DEFECT_IDS", cast=int, default=[1, 2, 4, 5, 3, 6])
-    defect_ordering_cases = []
-    for idx, defect_id in enumerate(ordered_defect_ids):
-        defect_ordering_cases.append(When(id=defect_id, then=Value(idx)))
-    defect_ordering_cases.append(When(~Q(id__in=ordered_defect_ids), then=Value(100000)))
-    ordered_defects = list(
-        Defect.objects.annotate(
-            custom_order=Case(
-                *defect_ordering_cases,
-                output_field=IntegerField(),
-            )
-        )
-        .order_by("custom_order")
-        .values_list("id", "name")
+    ml_model_map = {}
+    for model in MlModel.objects.filter(id__in=ml_model_filters["id__in"]).prefetch_related("use_case"):
+        if model.classification_type != "SINGLE_LABEL":
+            single_label_classification = False
+        ml_model_map[model.id] = model.name
+    upload_session_ids = file_set_filters["upload_session_id__in"]
+    upload_session_names = list(
+        UploadSession.objects.filter(id__in=list(map(int, upload_session_ids))).values_list("name", flat=True)
     )
-    ordered_defect_ids = [defect[0] for defect in ordered_defects]
-    ordered_defect_names = [defect[1] for defect in ordered_defects]
-    file_set_meta_info = Subscription.objects.get(id=subscription_id).file_set_meta_info
-    meta_info_args = [f"meta_info__{item['field']}" for item in file_set_meta_info]
-    meta_info_headings = [item["field"] for item in file_set_meta_info]
 
-    file_sets = (
-        FileSet.objects.filter(files__file_regions__in=analysis_service.ai_regions())
-        .values("id", *meta_info_args)
-        .distinct()
-        .annotate(defects=JSONBAgg("files__file_regions__defects"))
-    )
-    file_set_lot_id_count = (
-        analysis_service.file_sets().values("meta_info__lot_id").annotate(count=Count("id", distinct=True))
+    analysis_service = AnalysisService(file_set_filters, ml_model_filters)
+    rows = prediction_csv_rows(
+        analysis_service.file_sets().order_by("id"),
+        ml_model_filters["id__in"],
+        ml_model_map,
+        single_label_classification,
     )
-    # file_set_lot_id_count = FileSet.objects.filter(
-    #     files__file_regions__in=analysis_service.ai_regions()
-    # ).values('meta_info__lot_id').annotate(count=Count('id', distinct=True))
-    meta_info_rows = {}
+    return streaming_csv_response(rows, "-".join(upload_session_names))
+
 
-    for file_set in file_sets:
+def ai_results_csv_rows(file_sets, file_set_lot_id_count, meta_info_headings, ordered_defect_ids, ordered_defect_names):
+    """Yields a row per lot. The file sets are read ordered by lot, the row of a lot is yielded as soon as the next lot
+    starts, so that only one lot is held in memory."""
+    yield [*meta_info_headings, "No. of records received by the platform", *ordered_defect_names]
+    lot_id_count_map = {item["meta_info__lot_id"]: item["count"] for item in file_set_lot_id_count}
+    row = None
+    row_lot_id = None
+
+    for file_set in file_sets.order_by("meta_info__lot_id").iterator(chunk_size=CSV_EXPORT_BATCH_SIZE):
         lot_id = file_set["meta_info__lot_id"]
+        if row is not None and lot_id != row_lot_id:
+            yield row
+            row = None
         defects = file_set.pop("defects")
         file_set.pop("id")
         defect_ids = [defect_id for defect in defects for defect_id in defect]
         defect_ids = list(map(int, defect_ids))
-        # if all_meta_uniq_el not in meta_info_rows:
-        if lot_id not in meta_info_rows:
+        if row is None:
             val = list(file_set.values())
-            try:
-                count = next(item for item in file_set_lot_id_count if lot_id in item.values())["count"]
-                val.append(count)
-            except StopIteration:
+            if lot_id not in lot_id_count_map:
                 continue
+            val.append(lot_id_count_map[lot_id])
             val.extend([0] * len(ordered_defect_ids))
-            meta_info_rows[lot_id] = val
+            row = val
+            row_lot_id = lot_id
             for order_defect_id in ordered_defect_ids:
                 for defect_id in defect_ids:
                     if defect_id == order_defect_id:
                         idx = ordered_defect_ids.index(defect_id)
-                        row = meta_info_rows[lot_id]
                         row[len(file_set) + idx + 1] = 1
-                        meta_info_rows[lot_id] = row
                         break
                 else:
                     continue
                 break
         else:
-            row = meta_info_rows[lot_id]
             # row_arr = row[0].split(',')
             for idx, el in enumerate(row):
                 if idx < len(list(file_set.values())):
@@ -1103,30 +842,80 @@ def ai_results_csv(request):
                     pp.append(new_pp)
                     pp = list(map(str, set(pp)))
                     row[idx] = ";;".join(pp)
-            meta_info_rows[lot_id] = row
             for order_defect_id in ordered_defect_ids:
                 for defect_id in defect_ids:
                     if defect_id == order_defect_id:
                         idx = ordered_defect_ids.index(defect_id)
                         row[len(file_set) + idx + 1] += 1
-                        meta_info_rows[lot_id] = row
                         break
                 else:
                     continue
                 break
 
-    temp_csv = tempfile.NamedTemporaryFile()
-    with open(temp_csv.name, "w", newline="") as csvfile:
-        writer = csv.writer(csvfile)
-        heading_row = [*meta_info_headings, "No. of records received by the platform", *ordered_defect_names]
-        writer.writerow(heading_row)
-        for row in meta_info_rows.values():
-            writer.writerow(row)
+    if row is not None:
+        yield row
 
-    FilePointer = open(temp_csv.name, "r")
-    response = HttpResponse(FilePointer, content_type="application/csv")
-    file_name = "ai_results"  # ToDo: Rename to something more sensible.
-    response["Content-Disposition"] = f"attachment; file_name={file_name}.csv"
-    response["Access-Control-Expose-Headers"] = "Content-Disposition"
 
-    return response
+@api_view(["GET"])
+@permission_classes((permissions.IsAuthenticated,))
+def ai_results_csv(request):
+    file_set_filters = {}
+    ml_model_filters = {}
+    date__gte = settings.PROJECT_START_DATE
+    date__lte = datetime.now()
+    file_set_filters["created_ts__gte"] = date__gte
+    file_set_filters["created_ts__lte"] = date__lte
+    subscription_id = None
+
+    for key, val in request.query_params.items():
+        if key == "ml_model_id__in":
+            ml_model_filters["id__in"] = val.split(",")
+        elif key == "subscription_id":
+            file_set_filters["subscription_id__in"] = val.split(",")
+            subscription_id = val
+        elif key == "date__gte":
+            file_set_filters["created_ts__gte"] = datetime(*list(map(int, (val.split("-")))), tzinfo=pytz.UTC)
+        elif key == "date__lte":
+            file_set_filters["created_ts__lte"] = datetime(*list(map(int, (val.split("-")))), tzinfo=pytz.UTC)
+        else:
+            file_set_filters[key] = val.split(",")
+    analysis_service = AnalysisService(file_set_filters, ml_model_filters)
+
+    ordered_defect_ids = get_env().list("ORDERED_DEFECT_IDS", cast=int, default=[1, 2, 4, 5, 3, 6])
+    defect_ordering_cases = []
+    for idx, defect_id in enumerate(ordered_defect_ids):
+        defect_ordering_cases.append(When(id=defect_id, then=Value(idx)))
+    defect_ordering_cases.append(When(~Q(id__in=ordered_defect_ids), then=Value(100000)))
+    ordered_defects = list(
+        Defect.objects.annotate(
+            custom_order=Case(
+                *defect_ordering_cases,
+                output_field=IntegerField(),
+            )
+        )
+        .order_by("custom_order")
+        .values_list("id", "name")
+    )
+    ordered_defect_ids = [defect[0] for defect in ordered_defects]
+    ordered_defect_names = [defect[1] for defect in ordered_defects]
+    file_set_meta_info = Subscription.objects.get(id=subscription_id).file_set_meta_info
+    meta_info_args = [f"meta_info__{item['field']}" for item in file_set_meta_info]
+    meta_info_headings = [item["field"] for item in file_set_meta_info]
+
+    file_sets = (
+        FileSet.objects.filter(files__file_regions__in=analysis_service.ai_regions())
+        .values("id", *meta_info_args)
+        .distinct()
+        .annotate(defects=JSONBAgg("files__file_regions__defects"))
+    )
+    file_set_lot_id_count = (
+        analysis_service.file_sets().values("meta_info__lot_id").annotate(count=Count("id", distinct=True))
+    )
+    # file_set_lot_id_count = FileSet.objects.filter(
+    #     files__file_regions__in=analysis_service.ai_regions()
+    # ).values('meta_info__lot_id').annotate(count=Count('id', distinct=True))
+    rows = ai_results_csv_rows(
+        file_sets, file_set_lot_id_count, meta_info_headings, ordered_defect_ids, ordered_defect_names
+    )
+    file_name = "ai_results"  # ToDo: Rename to something more sensible.
+    return streaming_csv_response(rows, file_name)
@@ -1,4 +1,3 @@
-import boto3
 from django.core.exceptions import ValidationError
 from rest_framework import permissions, status
 from rest_framework.decorators import action
@@ -7,6 +6,7 @@ from rest_framework.response import Response
 from apps.classif_ai.models import TrainingSession, MlModelDefect, TrainingSessionFileSet
 from apps.classif_ai.serializers import TrainingSessionSerializer
 from apps.classif_ai.services import TrainingTerminator
+from common.services import get_boto3_client
 from common.views import BaseViewSet
 from sixsense.settings import RETRAINING_QUEUE_REGION_NAME
 
@@ -33,7 +33,7 @@ class TrainingSessionViewSet(BaseViewSet):
 
     @action(detail=True, methods=["POST"])
     def start(self, request, pk):
-        client = boto3.client("sqs", region_name=RETRAINING_QUEUE_REGION_NAME)
+        client = get_boto3_client("sqs", region_name=RETRAINING_QUEUE_REGION_NAME)
         try:
             training_session = TrainingSession.objects.prefetch_related("new_ml_model").get(id=pk)
             if training_session.new_ml_model.status != "draft":
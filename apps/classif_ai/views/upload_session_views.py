@@ -9,6 +9,7 @@ from rest_framework.response import Response
 from apps.classif_ai.filters import UploadSessionFilterSet
 from apps.classif_ai.models import UploadSession, FileSet, FileSetInferenceQueue, File, FileRegion, FileRegionHistory
 from apps.classif_ai.serializers import UploadSessionSerializer
+from apps.classif_ai.service.metric_rollup_service import mark_files_stale
 from apps.classif_ai.tasks import stitch_image_worker
 from common.views import BaseViewSet
 from sixsense.settings import PROJECT_START_DATE
@@ -79,6 +80,8 @@ class UploadSessionViewSet(BaseViewSet):
             file_region_history.delete()
             file_regions_with_ai_region_is_not_null.delete()
             file_regions_with_ai_region_is_null.delete()
+            # the classifications of the files are deleted along with them
+            mark_files_stale(files.values_list("id", flat=True))
             # ToDo: Delete the actual files from the storage as well
             files.delete()
             file_set_inference_queues.delete()
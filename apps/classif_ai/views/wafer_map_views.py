@@ -8,12 +8,19 @@ from apps.classif_ai.filters import WaferMapFilterSet
 from apps.classif_ai.models import WaferMap
 from apps.classif_ai.models import WaferMapTag
 from apps.classif_ai.serializers import WaferMapReadSerializer, WaferMapSerializer
-from common.views import BaseViewSet
+from common.views import BaseViewSet, SixsenseCursorPagination
+
+
+class WaferMapCursorPagination(SixsenseCursorPagination):
+    ordering = "updated_ts"
 
 
 class WaferMapViewSet(BaseViewSet):
     permission_classes = [permissions.IsAuthenticated]
-    pagination_class = None
+    pagination_class = WaferMapCursorPagination
+    # the filters are applied by WaferMapFilterSet, the backends only pick the cursor pagination ordering
+    filter_backends = [filters.OrderingFilter]
+    ordering_fields = ["id", "organization_wafer_id", "status", "created_ts", "updated_ts"]
     queryset = WaferMap.objects.all().defer("meta_data", "coordinate_meta_info", "defect_pattern_info")
 
     def get_serializer_context(self):
@@ -32,21 +39,14 @@ class WaferMapViewSet(BaseViewSet):
 
     def list(self, request, *args, **kwargs):
         serializer = self.get_serializer_class()
-
-        file_set_filter = WaferMapFilterSet(request.query_params, queryset=self.get_queryset(), request=request)
-        queryset = file_set_filter.qs
-
-        ordering = self.request.query_params.get("ordering")
-        if ordering:
-            ordering = ordering.split(",")
+        queryset = WaferMapFilterSet(request.query_params, queryset=self.get_queryset(), request=request).qs
+        if serializer is WaferMapSerializer:
+            queryset = queryset.defer(None).prefetch_related("tags")
         else:
-            ordering = ["updated_ts"]
-        queryset = queryset.order_by(*ordering)
-        limit = self.request.query_params.get("limit")
-        if limit:
-            queryset = queryset[: int(limit)]
-        serialized = serializer(queryset, many=True)
-        return Response(serialized.data)
+            queryset = WaferMapReadSerializer.annotate_queryset(queryset)
+        page = self.paginate_queryset(queryset)
+        serialized = serializer(page, many=True, context=self.get_serializer_context())
+        return self.get_paginated_response(serialized.data)
 
     # @staticmethod
     # def filter_wafers(query_params):
@@ -59,29 +59,19 @@ class WaferMapViewSet(BaseViewSet):
 
     def add_tags(self, qs, tag_ids):
         """
-        Add the tags for the specified waferMap.
+        Add the tags for the specified waferMap, returns the number of tags added.
         """
-        # ToDo: This API could be very slow if the qs count is very high
-        #   At the time of writing, django didn't support insert select.
-        #   Sample SQL:
-        #       INSERT INTO WaferMapTag(wafer_id, tag_id)
-        #       SELECT wafermaps.id, tags.id
-        #       FROM wafermaps  full outer join tags
-        #       WHERE  wafermaps.id in (1,2) and tags.id in (4,5)
-        wafer_map_tags = []
-        for wafer in qs.values("id"):
-            for tag_id in tag_ids:
-                wafer_map_tags.append(WaferMapTag(wafer_id=wafer["id"], tag_id=tag_id))
-        WaferMapTag.objects.bulk_create(wafer_map_tags)
+        return WaferMapTag.objects.add_tags(qs, tag_ids)
 
     def remove_tags(self, qs, tag_ids=None, remove_all=False):
         """
-        Remove the tags from the specified waferMap.
+        Remove the tags from the specified waferMap, returns the number of tags removed.
         """
         if remove_all:
-            WaferMapTag.objects.filter(wafer__in=qs).delete()
+            return WaferMapTag.objects.remove_tags(qs)
         elif tag_ids:
-            WaferMapTag.objects.filter(wafer__in=qs, tag_id__in=tag_ids).delete()
+            return WaferMapTag.objects.remove_tags(qs, tag_ids)
+        return 0
 
     filter_params = [
         OpenApiParameter(
@@ -101,23 +91,25 @@ class WaferMapViewSet(BaseViewSet):
         In PUT: Add the tags
         In DELETE: Remove the tags
 
-        query-params: It will support the FileSetFilters.
+        query-params: It will support the WaferMapFilters.
+
+        The tags of all the matching wafers are added / removed with a single query, the response has their count.
 
         """
-        queryset = self.filter_queryset(self.get_queryset())
+        queryset = WaferMapFilterSet(request.query_params, queryset=self.get_queryset(), request=request).qs
         request_method = request.method
         # filter_params = request.query_params
         tag_ids = request.data.get("tag_ids", None)
         if request_method == "PUT":
             if not tag_ids:
                 return Response({"error": "tag_ids is required field"}, status=status.HTTP_400_BAD_REQUEST)
-            self.add_tags(qs=queryset, tag_ids=tag_ids)
-            return Response({"success": "tags added successfully."}, status=status.HTTP_200_OK)
+            count = self.add_tags(qs=queryset, tag_ids=tag_ids)
+            return Response({"success": "tags added successfully.", "count": count}, status=status.HTTP_200_OK)
         elif request_method == "DELETE":
             remove_all_tags = False
             if tag_ids is None and request.data.get("remove_all_tags", False) is True:
                 remove_all_tags = True
-            self.remove_tags(qs=queryset, tag_ids=tag_ids, remove_all=remove_all_tags)
-            return Response({"success": "tags removed successfully."}, status=status.HTTP_200_OK)
+            count = self.remove_tags(qs=queryset, tag_ids=tag_ids, remove_all=remove_all_tags)
+            return Response({"success": "tags removed successfully.", "count": count}, status=status.HTTP_200_OK)
         else:
             return Response({"error": "Method '%s' not allowed." % request_method}, status=status.HTTP_400_BAD_REQUEST)
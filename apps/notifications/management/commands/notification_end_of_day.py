@@ -39,11 +39,7 @@ class Command(BaseCommand):
         print("Subscription found")
         expected_automation = self.get_expected_automation(subscription.expected_automation)
         notification_service = NotificationService()
-        print("Calling execute_automation_less_than_expected of notification service")
-        notification_service.execute_automation_less_than_expected(
-            start_datetime=start_datetime, end_datetime=end_datetime, expected_automation=expected_automation
-        )
-        print("Calling execute_automation_less_than_expected_layer_level of notification service")
-        notification_service.execute_automation_less_than_expected_layer_level(
+        print("Calling execute_automation_scenarios of notification service")
+        notification_service.execute_automation_scenarios(
             start_datetime=start_datetime, end_datetime=end_datetime, expected_automation=expected_automation
         )
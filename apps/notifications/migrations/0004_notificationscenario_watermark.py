@@ -0,0 +1,23 @@
+# Generated by Django 3.2 on 2026-10-18 15:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notifications', '0003_notificationscenario_is_active'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notificationscenario',
+            name='processed_up_to',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='notificationscenario',
+            name='partial_aggregates',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
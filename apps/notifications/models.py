@@ -12,6 +12,9 @@ class NotificationScenario(Base):
     navigation_link = models.CharField(max_length=200, null=True, blank=True)
     priority = models.CharField(max_length=50, choices=NOTIFICATION_PRIORITY_CHOICES, default="Low")
     is_active = models.BooleanField(default=False)
+    # rows up to processed_up_to were already evaluated, partial_aggregates keeps what they added up to
+    processed_up_to = models.DateTimeField(null=True, blank=True)
+    partial_aggregates = models.JSONField(default=dict, blank=True)
 
     class Meta:
         db_table = "notifications_notification_scenario"
@@ -1,18 +1,30 @@
 import logging
 from datetime import timedelta
 
-from django.db.models import F, FloatField
+from django.db import connection, transaction
+from django.db.models import F, FloatField, Q
 from django.db.models.functions import Cast
+from django.utils import timezone
 from rest_framework.exceptions import ValidationError
 
 from apps.classif_ai.models import File, WaferMap
-from apps.classif_ai.service.metrics_service import AutoClassificationMetrics, DistributionMetrics
+from apps.classif_ai.service.metrics_service import CommonMetrics
 from apps.notifications.models import NotificationScenario, Notification
 
 logger = logging.getLogger(__name__)
 
+# scenarios evaluated on the automation rates of the files, they share their partial aggregates
+AUTOMATION_SCENARIO_NAMES = {
+    "low_automation_overall",
+    "low_automation_single_use_case",
+    "low_automation_multiple_use_cases",
+}
+
 
 class NotificationService:
+    def __init__(self):
+        self._active_scenarios = None
+
     @staticmethod
     def annotate_queryset(queryset):
         return queryset.annotate(
@@ -58,25 +70,41 @@ class NotificationService:
             "organization_wafer_id",
         )
 
-    def filter_files(self, start_datetime, end_datetime):
+    def filter_files(self, start_datetime, end_datetime, classified_after=None, classified_up_to=None):
         """
-        Filter files based on start_datetime, end_datetime and ml_model status = deployed_in_prod
+        Filter files based on start_datetime, end_datetime and ml_model status = deployed_in_prod, only the model
+        classifications created after classified_after and up to classified_up_to if given
         """
-        input_queryset = File.objects.filter(
-            created_ts__gte=start_datetime,
-            created_ts__lte=end_datetime,
-            model_classifications__ml_model__status="deployed_in_prod",
-        )
+        filters = {
+            "created_ts__gte": start_datetime,
+            "created_ts__lte": end_datetime,
+            "model_classifications__ml_model__status": "deployed_in_prod",
+        }
+        # in the same filter call, so that they apply to the same model classification
+        if classified_after is not None:
+            filters["model_classifications__created_ts__gt"] = classified_after
+        if classified_up_to is not None:
+            filters["model_classifications__created_ts__lte"] = classified_up_to
+        input_queryset = File.objects.filter(**filters)
         queryset = self.annotate_queryset(input_queryset)
         return queryset
 
+    def get_active_scenarios(self):
+        """
+        Returns {name: scenario} of the active notification scenarios, loaded once per service
+        """
+        if self._active_scenarios is None:
+            self._active_scenarios = {
+                scenario.name: scenario for scenario in NotificationScenario.objects.filter(is_active=True)
+            }
+        return self._active_scenarios
+
     def get_notification_scenario(self, scenario_name):
         """
         It will return the active notification scenario based on scenario_name
         """
-        try:
-            notification_scenario = NotificationScenario.objects.get(name=scenario_name, is_active=True)
-        except NotificationScenario.DoesNotExist:
+        notification_scenario = self.get_active_scenarios().get(scenario_name)
+        if notification_scenario is None:
             raise ValidationError(f"No active notification scenario exist for '{scenario_name}' scenario")
         return notification_scenario
 
@@ -87,75 +115,260 @@ class NotificationService:
         if not Notification.objects.filter(scenario=notification_scenario, parameters=params, is_read=False).exists():
             Notification.objects.create(scenario=notification_scenario, parameters=params)
 
+    def automation_counts(self, start_datetime, end_datetime, classified_after=None, classified_up_to=None):
+        """
+        Counts, with a single query over the files of the time window, the files and the auto-classified files (a
+        file with one confident defect is auto-classified) and, for every use case, the defects and the confident
+        defects. The same counts AutoClassificationMetrics.file_level and DistributionMetrics.file_distribution
+        compute their percentages from.
+
+        Returns {"total", "auto_classified", "use_cases": {use case id: {"use_case_name", "total", "auto_classified"}}}
+        """
+        sql, params = self.filter_files(
+            start_datetime, end_datetime, classified_after, classified_up_to
+        ).query.sql_with_params()
+        output_sql = """
+            with "rows" as ({}),
+            "files" as (
+                select
+                    file_id,
+                    count(model_defect_id) filter (
+                        where confidence_threshold <= confidence
+                    ) as auto_classified_defects_count
+                from "rows"
+                group by file_id
+            )
+            select
+                'overall' as level,
+                null as use_case_id,
+                null as use_case_name,
+                count(file_id) as total,
+                count(file_id) filter (where auto_classified_defects_count > 0) as auto_classified
+            from "files"
+            union all
+            select
+                'use_case',
+                use_case_id,
+                use_case_name,
+                count(file_id),
+                count(file_id) filter (where confidence_threshold <= confidence)
+            from "rows"
+            group by use_case_id, use_case_name
+        """.format(
+            sql
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(output_sql, params)
+            rows = CommonMetrics.dictfetchall(cursor)
+        counts = {"total": 0, "auto_classified": 0, "use_cases": {}}
+        for row in rows:
+            if row["level"] == "overall":
+                counts["total"] = row["total"]
+                counts["auto_classified"] = row["auto_classified"]
+            elif row["use_case_id"] is not None:
+                # json keys, the counts are stored in NotificationScenario.partial_aggregates
+                counts["use_cases"][str(row["use_case_id"])] = {
+                    "use_case_name": row["use_case_name"],
+                    "total": row["total"],
+                    "auto_classified": row["auto_classified"],
+                }
+        return counts
+
+    @staticmethod
+    def merge_automation_counts(counts, new_counts):
+        """
+        Adds the counts of newly classified files to the counts of the files evaluated before
+        """
+        merged = {
+            "total": counts["total"] + new_counts["total"],
+            "auto_classified": counts["auto_classified"] + new_counts["auto_classified"],
+            "use_cases": {use_case_id: dict(value) for use_case_id, value in counts["use_cases"].items()},
+        }
+        for use_case_id, value in new_counts["use_cases"].items():
+            use_case_counts = merged["use_cases"].setdefault(
+                use_case_id, {"use_case_name": value["use_case_name"], "total": 0, "auto_classified": 0}
+            )
+            use_case_counts["total"] += value["total"]
+            use_case_counts["auto_classified"] += value["auto_classified"]
+        return merged
+
+    @staticmethod
+    def automation_rates_from_counts(counts):
+        """
+        Returns (overall percentage, [{"use_case_id", "use_case_name", "auto_classified_percentage"}]), rounded the
+        way the metrics round them: the overall percentage down to an int, the use case ones to the nearest integer
+        (ties to even, as postgres rounds floats)
+        """
+        overall_percentage = None
+        if counts["total"]:
+            overall_percentage = 100 * counts["auto_classified"] // counts["total"]
+        use_case_rates = []
+        for use_case_id, value in sorted(counts["use_cases"].items(), key=lambda item: int(item[0])):
+            percentage = None
+            if value["total"]:
+                percentage = float(round(100 * value["auto_classified"] / value["total"]))
+            use_case_rates.append(
+                {
+                    "use_case_id": int(use_case_id),
+                    "use_case_name": value["use_case_name"],
+                    "auto_classified_percentage": percentage,
+                }
+            )
+        return overall_percentage, use_case_rates
+
+    def automation_rates(self, start_datetime, end_datetime):
+        """
+        Returns (overall percentage, [{"use_case_id", "use_case_name", "auto_classified_percentage"}]) of the files of
+        the time window
+        """
+        return self.automation_rates_from_counts(self.automation_counts(start_datetime, end_datetime))
+
+    def execute_automation_scenarios(self, start_datetime, end_datetime, expected_automation):
+        """
+        Evaluates the overall and the use case level automation scenarios and creates their notifications, the
+        scenarios which aren't active are skipped.
+
+        The counts of the window are kept on the scenarios along with the time they were computed up to. When the
+        next run is over the same window (e.g. the same day), only the files classified since then are counted and
+        added to them. Both passes only count the model classifications created up to the time taken before
+        querying, a classification committed while the query runs is left to the next run instead of being counted
+        by both.
+
+        The counts are only ever added to:
+        - a file classified by two deployed models in different runs is counted in both runs.
+        - a re-inference which updates the existing model classification of a file keeps its created_ts, it's never
+          picked up and the file keeps the counts of its first classification until the window is counted again
+          from scratch (a new window start, or the scenarios' partial_aggregates cleared).
+        """
+        scenarios = [
+            scenario
+            for name, scenario in self.get_active_scenarios().items()
+            if name in AUTOMATION_SCENARIO_NAMES
+        ]
+        if not scenarios:
+            return
+        # a window ending in the future is only processed up to now
+        processed_up_to = min(end_datetime, timezone.now())
+        window_start = start_datetime.isoformat()
+        counts = None
+        for scenario in scenarios:
+            if (
+                scenario.partial_aggregates.get("window_start") == window_start
+                and scenario.processed_up_to is not None
+                and start_datetime <= scenario.processed_up_to <= processed_up_to
+            ):
+                new_counts = self.automation_counts(
+                    start_datetime,
+                    end_datetime,
+                    classified_after=scenario.processed_up_to,
+                    classified_up_to=processed_up_to,
+                )
+                counts = self.merge_automation_counts(scenario.partial_aggregates["counts"], new_counts)
+                break
+        if counts is None:
+            counts = self.automation_counts(start_datetime, end_datetime, classified_up_to=processed_up_to)
+        NotificationScenario.objects.filter(id__in=[scenario.id for scenario in scenarios]).update(
+            processed_up_to=processed_up_to, partial_aggregates={"window_start": window_start, "counts": counts}
+        )
+        overall_percentage, use_case_rates = self.automation_rates_from_counts(counts)
+        self.notify_low_automation_overall(overall_percentage, expected_automation)
+        self.notify_low_automation_use_cases(use_case_rates, expected_automation)
+
     def execute_automation_less_than_expected(self, start_datetime, end_datetime, expected_automation):
         """
         It will check the overall automation is less than expected and create the notification.
         """
-        queryset = self.filter_files(start_datetime, end_datetime)
-        auto_classification_response = AutoClassificationMetrics.file_level(queryset)
-        auto_classified_percentage = auto_classification_response.get("percentage")
-        if auto_classified_percentage and auto_classified_percentage < expected_automation:
-            below_expected = int(expected_automation - auto_classified_percentage)
-            notification_scenario = self.get_notification_scenario(scenario_name="low_automation_overall")
-            params = {"auto_classified_percentage": auto_classified_percentage, "below_expected": below_expected}
-            self.create_notification(notification_scenario=notification_scenario, params=params)
+        overall_percentage, _ = self.automation_rates(start_datetime, end_datetime)
+        self.notify_low_automation_overall(overall_percentage, expected_automation, raise_if_inactive=True)
 
     def execute_automation_less_than_expected_layer_level(self, start_datetime, end_datetime, expected_automation):
         """
         It will check the automation is less than expected on one usecase or multiple usecase and
         create the notification
         """
-        queryset = self.filter_files(start_datetime, end_datetime)
-        auto_classification_distributions = DistributionMetrics.file_distribution(
-            queryset, group_by=["use_case_id", "use_case_name"]
-        )
-        use_case_names = []
-        use_case_ids = []
-        for distribution in auto_classification_distributions:
-            use_case_id = distribution.get("use_case_id")
-            use_case_name = distribution.get("use_case_name")
-            auto_classified_percentage = distribution.get("auto_classified_percentage")
-            if auto_classified_percentage and auto_classified_percentage < expected_automation:
-                use_case_ids.append(use_case_id)
-                use_case_names.append(use_case_name)
-        if len(use_case_ids) > 1:
-            use_case_count = len(use_case_ids)
-            use_case_names = ", ".join(use_case_names)
-            notification_scenario = self.get_notification_scenario(scenario_name="low_automation_multiple_use_cases")
-            params = {"use_case_count": use_case_count, "use_cases": use_case_names, "use_case_ids": use_case_ids}
-            self.create_notification(notification_scenario=notification_scenario, params=params)
-        elif len(use_case_ids) == 1:
+        _, use_case_rates = self.automation_rates(start_datetime, end_datetime)
+        self.notify_low_automation_use_cases(use_case_rates, expected_automation, raise_if_inactive=True)
+
+    def _scenario(self, scenario_name, raise_if_inactive):
+        if raise_if_inactive:
+            return self.get_notification_scenario(scenario_name)
+        return self.get_active_scenarios().get(scenario_name)
+
+    def notify_low_automation_overall(self, auto_classified_percentage, expected_automation, raise_if_inactive=False):
+        if auto_classified_percentage and auto_classified_percentage < expected_automation:
+            notification_scenario = self._scenario("low_automation_overall", raise_if_inactive)
+            if notification_scenario is None:
+                return
             below_expected = int(expected_automation - auto_classified_percentage)
-            notification_scenario = self.get_notification_scenario(scenario_name="low_automation_single_use_case")
+            params = {"auto_classified_percentage": auto_classified_percentage, "below_expected": below_expected}
+            self.create_notification(notification_scenario=notification_scenario, params=params)
+
+    def notify_low_automation_use_cases(self, use_case_rates, expected_automation, raise_if_inactive=False):
+        low_automation_rates = [
+            rate
+            for rate in use_case_rates
+            if rate["auto_classified_percentage"] and rate["auto_classified_percentage"] < expected_automation
+        ]
+        if len(low_automation_rates) > 1:
+            notification_scenario = self._scenario("low_automation_multiple_use_cases", raise_if_inactive)
+            if notification_scenario is None:
+                return
             params = {
-                "use_case_name": use_case_name,
-                "auto_classified_percentage": auto_classified_percentage,
-                "use_case_ids": [use_case_id],
-                "below_expected": below_expected,
+                "use_case_count": len(low_automation_rates),
+                "use_cases": ", ".join(rate["use_case_name"] for rate in low_automation_rates),
+                "use_case_ids": [rate["use_case_id"] for rate in low_automation_rates],
+            }
+            self.create_notification(notification_scenario=notification_scenario, params=params)
+        elif len(low_automation_rates) == 1:
+            notification_scenario = self._scenario("low_automation_single_use_case", raise_if_inactive)
+            if notification_scenario is None:
+                return
+            rate = low_automation_rates[0]
+            params = {
+                "use_case_name": rate["use_case_name"],
+                "auto_classified_percentage": rate["auto_classified_percentage"],
+                "use_case_ids": [rate["use_case_id"]],
+                "below_expected": int(expected_automation - rate["auto_classified_percentage"]),
             }
             self.create_notification(notification_scenario=notification_scenario, params=params)
 
     def execute_wafer_on_hold(self, current_datetime, more_than_hours=2):
         """
         It will find the wafers which are on hold more than X(default is 2 hours) hours and create the notification
-        for the same
+        for the same.
+
+        The scenario keeps the time of its last run. A wafer put on hold before then was already evaluated, unless
+        it has been updated since, so only the wafers created or updated after the previous run are looked at
+        again, along with the ones having an unread notification.
         """
         time_threshold = current_datetime - timedelta(hours=more_than_hours)
         notification_scenario = self.get_notification_scenario(scenario_name="wafer_on_hold_more_than_2_hours")
-        filtered_wafers = WaferMap.objects.filter(
-            status="manual_classification_pending", created_ts__lt=time_threshold
-        )
-        filtered_wafers_ids = list(filtered_wafers.values_list("id", flat=True))
+        on_hold_wafers = WaferMap.objects.filter(status="manual_classification_pending", created_ts__lt=time_threshold)
         filtered_notifications = Notification.objects.filter(scenario=notification_scenario, is_read=False).annotate(
             wafer_id=F("parameters__wafer_id")
         )
-        unread_wafers_ids = list(filtered_notifications.values_list("wafer_id", flat=True))
-        new_wafers_ids = list(set(filtered_wafers_ids) - set(unread_wafers_ids))
-        mark_as_read_wafers_ids = list(set(unread_wafers_ids) - set(filtered_wafers_ids))
-        notifications = []
-        for wafer_id in new_wafers_ids:
-            organization_wafer_id = filtered_wafers.get(id=wafer_id).organization_wafer_id
-            params = {"wafer_id": wafer_id, "organization_wafer_id": organization_wafer_id}
-            notifications.append(Notification(scenario=notification_scenario, parameters=params))
-        Notification.objects.bulk_create(notifications)
-        filtered_notifications.filter(parameters__wafer_id__in=mark_as_read_wafers_ids).update(is_read=True)
+        unread_wafers_ids = set(filtered_notifications.values_list("wafer_id", flat=True))
+        previous_run = notification_scenario.processed_up_to
+        new_on_hold_wafers = on_hold_wafers
+        if previous_run is not None:
+            new_on_hold_wafers = on_hold_wafers.filter(
+                Q(created_ts__gte=previous_run - timedelta(hours=more_than_hours)) | Q(updated_ts__gte=previous_run)
+            )
+        organization_wafer_ids = dict(
+            new_on_hold_wafers.exclude(id__in=unread_wafers_ids).values_list("id", "organization_wafer_id")
+        )
+        still_on_hold_wafers_ids = set(on_hold_wafers.filter(id__in=unread_wafers_ids).values_list("id", flat=True))
+        mark_as_read_wafers_ids = list(unread_wafers_ids - still_on_hold_wafers_ids)
+        with transaction.atomic():
+            Notification.objects.bulk_create(
+                [
+                    Notification(
+                        scenario=notification_scenario,
+                        parameters={"wafer_id": wafer_id, "organization_wafer_id": organization_wafer_id},
+                    )
+                    for wafer_id, organization_wafer_id in organization_wafer_ids.items()
+                ]
+            )
+            if mark_as_read_wafers_ids:
+                filtered_notifications.filter(parameters__wafer_id__in=mark_as_read_wafers_ids).update(is_read=True)
+            NotificationScenario.objects.filter(id=notification_scenario.id).update(processed_up_to=current_datetime)
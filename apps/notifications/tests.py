@@ -0,0 +1,297 @@
+from datetime import timedelta
+from unittest import mock
+
+from django.db.models import F
+from django.test import SimpleTestCase
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+
+from apps.classif_ai.models import (
+    Defect,
+    File,
+    FileSet,
+    MlModel,
+    ModelClassification,
+    ModelClassificationDefect,
+    UploadSession,
+    WaferMap,
+)
+from apps.classif_ai.service.metrics_service import AutoClassificationMetrics, DistributionMetrics
+from apps.classif_ai.tests.classif_ai_test_case import ClassifAiTestCase
+from apps.notifications.models import Notification, NotificationScenario
+from apps.notifications.services import NotificationService
+
+
+class AutomationCountsTest(SimpleTestCase):
+    def test_merge_automation_counts(self):
+        counts = {
+            "total": 4,
+            "auto_classified": 3,
+            "use_cases": {"1": {"use_case_name": "use-case-1", "total": 4, "auto_classified": 3}},
+        }
+        new_counts = {
+            "total": 3,
+            "auto_classified": 1,
+            "use_cases": {
+                "1": {"use_case_name": "use-case-1", "total": 1, "auto_classified": 1},
+                "2": {"use_case_name": "use-case-2", "total": 2, "auto_classified": 0},
+            },
+        }
+        merged = NotificationService.merge_automation_counts(counts, new_counts)
+        self.assertEqual(
+            merged,
+            {
+                "total": 7,
+                "auto_classified": 4,
+                "use_cases": {
+                    "1": {"use_case_name": "use-case-1", "total": 5, "auto_classified": 4},
+                    "2": {"use_case_name": "use-case-2", "total": 2, "auto_classified": 0},
+                },
+            },
+        )
+        # the stored counts are left untouched
+        self.assertEqual(counts["total"], 4)
+        self.assertEqual(counts["use_cases"]["1"]["total"], 4)
+
+    def test_automation_rates_from_counts(self):
+        counts = {
+            "total": 3,
+            "auto_classified": 2,
+            "use_cases": {
+                "10": {"use_case_name": "use-case-10", "total": 8, "auto_classified": 5},
+                "2": {"use_case_name": "use-case-2", "total": 8, "auto_classified": 1},
+                "3": {"use_case_name": "use-case-3", "total": 0, "auto_classified": 0},
+            },
+        }
+        overall_percentage, use_case_rates = NotificationService.automation_rates_from_counts(counts)
+        # 66.67 rounded down, 62.5 and 12.5 rounded to even
+        self.assertEqual(overall_percentage, 66)
+        self.assertEqual(
+            use_case_rates,
+            [
+                {"use_case_id": 2, "use_case_name": "use-case-2", "auto_classified_percentage": 12.0},
+                {"use_case_id": 3, "use_case_name": "use-case-3", "auto_classified_percentage": None},
+                {"use_case_id": 10, "use_case_name": "use-case-10", "auto_classified_percentage": 62.0},
+            ],
+        )
+
+    def test_automation_rates_without_files(self):
+        overall_percentage, use_case_rates = NotificationService.automation_rates_from_counts(
+            {"total": 0, "auto_classified": 0, "use_cases": {}}
+        )
+        self.assertIsNone(overall_percentage)
+        self.assertEqual(use_case_rates, [])
+
+
+class NotificationServiceTestCase(ClassifAiTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.ml_model = MlModel.objects.create(
+            name="test-model",
+            code="test-code",
+            version=1,
+            status="deployed_in_prod",
+            is_stable=True,
+            subscription=cls.subscription,
+            use_case=cls.use_case,
+            confidence_threshold=0.5,
+        )
+        cls.defect = Defect.objects.create(name="test-defect", code="test-defect", subscription=cls.subscription)
+        cls.upload_session = UploadSession.objects.create(
+            name="test-upload", subscription=cls.subscription, use_case=cls.use_case
+        )
+        cls.scenarios = {
+            name: NotificationScenario.objects.create(name=name, notification_type="WEB", is_active=True)
+            for name in [
+                "low_automation_overall",
+                "low_automation_single_use_case",
+                "low_automation_multiple_use_cases",
+                "wafer_on_hold_more_than_2_hours",
+            ]
+        }
+
+    def create_classified_file(self, confidences, ml_model=None, upload_session=None):
+        """creates a file classified by the ml model with a defect of each confidence"""
+        upload_session = upload_session or self.upload_session
+        file_set = FileSet.objects.create(upload_session=upload_session, subscription=self.subscription)
+        file = File.objects.create(file_set=file_set, name="test-file", path="test/test-file")
+        classification = ModelClassification.objects.create(file=file, ml_model=ml_model or self.ml_model)
+        for confidence in confidences:
+            ModelClassificationDefect.objects.create(
+                classification=classification, defect=self.defect, confidence=confidence
+            )
+        return classification
+
+
+class AutomationScenariosTest(NotificationServiceTestCase):
+    def setUp(self):
+        super().setUp()
+        now = timezone.now()
+        self.start_datetime, self.end_datetime = now - timedelta(days=1), now + timedelta(days=1)
+        single_label_ml_model = MlModel.objects.create(
+            name="single-label-model",
+            code="single-label-code",
+            version=1,
+            status="deployed_in_prod",
+            is_stable=True,
+            subscription=self.subscription,
+            use_case=self.single_label_use_case,
+            confidence_threshold=0.5,
+        )
+        single_label_upload_session = UploadSession.objects.create(
+            name="single-label-upload", subscription=self.subscription, use_case=self.single_label_use_case
+        )
+        # use case: 2 of the 4 files, 2 of the 6 defects are confident
+        for confidences in [[0.9], [0.2, 0.7], [0.3], [0.1, 0.2]]:
+            self.create_classified_file(confidences)
+        # single label use case: 2 of the 3 files are confident
+        for confidences in [[0.8], [0.4], [0.6]]:
+            self.create_classified_file(confidences, single_label_ml_model, single_label_upload_session)
+
+    def notification_parameters(self, scenario_name):
+        return list(
+            Notification.objects.filter(scenario=self.scenarios[scenario_name]).values_list("parameters", flat=True)
+        )
+
+    def test_automation_rates_match_the_metrics(self):
+        service = NotificationService()
+        overall_percentage, use_case_rates = service.automation_rates(self.start_datetime, self.end_datetime)
+
+        queryset = service.filter_files(self.start_datetime, self.end_datetime)
+        self.assertEqual(overall_percentage, 57)
+        self.assertEqual(overall_percentage, AutoClassificationMetrics.file_level(queryset)["percentage"])
+        # file_distribution also counts the audited files
+        distributions = DistributionMetrics.file_distribution(
+            queryset.annotate(gt_classification=F("gt_classifications")), group_by=["use_case_id", "use_case_name"]
+        )
+        self.assertEqual(
+            use_case_rates,
+            [
+                {
+                    "use_case_id": distribution["use_case_id"],
+                    "use_case_name": distribution["use_case_name"],
+                    "auto_classified_percentage": distribution["auto_classified_percentage"],
+                }
+                for distribution in sorted(distributions, key=lambda distribution: distribution["use_case_id"])
+            ],
+        )
+        self.assertEqual(
+            {rate["use_case_id"]: rate["auto_classified_percentage"] for rate in use_case_rates},
+            {self.use_case.id: 33.0, self.single_label_use_case.id: 67.0},
+        )
+
+    def test_overall_and_multiple_use_cases_notifications(self):
+        NotificationService().execute_automation_scenarios(
+            self.start_datetime, self.end_datetime, expected_automation=70
+        )
+        self.assertEqual(
+            self.notification_parameters("low_automation_overall"),
+            [{"auto_classified_percentage": 57, "below_expected": 13}],
+        )
+        self.assertEqual(
+            self.notification_parameters("low_automation_multiple_use_cases"),
+            [
+                {
+                    "use_case_count": 2,
+                    "use_cases": f"{self.use_case.name}, {self.single_label_use_case.name}",
+                    "use_case_ids": [self.use_case.id, self.single_label_use_case.id],
+                }
+            ],
+        )
+        self.assertEqual(self.notification_parameters("low_automation_single_use_case"), [])
+
+    def test_single_use_case_notification(self):
+        NotificationService().execute_automation_scenarios(
+            self.start_datetime, self.end_datetime, expected_automation=50
+        )
+        self.assertEqual(
+            self.notification_parameters("low_automation_single_use_case"),
+            [
+                {
+                    "use_case_name": self.use_case.name,
+                    "auto_classified_percentage": 33.0,
+                    "use_case_ids": [self.use_case.id],
+                    "below_expected": 17,
+                }
+            ],
+        )
+        self.assertEqual(self.notification_parameters("low_automation_overall"), [])
+        self.assertEqual(self.notification_parameters("low_automation_multiple_use_cases"), [])
+
+    def test_inactive_scenarios_are_skipped(self):
+        NotificationScenario.objects.filter(
+            name__in=["low_automation_overall", "low_automation_multiple_use_cases"]
+        ).update(is_active=False)
+        NotificationService().execute_automation_scenarios(
+            self.start_datetime, self.end_datetime, expected_automation=70
+        )
+        # the single use case scenario is active, but two use cases are below the expected automation
+        self.assertFalse(Notification.objects.exists())
+        with self.assertRaises(ValidationError):
+            NotificationService().execute_automation_less_than_expected(
+                self.start_datetime, self.end_datetime, expected_automation=70
+            )
+
+    def test_nothing_is_counted_without_active_scenarios(self):
+        NotificationScenario.objects.update(is_active=False)
+        NotificationService().execute_automation_scenarios(
+            self.start_datetime, self.end_datetime, expected_automation=70
+        )
+        self.assertFalse(Notification.objects.exists())
+        self.assertFalse(NotificationScenario.objects.filter(processed_up_to__isnull=False).exists())
+
+
+class WatermarkTest(NotificationServiceTestCase):
+    def stored_counts(self):
+        return NotificationScenario.objects.get(name="low_automation_overall").partial_aggregates["counts"]
+
+    def test_rerun_of_the_same_window(self):
+        now = timezone.now()
+        start_datetime, end_datetime = now - timedelta(days=1), now + timedelta(days=1)
+        self.create_classified_file([0.9])
+        late_classification = self.create_classified_file([0.2])
+        # committed after the snapshot of the first run was taken, while it was querying
+        ModelClassification.objects.filter(id=late_classification.id).update(created_ts=now + timedelta(hours=1))
+
+        NotificationService().execute_automation_scenarios(start_datetime, end_datetime, expected_automation=90)
+        self.assertEqual(self.stored_counts()["total"], 1)
+        self.assertEqual(self.stored_counts()["auto_classified"], 1)
+
+        with mock.patch("apps.notifications.services.timezone.now", return_value=now + timedelta(hours=2)):
+            NotificationService().execute_automation_scenarios(start_datetime, end_datetime, expected_automation=90)
+            self.assertEqual(self.stored_counts()["total"], 2)
+            # nothing was classified since the previous run, the counts stay the same
+            NotificationService().execute_automation_scenarios(start_datetime, end_datetime, expected_automation=90)
+        counts = self.stored_counts()
+        self.assertEqual(counts["total"], 2)
+        self.assertEqual(counts["auto_classified"], 1)
+        self.assertEqual(counts["use_cases"][str(self.use_case.id)]["total"], 2)
+        self.assertEqual(Notification.objects.filter(scenario=self.scenarios["low_automation_overall"]).count(), 1)
+
+    def test_wafer_on_hold_is_notified_once_even_after_read(self):
+        now = timezone.now()
+        wafer = WaferMap.objects.create(organization_wafer_id="wafer-1", status="manual_classification_pending")
+        WaferMap.objects.filter(id=wafer.id).update(
+            created_ts=now - timedelta(hours=3), updated_ts=now - timedelta(hours=3)
+        )
+        scenario = self.scenarios["wafer_on_hold_more_than_2_hours"]
+
+        NotificationService().execute_wafer_on_hold(now)
+        notifications = Notification.objects.filter(scenario=scenario)
+        self.assertEqual(
+            list(notifications.values_list("parameters", flat=True)),
+            [{"wafer_id": wafer.id, "organization_wafer_id": "wafer-1"}],
+        )
+
+        notifications.update(is_read=True)
+        # put on hold after the first run, not long enough to be notified by it
+        new_wafer = WaferMap.objects.create(organization_wafer_id="wafer-2", status="manual_classification_pending")
+        WaferMap.objects.filter(id=new_wafer.id).update(
+            created_ts=now - timedelta(hours=1, minutes=30), updated_ts=now - timedelta(hours=1, minutes=30)
+        )
+        NotificationService().execute_wafer_on_hold(now + timedelta(hours=1))
+        NotificationService().execute_wafer_on_hold(now + timedelta(hours=2))
+
+        self.assertEqual(notifications.filter(parameters__wafer_id=wafer.id).count(), 1)
+        self.assertEqual(notifications.filter(parameters__wafer_id=new_wafer.id, is_read=False).count(), 1)
@@ -0,0 +1,92 @@
+from typing import Dict, Iterable, Set, Tuple
+
+from django.conf import settings
+from django.core.cache import DEFAULT_CACHE_ALIAS, cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import connection, transaction
+from rest_framework import serializers
+
+### how are the file set meta info validators cached?
+# The serializer class validating the meta info of a subscription's file sets is built once per process and kept in
+# _validators along with the version (updated_ts) of the subscription it was built from. The current version of every
+# subscription is kept in the django cache, so a validation costs a cache lookup and a dict lookup. Saving a
+# subscription publishes its new version once the transaction is committed, processes holding an older validator
+# rebuild it on their next validation. A validation only adds the version it read when the cache has none, it never
+# overwrites one published by a save it raced with. The versions expire after FILE_SET_META_INFO_VERSION_CACHE_TTL,
+# so a version lost in between is read again from the database.
+# Publishing only reaches the other processes through a shared cache (CACHE_URL). With a process-local one, e.g. the
+# default locmem cache, every validation reads the version (updated_ts) of the subscription from the database instead.
+# The keys include the schema name, subscription ids of different tenants overlap.
+
+CacheKey = Tuple[str, int]
+
+_validators: Dict[CacheKey, Tuple[str, "FileSetMetaInfoValidator"]] = {}
+
+
+class FileSetMetaInfoValidator:
+    """[validates file set meta info against the file_set_meta_info config of a subscription]"""
+
+    def __init__(self, config: Iterable[Dict]):
+        sub_fields = {}
+        for field in config:
+            serializer_field = getattr(serializers, field["field_type"])
+            sub_fields[field["field"]] = serializer_field(**field["field_props"])
+        self.serializer_class = type("FileSetMetaInfoSerializer", (serializers.Serializer,), sub_fields)
+        self.field_names = frozenset(sub_fields)
+
+    def unknown_fields(self, meta_info: Dict) -> Set[str]:
+        return set(meta_info) - self.field_names
+
+    def serializer(self, meta_info: Dict) -> serializers.Serializer:
+        return self.serializer_class(data=dict(meta_info))
+
+
+def _cache_key(subscription_id) -> CacheKey:
+    return connection.schema_name, int(subscription_id)
+
+
+def _version_cache_key(key: CacheKey) -> str:
+    return "file_set_meta_info_version:{}:{}".format(*key)
+
+
+def _shared_cache() -> bool:
+    """[whether the versions published to the django cache are seen by the other processes]"""
+    return not isinstance(caches[DEFAULT_CACHE_ALIAS], (LocMemCache, DummyCache))
+
+
+def get_file_set_meta_info_validator(subscription_id) -> FileSetMetaInfoValidator:
+    """[returns the meta info validator of the subscription, built from the database only if the subscription changed
+    since the last call]"""
+    from apps.subscriptions.models import Subscription
+
+    key = _cache_key(subscription_id)
+    if _shared_cache():
+        version = cache.get(_version_cache_key(key))
+    else:
+        updated_ts = Subscription.objects.filter(id=subscription_id).values_list("updated_ts", flat=True).first()
+        version = updated_ts.isoformat() if updated_ts is not None else None
+    cached = _validators.get(key)
+    if version is not None and cached is not None and cached[0] == version:
+        return cached[1]
+    config, updated_ts = Subscription.objects.values_list("file_set_meta_info", "updated_ts").get(id=subscription_id)
+    version = updated_ts.isoformat()
+    cache.add(_version_cache_key(key), version, settings.FILE_SET_META_INFO_VERSION_CACHE_TTL)
+    validator = FileSetMetaInfoValidator(config)
+    _validators[key] = (version, validator)
+    return validator
+
+
+def _publish_version(key: CacheKey, version: str = None) -> None:
+    if version is None:
+        cache.delete(_version_cache_key(key))
+    else:
+        cache.set(_version_cache_key(key), version, settings.FILE_SET_META_INFO_VERSION_CACHE_TTL)
+
+
+def invalidate_file_set_meta_info_validator(subscription_id, version: str = None) -> None:
+    """[drops the cached validator of the subscription, in this process right away and in the others on their next
+    validation after the transaction is committed]"""
+    key = _cache_key(subscription_id)
+    _validators.pop(key, None)
+    transaction.on_commit(lambda: _publish_version(key, version))
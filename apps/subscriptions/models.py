@@ -4,7 +4,10 @@ from django.db.models import JSONField
 from django.contrib.postgres.fields.array import ArrayField
 from django.core.exceptions import ValidationError
 from django.db import models
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from common.models import Base
+from apps.subscriptions.meta_info_validator import invalidate_file_set_meta_info_validator
 from apps.packs.models import Pack
 from apps.users.models import SubOrganization
 import jsonschema
@@ -42,3 +45,13 @@ class Subscription(Base):
     def save(self, *args, **kwargs):
         self.full_clean()
         return super().save(*args, **kwargs)
+
+
+@receiver(post_save, sender=Subscription)
+def invalidate_meta_info_validator_on_save(sender, instance, **kwargs):
+    invalidate_file_set_meta_info_validator(instance.id, instance.updated_ts.isoformat())
+
+
+@receiver(post_delete, sender=Subscription)
+def invalidate_meta_info_validator_on_delete(sender, instance, **kwargs):
+    invalidate_file_set_meta_info_validator(instance.id)
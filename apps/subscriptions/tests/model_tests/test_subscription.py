@@ -1,8 +1,17 @@
 from datetime import datetime, timedelta
+from unittest import mock
 
+from django.core.cache import cache
+from django.test import override_settings
 from pytz import UTC
 from sixsense.tenant_test_case import SixsenseTenantTestCase
 from common.error_test_mixins.validation_error_test_mixin import ValidationErrorTestMixin
+from apps.subscriptions.meta_info_validator import (
+    _cache_key,
+    _validators,
+    _version_cache_key,
+    get_file_set_meta_info_validator,
+)
 from apps.subscriptions.models import Subscription
 from apps.users.models import SubOrganization
 from apps.packs.models import Pack
@@ -87,3 +96,89 @@ class SubscriptionTest(SixsenseTenantTestCase, ValidationErrorTestMixin):
         )
         with self.assertValidationErrors(["starts_at", "expires_at"]):
             subscription.full_clean()
+
+    def test_meta_info_validator_is_cached_until_save(self):
+        subscription = Subscription.objects.create(
+            pack=self.pack,
+            sub_organization=self.sub_org,
+            starts_at=self.starts_at,
+            expires_at=self.expires_at,
+            file_set_meta_info=self.fsmi,
+        )
+        validator = get_file_set_meta_info_validator(subscription.id)
+        with self.assertNumQueries(0), mock.patch(
+            "apps.subscriptions.meta_info_validator._shared_cache", return_value=True
+        ):
+            self.assertIs(get_file_set_meta_info_validator(subscription.id), validator)
+        self.assertEqual(validator.unknown_fields({"package": "a", "lot_id": "b"}), {"lot_id"})
+        self.assertTrue(validator.serializer({"package": "a"}).is_valid())
+
+        subscription.file_set_meta_info = self.fsmi + [
+            {"field": "lot_id", "name": "Lot", "field_type": "CharField", "field_props": {"required": True}}
+        ]
+        subscription.save()
+        validator = get_file_set_meta_info_validator(subscription.id)
+        self.assertEqual(validator.unknown_fields({"package": "a", "lot_id": "b"}), set())
+        self.assertFalse(validator.serializer({"package": "a"}).is_valid())
+
+    @override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+    def test_meta_info_validator_of_a_process_local_cache_follows_the_database(self):
+        subscription = Subscription.objects.create(
+            pack=self.pack,
+            sub_organization=self.sub_org,
+            starts_at=self.starts_at,
+            expires_at=self.expires_at,
+            file_set_meta_info=self.fsmi,
+        )
+        validator = get_file_set_meta_info_validator(subscription.id)
+        # the version is read from the database, the config isn't
+        with self.assertNumQueries(1):
+            self.assertIs(get_file_set_meta_info_validator(subscription.id), validator)
+
+        # saved by another process, which published the new version to its own locmem cache only
+        Subscription.objects.filter(id=subscription.id).update(
+            file_set_meta_info=self.fsmi
+            + [{"field": "lot_id", "name": "Lot", "field_type": "CharField", "field_props": {"required": True}}],
+            updated_ts=datetime.now(UTC),
+        )
+        self.assertEqual(
+            cache.get(_version_cache_key(_cache_key(subscription.id))), subscription.updated_ts.isoformat()
+        )
+        validator = get_file_set_meta_info_validator(subscription.id)
+        self.assertEqual(validator.unknown_fields({"package": "a", "lot_id": "b"}), set())
+
+    def test_meta_info_validator_version_is_published_on_commit(self):
+        subscription = Subscription.objects.create(
+            pack=self.pack,
+            sub_organization=self.sub_org,
+            starts_at=self.starts_at,
+            expires_at=self.expires_at,
+            file_set_meta_info=self.fsmi,
+        )
+        version_cache_key = _version_cache_key(_cache_key(subscription.id))
+        get_file_set_meta_info_validator(subscription.id)
+        version = cache.get(version_cache_key)
+        self.assertEqual(version, subscription.updated_ts.isoformat())
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            subscription.save()
+        # the other processes keep using the committed version until the transaction is committed
+        self.assertEqual(cache.get(version_cache_key), version)
+        for callback in callbacks:
+            callback()
+        self.assertEqual(cache.get(version_cache_key), subscription.updated_ts.isoformat())
+
+    def test_meta_info_validator_read_does_not_overwrite_a_published_version(self):
+        subscription = Subscription.objects.create(
+            pack=self.pack,
+            sub_organization=self.sub_org,
+            starts_at=self.starts_at,
+            expires_at=self.expires_at,
+            file_set_meta_info=self.fsmi,
+        )
+        version_cache_key = _version_cache_key(_cache_key(subscription.id))
+        # published by a save this process hasn't read yet
+        cache.set(version_cache_key, "newer-version")
+        _validators.pop(_cache_key(subscription.id), None)
+        get_file_set_meta_info_validator(subscription.id)
+        self.assertEqual(cache.get(version_cache_key), "newer-version")
@@ -1,5 +1,7 @@
+import hashlib
 import os
 
+from django.core.cache import cache
 from django.core.exceptions import SuspiciousOperation
 from django.db import connection
 from django.utils._os import safe_join
@@ -37,3 +39,36 @@ class TenantOnPremFileSystemStorage(TenantFileSystemStorage):
         except ValueError:
             raise SuspiciousOperation("Attempted access to '%s' denied." % name)
         return os.path.normpath(path)
+
+
+def _pre_signed_url_cache_key(path):
+    # Paths can be longer than what some cache backends accept as a key. The url of a path depends on the tenant with
+    # the tenant storages, hence the schema name.
+    return "pre_signed_url:{}:{}".format(connection.schema_name, hashlib.sha1(path.encode("utf-8")).hexdigest())
+
+
+def get_pre_signed_urls(paths):
+    """
+    Returns {path: pre signed url} for the given storage paths. URLs signed in the last PRE_SIGNED_URL_CACHE_TTL
+    seconds are served from the cache, only the remaining ones are signed (and cached).
+    """
+    paths = {path for path in paths if path}
+    if not paths:
+        return {}
+    keys = {_pre_signed_url_cache_key(path): path for path in paths}
+    cached_urls = cache.get_many(keys.keys())
+    urls = {keys[key]: url for key, url in cached_urls.items()}
+    new_urls = {}
+    for key, path in keys.items():
+        if key not in cached_urls:
+            urls[path] = settings.DEFAULT_FILE_STORAGE_OBJECT.url(path)
+            new_urls[key] = urls[path]
+    if new_urls:
+        cache.set_many(new_urls, timeout=settings.PRE_SIGNED_URL_CACHE_TTL)
+    return urls
+
+
+def get_pre_signed_url(path):
+    if not path:
+        return None
+    return get_pre_signed_urls([path])[path]
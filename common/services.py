@@ -1,20 +1,92 @@
 import logging
+import os
+import threading
+
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
 from sixsense import settings
 
 
+class Boto3ClientRegistry(object):
+    """
+    Process wide registry of boto3 clients. boto3 clients are thread safe and keep their http connections alive, so a
+    single client per (service, region, credentials) is shared by the whole process instead of building a new one
+    (and opening new TLS connections) on every call. Sessions are not thread safe, hence the clients are created under
+    a lock. Connections can't be shared with a forked child (eg. celery prefork workers), so the registry is emptied
+    in the child after a fork.
+    """
+
+    _lock = threading.Lock()
+    _clients = {}
+    _pid = os.getpid()
+
+    @classmethod
+    def get_client(
+        cls, service_name, region_name=None, aws_access_key_id=None, aws_secret_access_key=None, endpoint_url=None
+    ):
+        if cls._pid != os.getpid():
+            cls.reset()
+        key = (service_name, region_name, aws_access_key_id, aws_secret_access_key, endpoint_url)
+        client = cls._clients.get(key, None)
+        if client is not None:
+            return client
+        with cls._lock:
+            client = cls._clients.get(key, None)
+            if client is None:
+                session = boto3.session.Session(
+                    aws_access_key_id=aws_access_key_id, aws_secret_access_key=aws_secret_access_key
+                )
+                client = session.client(
+                    service_name,
+                    region_name=region_name,
+                    endpoint_url=endpoint_url,
+                    config=Config(
+                        max_pool_connections=settings.AWS_MAX_POOL_CONNECTIONS,
+                        tcp_keepalive=True,
+                        retries={"max_attempts": settings.AWS_MAX_RETRY_ATTEMPTS, "mode": "standard"},
+                    ),
+                )
+                cls._clients[key] = client
+        return client
+
+    @classmethod
+    def reset(cls):
+        cls._lock = threading.Lock()
+        cls._clients = {}
+        cls._pid = os.getpid()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=Boto3ClientRegistry.reset)
+
+
+def get_boto3_client(
+    service_name, region_name=None, aws_access_key_id=None, aws_secret_access_key=None, endpoint_url=None
+):
+    return Boto3ClientRegistry.get_client(
+        service_name,
+        region_name=region_name,
+        aws_access_key_id=aws_access_key_id,
+        aws_secret_access_key=aws_secret_access_key,
+        endpoint_url=endpoint_url,
+    )
+
+
 class S3Service(object):
     def __init__(
         self, aws_access_key_id=settings.AWS_ACCESS_KEY_ID, aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY
     ) -> None:
         if aws_access_key_id:
-            self.s3_client = boto3.client(
-                "s3", aws_access_key_id=aws_access_key_id, aws_secret_access_key=aws_secret_access_key
+            self.s3_client = get_boto3_client(
+                "s3",
+                aws_access_key_id=aws_access_key_id,
+                aws_secret_access_key=aws_secret_access_key,
+                endpoint_url=settings.AWS_S3_ENDPOINT_URL,
             )
         else:
-            self.s3_client = boto3.client("s3")
+            self.s3_client = get_boto3_client("s3", endpoint_url=settings.AWS_S3_ENDPOINT_URL)
 
     def generate_pre_signed_post(self, key):
         try:
@@ -62,9 +134,9 @@ class S3Service(object):
 
 
 class SqsService(object):
-    def __init__(self, queue_url) -> None:
-        sqs_resource = boto3.resource("sqs", region_name=settings.IMAGE_HANDLER_QUEUE_REGION_NAME)
-        self.sqs_client = sqs_resource.Queue(queue_url)
+    def __init__(self, queue_url, region_name=settings.IMAGE_HANDLER_QUEUE_REGION_NAME) -> None:
+        self.queue_url = queue_url
+        self.sqs_client = get_boto3_client("sqs", region_name=region_name)
 
     def send_message(self, message):
-        return self.sqs_client.send_message(MessageBody=message)
+        return self.sqs_client.send_message(QueueUrl=self.queue_url, MessageBody=message)
@@ -180,6 +180,10 @@ ORIGINAL_BACKEND = "django.contrib.gis.db.backends.postgis"
 
 DATABASE_ROUTERS = ("django_tenants.routers.TenantSyncRouter",)
 
+# The default locmem cache is per process: what the workers share through the cache, e.g. the file set meta info
+# validator versions, is read from the database instead. Set CACHE_URL to a shared cache (e.g. redis) in production.
+CACHES = {"default": env.cache("CACHE_URL", default="locmemcache://")}
+
 AUTH_USER_MODEL = "user_auth.User"
 
 AUTHENTICATION_BACKENDS = ("apps.user_auth.auth_backends.EmailMobileAuthentication",)
@@ -324,7 +328,17 @@ AWS_STORAGE_BUCKET_NAME = env("AWS_STORAGE_BUCKET_NAME")
 AWS_DEFAULT_ACL = None
 AWS_ACCESS_KEY_ID = env.get_value("AWS_ACCESS_KEY_ID", default=None)
 AWS_SECRET_ACCESS_KEY = env.get_value("AWS_SECRET_ACCESS_KEY", default=None)
+# points S3Service and the storage backend to an S3 compatible server, e.g. a local MinIO for tests
+AWS_S3_ENDPOINT_URL = env.get_value("AWS_S3_ENDPOINT_URL", default=None)
+AWS_MAX_POOL_CONNECTIONS = env.int("AWS_MAX_POOL_CONNECTIONS", default=50)
+AWS_MAX_RETRY_ATTEMPTS = env.int("AWS_MAX_RETRY_ATTEMPTS", default=3)
+AWS_QUERYSTRING_EXPIRE = env.int("AWS_QUERYSTRING_EXPIRE", default=3600)
 DEFAULT_FILE_STORAGE_OBJECT = locate(DEFAULT_FILE_STORAGE)()
+# Pre signed urls are cached for a little less than their expiry, so that a cached url is never handed out expired.
+PRE_SIGNED_URL_CACHE_TTL = env.int("PRE_SIGNED_URL_CACHE_TTL", default=max(AWS_QUERYSTRING_EXPIRE - 300, 0))
+# Seconds the version of a subscription's file set meta info validator stays in the cache, a version missed by a
+# process (e.g. a cache eviction racing a save) is read again from the database after at most that long.
+FILE_SET_META_INFO_VERSION_CACHE_TTL = env.int("FILE_SET_META_INFO_VERSION_CACHE_TTL", default=3600)
 CUSTOM_MODELS_PATH = env.get_value("CUSTOM_MODELS_PATH", default="all_models")
 CELERY_BROKER_URL = env("CELERY_BROKER_URL", default=None)
 CELERY_TASK_DEFAULT_QUEUE = env("CELERY_TASK_DEFAULT_QUEUE", default=None)
@@ -333,6 +347,7 @@ GF_DS_MODEL_INVOCATION_PATH = env.get_value("GF_DS_MODEL_INVOCATION_PATH", defau
 STM_DS_MODEL_INVOCATION_PATH = env.get_value("STM_DS_MODEL_INVOCATION_PATH", default="/")
 SKYWORKS_DS_MODEL_INVOCATION_PATH = env.get_value("SKYWORKS_DS_MODEL_INVOCATION_PATH", default="/")
 GF7_DATA_PREP_PATH = env.get_value("GF7_DATA_PREP_PATH", default="/")
+STITCH_UPLOAD_WORKERS = env.int("STITCH_UPLOAD_WORKERS", default=16)
 TENANT_FILE_STORAGE = env.get_value("TENANT_FILE_STORAGE", default="S3")
 INFERENCE_QUEUE = env.get_value("INFERENCE_QUEUE", default="inference_development")
 INFERENCE_QUEUE_REGION = env.get_value("INFERENCE_QUEUE_REGION", default="ap-southeast-1")
@@ -349,6 +364,16 @@ IMAGE_HANDLER_QUEUE_REGION_NAME = env("IMAGE_HANDLER_QUEUE_REGION_NAME", default
 IMAGE_HANDLER_QUEUE_URL = env("IMAGE_HANDLER_QUEUE_URL", default=None)
 INFERENCE_METHOD = env.get_value("INFERENCE_METHOD", default=None)
 CELERY_RESULT_BACKEND = env.get_value("CELERY_RESULT_BACKEND", default=None)
+# Budget of the in memory ml model cache of a worker process. 0 means unbounded.
+MODEL_CACHE_MAX_MODELS = env.int("MODEL_CACHE_MAX_MODELS", default=8)
+MODEL_CACHE_MAX_BYTES = env.int("MODEL_CACHE_MAX_BYTES", default=0)
+MODEL_CACHE_MAX_MODELS_PER_TENANT = env.int("MODEL_CACHE_MAX_MODELS_PER_TENANT", default=0)
+MODEL_CACHE_WARMUP_ON_WORKER_START = env.bool("MODEL_CACHE_WARMUP_ON_WORKER_START", default=False)
+# Maintain the daily classification metric rollups and serve the classification dashboards from them. After enabling
+# it, run rebuild_classification_metric_rollups once for every tenant to backfill the existing data.
+CLASSIFICATION_METRIC_ROLLUPS_ENABLED = env.bool("CLASSIFICATION_METRIC_ROLLUPS_ENABLED", default=False)
+# Seconds to wait before rebuilding the stale rollups, the changes made in the meantime are rebuilt together.
+CLASSIFICATION_METRIC_ROLLUP_REFRESH_DELAY = env.int("CLASSIFICATION_METRIC_ROLLUP_REFRESH_DELAY", default=60)
 
 
 if env.get_value("GDAL_LIBRARY_PATH", default=None):